@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Memory cost per bet of the representations a batch goes through
+
+Compares the decoded tuples plus one `Bet` per bet, as batches used to be
+handled, against the `__slots__` Bet and the columnar `BetBatch`.
+
+Usage (from the server directory): python -m benchmarks.bet_memory [--bets N]
+"""
+import argparse
+import datetime
+import logging
+import tracemalloc
+from common.protocol import parse_bet_batch, parse_bet_batch_columns
+from common.utils import Bet
+from benchmarks.decoder import encode_batch_payload
+
+
+class DictBet:
+    """Bet as it was before __slots__"""
+    def __init__(self, agency, first_name, last_name, document, birthdate, number):
+        self.agency = int(agency)
+        self.first_name = first_name
+        self.last_name = last_name
+        self.document = document
+        self.birthdate = datetime.date.fromisoformat(birthdate)
+        self.number = int(number)
+
+
+def measure(build):
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=100_000, help="bets per batch")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    payload = encode_batch_payload(1, args.bets)
+
+    def tuples_and_bets(bet_class):
+        client_id, bets_data = parse_bet_batch(payload)
+        return bets_data, [bet_class(client_id, *bet_data) for bet_data in bets_data]
+
+    results = [
+        ("tuples + Bet with __dict__", lambda: tuples_and_bets(DictBet)),
+        ("tuples + Bet with __slots__", lambda: tuples_and_bets(Bet)),
+        ("BetBatch", lambda: parse_bet_batch_columns(payload)),
+    ]
+    baseline = None
+    for name, build in results:
+        per_bet = measure(build) / args.bets
+        baseline = baseline or per_bet
+        print(f"{name:<28} {per_bet:>8.1f} bytes/bet  ({per_bet / baseline:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of compressed batch payloads
+
+Encodes the agencies dataset (`.data/dataset.zip`) in batches as the load
+generator does and, for every codec the server can decompress, reports
+the compression ratio, the client CPU cost of compressing the batches
+and the server throughput of decompressing and decoding them with
+`CompressedBetBatchDecoder`, against decoding the uncompressed batches
+with `BetBatchDecoder`. Payloads are fed to the decoders in pieces of
+the receive buffer size, as they arrive from a socket.
+
+Usage (from the server directory): python -m benchmarks.compression [--batch-size N] [--rounds R]
+"""
+import argparse
+import logging
+import struct
+from benchmarks.decoder import best_of
+from benchmarks.load import load_dataset, encode_bet, DEFAULT_DATASET
+from common.compression import available_codecs, COMPRESSION_LZ4, COMPRESSION_NONE, COMPRESSION_ZLIB
+from common.protocol import encode_compressed_batch_payload, new_bet_batch_decoder, DEFAULT_RECV_BUFFER_SIZE
+
+
+_BATCH_HEADER = struct.Struct('>II')
+""" Cases measured for every codec: name, codec and zlib level. """
+CASES = [("zlib-1", COMPRESSION_ZLIB, 1), ("zlib-6", COMPRESSION_ZLIB, 6), ("lz4", COMPRESSION_LZ4, 0)]
+
+
+def encode_payloads(dataset, batch_size):
+    payloads = []
+    for agency_id, rows in enumerate(dataset, start=1):
+        for start in range(0, len(rows), batch_size):
+            bets = rows[start:start + batch_size]
+            payloads.append(_BATCH_HEADER.pack(agency_id, len(bets)) + b''.join(encode_bet(row) for row in bets))
+    return payloads
+
+
+def decode_all(payloads, compression):
+    bets = 0
+    for payload in payloads:
+        decoder = new_bet_batch_decoder(len(payload), compression, 1 << 24)
+        offset = 0
+        while not decoder.done:
+            view = decoder.writable_view()
+            received = payload[offset:offset + len(view)]
+            view[:len(received)] = received
+            offset += len(received)
+            bets += sum(len(chunk) for chunk in decoder.feed(len(received)))
+        bets += len(decoder.finish())
+    return bets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=150, help="bets per batch")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds, the best one is reported")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="zip with the agency-N.csv files")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    payloads = encode_payloads(load_dataset(args.dataset), args.batch_size)
+    size = sum(len(payload) for payload in payloads)
+    num_bets = decode_all(payloads, COMPRESSION_NONE)
+    plain = best_of(args.rounds, decode_all, payloads, COMPRESSION_NONE)
+    print(f"dataset: {num_bets} bets in {len(payloads)} batches, {size / 2**20:.1f} MiB, "
+          f"receive buffer {DEFAULT_RECV_BUFFER_SIZE} bytes")
+    print(f"none     ratio  1.00 | compress            - | decode {num_bets / plain:>10,.0f} bets/s")
+
+    for name, codec, level in CASES:
+        if codec not in available_codecs():
+            print(f"{name:<8} skipped, needs the {name} package")
+            continue
+        compress = lambda: [encode_compressed_batch_payload(payload, codec, level) for payload in payloads]
+        compressed = compress()
+        if decode_all(compressed, codec) != num_bets:
+            raise AssertionError("compressed batches decode to other bets")
+        compress_time = best_of(args.rounds, compress)
+        decode_time = best_of(args.rounds, decode_all, compressed, codec)
+        ratio = size / sum(len(payload) for payload in compressed)
+        print(f"{name:<8} ratio {ratio:>5.2f} | compress {size / 2**20 / compress_time:>6.1f} MiB/s | "
+              f"decode {num_bets / decode_time:>10,.0f} bets/s  ({plain / decode_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
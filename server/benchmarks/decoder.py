@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the bet batch decoder
+
+Compares the current `parse_bet_batch` and `recv_all` against the
+slicing decoder and the `data += packet` receive loop they replaced,
+using bets with the names of the agencies dataset. The columnar
+`parse_bet_batch_columns`, which the server uses, is measured as well.
+
+Usage (from the server directory): python -m benchmarks.decoder [--bets N] [--rounds R]
+"""
+import argparse
+import logging
+import socket
+import struct
+import threading
+import time
+from common.protocol import parse_bet_batch, parse_bet_batch_columns, recv_all
+
+
+SAMPLE_BETS = [
+    ("Santiago Lionel", "Lorca", 30904465, 19990317, 2201),
+    ("Agustin Emanuel", "Zambrano", 21689196, 20000510, 9325),
+    ("Tiago Nicolás", "Rivera", 34407251, 20010829, 1033),
+    ("Milagros De Los Angeles", "Valenzuela", 28765432, 19921210, 7574),
+]
+
+
+def encode_batch_payload(client_id: int, num_bets: int) -> bytes:
+    payload = [struct.pack('>II', client_id, num_bets)]
+    for i in range(num_bets):
+        nombre, apellido, documento, nacimiento, numero = SAMPLE_BETS[i % len(SAMPLE_BETS)]
+        nombre = nombre.encode('utf-8')
+        apellido = apellido.encode('utf-8')
+        payload.append(struct.pack('>I', len(nombre)) + nombre)
+        payload.append(struct.pack('>I', len(apellido)) + apellido)
+        payload.append(struct.pack('>III', documento + i, nacimiento, numero))
+    return b''.join(payload)
+
+
+def _legacy_unpack_uint32_be(data):
+    return (data[0] << 24) | (data[1] << 16) | (data[2] << 8) | data[3]
+
+
+def legacy_parse_bet_batch(message_data):
+    """Slicing decoder as it was before memoryview/struct decoding"""
+    client_id = str(_legacy_unpack_uint32_be(message_data[0:4]))
+    batch_size = _legacy_unpack_uint32_be(message_data[4:8])
+    offset = 8
+    bets_data = []
+    for _ in range(batch_size):
+        nombre_len = _legacy_unpack_uint32_be(message_data[offset:offset+4])
+        offset += 4
+        nombre = message_data[offset:offset+nombre_len].decode('utf-8')
+        offset += nombre_len
+        apellido_len = _legacy_unpack_uint32_be(message_data[offset:offset+4])
+        offset += 4
+        apellido = message_data[offset:offset+apellido_len].decode('utf-8')
+        offset += apellido_len
+        documento = _legacy_unpack_uint32_be(message_data[offset:offset+4])
+        offset += 4
+        nacimiento_int = _legacy_unpack_uint32_be(message_data[offset:offset+4])
+        offset += 4
+        year = nacimiento_int // 10000
+        month = (nacimiento_int % 10000) // 100
+        day = nacimiento_int % 100
+        nacimiento = f"{year:04d}-{month:02d}-{day:02d}"
+        numero = _legacy_unpack_uint32_be(message_data[offset:offset+4])
+        offset += 4
+        bets_data.append((nombre, apellido, str(documento), nacimiento, str(numero)))
+    return (client_id, bets_data)
+
+
+def legacy_recv_all(sock, n):
+    """Receive loop as it was before receiving into a preallocated buffer"""
+    data = b''
+    while len(data) < n:
+        packet = sock.recv(n - len(data))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+
+def best_of(rounds, fn, *args):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_decode(payload, num_bets, rounds):
+    if parse_bet_batch(payload) != legacy_parse_bet_batch(payload):
+        raise AssertionError("decoders disagree")
+
+    legacy = best_of(rounds, legacy_parse_bet_batch, payload)
+    current = best_of(rounds, parse_bet_batch, payload)
+    print(f"decode  legacy:  {num_bets / legacy:>12,.0f} bets/s")
+    print(f"decode  current: {num_bets / current:>12,.0f} bets/s  ({legacy / current:.2f}x)")
+    columns = best_of(rounds, parse_bet_batch_columns, payload)
+    print(f"decode  columns: {num_bets / columns:>12,.0f} bets/s  ({legacy / columns:.2f}x)")
+
+
+def bench_recv(payload, rounds):
+    def receive(recv_fn):
+        sender, receiver = socket.socketpair()
+        writer = threading.Thread(target=sender.sendall, args=(payload,))
+        writer.start()
+        try:
+            recv_fn(receiver, len(payload))
+        finally:
+            writer.join()
+            sender.close()
+            receiver.close()
+
+    mib = len(payload) / (1024 * 1024)
+    legacy = best_of(rounds, receive, legacy_recv_all)
+    current = best_of(rounds, receive, recv_all)
+    print(f"recv    legacy:  {mib / legacy:>12,.1f} MiB/s")
+    print(f"recv    current: {mib / current:>12,.1f} MiB/s  ({legacy / current:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=100_000, help="bets per batch")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds, the best one is reported")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    payload = encode_batch_payload(1, args.bets)
+    print(f"batch: {args.bets} bets, {len(payload)} bytes")
+    bench_decode(payload, args.bets, args.rounds)
+    bench_recv(payload, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the winners computation over the stored bets
+
+Fills a binary and a CSV storage with the given number of bets and
+compares `draw.compute_winners`, which scans the storage as columns and
+matches each chunk in bulk, against evaluating `has_won` on every `Bet`
+of `load_bets` and against the `find_by_number` scan it replaced.
+Reports whether NumPy was used for the matching.
+
+Usage (from the server directory): python -m benchmarks.draw [--bets N] [--agencies A] [--rounds R]
+"""
+import argparse
+import logging
+import os
+import tempfile
+from benchmarks.decoder import best_of, encode_batch_payload
+from common import draw
+from common.protocol import parse_bet_batch_columns
+from common.storage import BinaryBetStorage, CsvBetStorage
+from common.utils import has_won, LOTTERY_WINNER_NUMBER
+
+BATCH_BETS = 10_000
+
+
+def fill(storage, num_bets: int, num_agencies: int) -> None:
+    for start in range(0, num_bets, BATCH_BETS):
+        agency = start // BATCH_BETS % num_agencies + 1
+        storage.append(parse_bet_batch_columns(encode_batch_payload(agency, min(BATCH_BETS, num_bets - start))))
+    storage.flush(sync=False)
+    storage.close()
+
+
+def legacy_has_won(storage):
+    """Per-bet evaluation of has_won over every loaded Bet"""
+    winners = {}
+    for bet in storage.load_bets():
+        if has_won(bet):
+            winners.setdefault(str(bet.agency), []).append(str(bet.document))
+    return winners
+
+
+def legacy_find_by_number(storage):
+    """Row by row scan filtered on the number, as loaded before the columnar scan"""
+    winners = {}
+    for agency, document in storage.find_by_number({LOTTERY_WINNER_NUMBER}):
+        winners.setdefault(str(agency), []).append(document)
+    return winners
+
+
+def bench(name, storage, num_bets, rounds):
+    expected = {agency_id: [document for document, _ in winners] for agency_id, winners in draw.compute_winners(storage).items()}
+    if legacy_has_won(storage) != expected or legacy_find_by_number(storage) != expected:
+        raise AssertionError("winners disagree")
+
+    has_won_time = best_of(rounds, legacy_has_won, storage)
+    find_time = best_of(rounds, legacy_find_by_number, storage)
+    columns_time = best_of(rounds, draw.compute_winners, storage)
+    print(f"{name:<7} has_won:  {num_bets / has_won_time:>12,.0f} bets/s")
+    print(f"{name:<7} find:     {num_bets / find_time:>12,.0f} bets/s  ({has_won_time / find_time:.2f}x)")
+    print(f"{name:<7} columns:  {num_bets / columns_time:>12,.0f} bets/s  ({has_won_time / columns_time:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=1_000_000, help="stored bets")
+    parser.add_argument("--agencies", type=int, default=5, help="agencies the bets are spread over")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds, the best one is reported")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    print(f"storage: {args.bets} bets, numpy: {'yes' if draw.numpy is not None else 'no'}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, storage in (("binary", BinaryBetStorage(os.path.join(directory, "bets.log"))),
+                              ("csv", CsvBetStorage(os.path.join(directory, "bets.csv")))):
+            fill(storage, args.bets, args.agencies)
+            bench(name, storage, args.bets, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Load generator and benchmark of a running server
+
+Replays the agencies dataset (`.data/dataset.zip`) over the bet protocol:
+every simulated agency sends its bets in batches, notifies that it
+finished and queries its winners, as the Go client does. Simulated agency
+N replays `agency-N.csv`, wrapping around the files of the dataset.
+Reports ingested bets/s, the batch ack latency and the winners query
+latency, which is measured once every agency finished, so it does not
+include the wait for the draw.
+
+With --window W agencies send sequenced batches, up to W of them ahead
+of the server acks, instead of waiting for the ack of each batch.
+
+With --compression CODEC agencies negotiate that codec on their connection
+and send their batch payloads compressed, compressing them before the load
+starts so the client CPU does not count in the results.
+
+With --spawn a server is started from this tree in a temporary directory,
+configured through --env KEY=VALUE, and stopped with SIGTERM at the end.
+
+Usage (from the server directory):
+    python -m benchmarks.load --spawn --agencies 5 --batch-size 150
+    python -m benchmarks.load --spawn --agencies 5 --batch-size 150 --window 16
+    python -m benchmarks.load --spawn --agencies 5 --batch-size 150 --compression zlib
+    python -m benchmarks.load --host server --port 12345 --agencies 5
+"""
+import argparse
+import csv
+import io
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from common.compression import COMPRESSION_CODECS, COMPRESSION_NONE
+from common.protocol import encode_compressed_batch_payload, MESSAGE_TYPE_BATCH, MESSAGE_TYPE_FINISHED_SENDING, MESSAGE_TYPE_NEGOTIATE_COMPRESSION, MESSAGE_TYPE_QUERY_WINNERS, MESSAGE_TYPE_SEQUENCED_BATCH
+from common.utils import LOTTERY_WINNER_NUMBER
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DATASET = os.path.join(os.path.dirname(SERVER_DIR), ".data", "dataset.zip")
+
+_MESSAGE_HEADER = struct.Struct('>II')
+_UINT32 = struct.Struct('>I')
+_BET_FIXED_FIELDS = struct.Struct('>III')
+_BATCH_ACK = struct.Struct('>BI')
+
+
+def load_dataset(path: str) -> list:
+    """
+    Return the rows of every agency file of the dataset, ordered by agency
+    """
+    agencies = []
+    with zipfile.ZipFile(path) as dataset:
+        names = sorted((name for name in dataset.namelist() if name.startswith("agency-")),
+                       key=lambda name: int(name[len("agency-"):-len(".csv")]))
+        for name in names:
+            with dataset.open(name) as file:
+                agencies.append(list(csv.reader(io.TextIOWrapper(file, encoding='utf-8'))))
+    return agencies
+
+
+def encode_bet(row) -> bytes:
+    nombre, apellido, documento, nacimiento, numero = row
+    nombre = nombre.encode('utf-8')
+    apellido = apellido.encode('utf-8')
+    return b''.join((_UINT32.pack(len(nombre)), nombre, _UINT32.pack(len(apellido)), apellido,
+                     _BET_FIXED_FIELDS.pack(int(documento), int(nacimiento.replace('-', '')), int(numero))))
+
+
+def encode_message(message_type: int, payload: bytes) -> bytes:
+    return _MESSAGE_HEADER.pack(message_type, len(payload)) + payload
+
+
+def encode_batches(agency_id: int, rows: list, batch_size: int, compression: int = COMPRESSION_NONE) -> list:
+    batches = []
+    for start in range(0, len(rows), batch_size):
+        bets = rows[start:start + batch_size]
+        payload = _MESSAGE_HEADER.pack(agency_id, len(bets)) + b''.join(encode_bet(row) for row in bets)
+        if compression != COMPRESSION_NONE:
+            payload = encode_compressed_batch_payload(payload, compression)
+        batches.append((len(bets), encode_message(MESSAGE_TYPE_BATCH, payload)))
+    return batches
+
+
+def recv_exactly(sock, n: int) -> bytes:
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("server closed the connection")
+        received += count
+    return bytes(data)
+
+
+def receive_response(sock) -> bytes:
+    length = _UINT32.unpack(recv_exactly(sock, 4))[0]
+    response = recv_exactly(sock, length)
+    if response[0] != 0:
+        raise RuntimeError("server answered with an error")
+    return response
+
+
+class Agency:
+    """
+    Simulated agency that replays its rows over one connection
+    """
+    def __init__(self, agency_id: int, rows: list, batch_size: int, window: int = 0, compression: int = COMPRESSION_NONE):
+        self.agency_id = agency_id
+        self.window = window
+        self.compression = compression
+        self.batches = encode_batches(agency_id, rows, batch_size, compression)
+        if window:
+            # Sequenced batch: message_type(4), sequence_number(4), then the batch message length and payload
+            self.batches = [(count, _MESSAGE_HEADER.pack(MESSAGE_TYPE_SEQUENCED_BATCH, sequence_number) + message[4:])
+                            for sequence_number, (count, message) in enumerate(self.batches, 1)]
+        self.expected_winners = sorted(int(row[2]) for row in rows if int(row[4]) == LOTTERY_WINNER_NUMBER)
+        self.ack_latencies = []
+        self.query_latency = None
+        self.winners = None
+        self.error = None
+
+    def run(self, host: str, port: int, finished: threading.Barrier) -> None:
+        try:
+            with socket.create_connection((host, port)) as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if self.compression != COMPRESSION_NONE:
+                    self.negotiate_compression(sock)
+                if self.window:
+                    self.send_pipelined(sock)
+                else:
+                    for _, message in self.batches:
+                        start = time.perf_counter()
+                        sock.sendall(message)
+                        receive_response(sock)
+                        self.ack_latencies.append(time.perf_counter() - start)
+
+                sock.sendall(encode_message(MESSAGE_TYPE_FINISHED_SENDING, _UINT32.pack(self.agency_id)))
+                receive_response(sock)
+                finished.wait()
+
+                start = time.perf_counter()
+                sock.sendall(encode_message(MESSAGE_TYPE_QUERY_WINNERS, _UINT32.pack(self.agency_id)))
+                response = receive_response(sock)
+                self.query_latency = time.perf_counter() - start
+                count = _UINT32.unpack_from(response, 1)[0]
+                self.winners = sorted(struct.unpack_from(f'>{count}I', response, 5))
+        except Exception as e:
+            self.error = e
+            finished.abort()
+
+    def negotiate_compression(self, sock) -> None:
+        sock.sendall(encode_message(MESSAGE_TYPE_NEGOTIATE_COMPRESSION, bytes([self.compression])))
+        if receive_response(sock)[1] != self.compression:
+            raise RuntimeError("server did not accept the compression codec")
+
+    def send_pipelined(self, sock) -> None:
+        """
+        Send the sequenced batches keeping up to `window` of them unacked
+        """
+        sent_at = {}
+        window = threading.Semaphore(self.window)
+        failed = []
+
+        def receive_acks():
+            next_unacked = 1
+            try:
+                while next_unacked <= len(self.batches):
+                    length = _UINT32.unpack(recv_exactly(sock, 4))[0]
+                    code, sequence_number = _BATCH_ACK.unpack(recv_exactly(sock, length))
+                    now = time.perf_counter()
+                    if code != 0:
+                        failed.append(sequence_number)
+                    # A successful ack covers every batch up to its sequence number
+                    for acked in range(next_unacked, sequence_number + 1):
+                        if code == 0 or acked == sequence_number:
+                            self.ack_latencies.append(now - sent_at.pop(acked))
+                            window.release()
+                    next_unacked = sequence_number + 1
+            except Exception as e:
+                failed.append(e)
+                for _ in range(len(self.batches)):
+                    window.release()
+
+        receiver = threading.Thread(target=receive_acks)
+        receiver.start()
+        for sequence_number, (_, message) in enumerate(self.batches, 1):
+            window.acquire()
+            if failed:
+                break
+            sent_at[sequence_number] = time.perf_counter()
+            sock.sendall(message)
+        receiver.join()
+        if failed:
+            raise RuntimeError(f"batches failed: {failed}")
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def spawn_server(port: int, num_agencies: int, env: dict, timeout: float = 10, poll_interval: float = 0.05):
+    """
+    Start a server from this tree in a temporary directory, and wait until it accepts connections
+    """
+    workdir = tempfile.mkdtemp(prefix="bets-load-")
+    shutil.copy(os.path.join(SERVER_DIR, "config.ini"), workdir)
+    server_env = dict(os.environ, SERVER_PORT=str(port), NUM_AGENCIES=str(num_agencies),
+                      LOGGING_LEVEL="WARNING", PYTHONPATH=SERVER_DIR)
+    server_env.update(env)
+    server = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, "main.py")], cwd=workdir, env=server_env)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server, workdir
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("spawned server did not start")
+            time.sleep(poll_interval)
+
+
+def run_load(host: str, port: int, agencies: list) -> float:
+    finished = threading.Barrier(len(agencies))
+    threads = [threading.Thread(target=agency.run, args=(host, port, finished)) for agency in agencies]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def report(agencies: list, elapsed: float) -> None:
+    for agency in agencies:
+        if agency.error is not None:
+            print(f"agency {agency.agency_id}: failed: {agency.error!r}")
+        elif agency.winners != agency.expected_winners:
+            print(f"agency {agency.agency_id}: got {len(agency.winners)} winners, expected {len(agency.expected_winners)}")
+
+    bets = sum(count for agency in agencies for count, _ in agency.batches)
+    acks = [latency for agency in agencies for latency in agency.ack_latencies]
+    queries = [agency.query_latency for agency in agencies if agency.query_latency is not None]
+    print(f"bets:          {bets} in {elapsed:.2f}s, {bets / elapsed:,.0f} bets/s")
+    if acks:
+        print(f"batch ack:     p50 {percentile(acks, 0.5) * 1000:.2f} ms | p99 {percentile(acks, 0.99) * 1000:.2f} ms | {len(acks)} batches")
+    if queries:
+        print(f"winners query: p50 {percentile(queries, 0.5) * 1000:.2f} ms | p99 {percentile(queries, 0.99) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--agencies", type=int, default=5, help="simulated agencies, one connection each")
+    parser.add_argument("--batch-size", type=int, default=150, help="bets per batch")
+    parser.add_argument("--window", type=int, default=0,
+                        help="sequenced batches sent ahead of the acks, 0 waits for the ack of each batch")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_CODECS), help="codec to compress the batches with")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="zip with the agency-N.csv files")
+    parser.add_argument("--spawn", action="store_true", help="start a local server from this tree")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="config of the spawned server, e.g. --env SERVER_ENGINE=asyncio")
+    args = parser.parse_args()
+
+    dataset = load_dataset(args.dataset)
+    compression = COMPRESSION_CODECS[args.compression] if args.compression else COMPRESSION_NONE
+    agencies = [Agency(agency_id, dataset[(agency_id - 1) % len(dataset)], args.batch_size, args.window, compression)
+                for agency_id in range(1, args.agencies + 1)]
+
+    server = None
+    if args.spawn:
+        env = dict(setting.split("=", 1) for setting in args.env)
+        server, workdir = spawn_server(args.port, args.agencies, env)
+    try:
+        elapsed = run_load(args.host, args.port, agencies)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(agencies, elapsed)
+
+
+if __name__ == "__main__":
+    main()
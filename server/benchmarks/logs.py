@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Time spent by handler threads logging the batches they receive
+
+Starts the given number of threads that log the given number of
+`apuesta_recibida` lines each, as the handlers do, writing the log to a
+temporary file, and compares synchronous logging against the asynchronous
+one of `common.logs`, with and without sampling. Reports the time the
+threads took, which is what a handler waits for, and the time until every
+line was written.
+
+Usage (from the server directory): python -m benchmarks.logs [--threads T] [--batches N] [--sample S]
+"""
+import argparse
+import logging
+import sys
+import tempfile
+import threading
+import time
+from common import logs
+
+
+def log_batches(batches: int) -> None:
+    for _ in range(batches):
+        logs.log_batch_received(100)
+
+
+def measure(output, threads: int, batches: int, asynchronous: bool, sample: int):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    sys.stderr = output
+    logs.initialize_log("INFO", asynchronous, sample)
+
+    workers = [threading.Thread(target=log_batches, args=(batches,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    logged = time.perf_counter() - start
+    logs.stop_log()
+    written = time.perf_counter() - start
+    sys.stderr = sys.__stderr__
+    return logged, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8, help="logging threads")
+    parser.add_argument("--batches", type=int, default=50_000, help="batches logged by each thread")
+    parser.add_argument("--sample", type=int, default=10, help="batches per line logged when sampling")
+    args = parser.parse_args()
+
+    lines = args.threads * args.batches
+    for name, asynchronous, sample in (("sync", False, 1), ("async", True, 1), (f"async 1/{args.sample}", True, args.sample)):
+        with tempfile.TemporaryFile("w") as output:
+            logged, written = measure(output, args.threads, args.batches, asynchronous, sample)
+        print(f"{name:<12} handlers: {logged * 1e6 / lines:>6.2f} us/batch  written: {written * 1e6 / lines:>6.2f} us/batch")
+
+
+if __name__ == "__main__":
+    main()
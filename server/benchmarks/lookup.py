@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Latency of the point lookups of the secondary indexes
+
+Fills a storage of the given backend with the given number of bets of
+random documents, spread over 5 agencies, reporting the append rate with
+the indexes maintained and their size on disk. Then reopens the storage
+and measures `find_bets` by document of stored documents, and the bets
+count of an agency, against finding a document by scanning the column
+cache, as every lookup had to before.
+
+Usage (from the server directory): python -m benchmarks.lookup [--bets N] [--backend binary|csv] [--lookups L]
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from common.storage import create_storage, STORAGE_BACKENDS, STORAGE_BACKEND_BINARY
+from common.utils import BetBatch
+
+BATCH_BETS = 10_000
+AGENCIES = 5
+
+
+def fill(storage, num_bets: int, sample_every: int) -> list:
+    """
+    Append the bets as the storage writer would, returning a sample of their documents
+    """
+    rand = random.Random(1)
+    sample = []
+    for start in range(0, num_bets, BATCH_BETS):
+        batch = BetBatch(start // BATCH_BETS % AGENCIES + 1)
+        for i in range(start, min(start + BATCH_BETS, num_bets)):
+            document = rand.randrange(10_000_000, 99_999_999)
+            batch.append("Santiago Lionel", "Lorca", document, 19990317, i % 10000)
+            if i % sample_every == 0:
+                sample.append(document)
+        storage.append(batch)
+        storage.flush(sync=False)
+    storage.close()
+    return sample
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    return sorted(latencies)[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=2_000_000, help="stored bets")
+    parser.add_argument("--backend", choices=STORAGE_BACKENDS, default=STORAGE_BACKEND_BINARY, help="storage backend")
+    parser.add_argument("--lookups", type=int, default=1000, help="lookups by document measured")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = "bets.log" if args.backend == STORAGE_BACKEND_BINARY else "bets.csv"
+        storage = create_storage(args.backend, os.path.join(directory, filename))
+        start = time.perf_counter()
+        documents = fill(storage, args.bets, max(1, args.bets // args.lookups))
+        elapsed = time.perf_counter() - start
+        index_size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if ".idx" in name)
+        print(f"storage: {args.backend}, {args.bets} bets")
+        print(f"append:   {args.bets / elapsed:>12,.0f} bets/s with indexes, "
+              f"{index_size / 2**20:.1f} MiB of indexes ({index_size / os.path.getsize(storage.filepath):.2f}x the storage)")
+
+        storage = create_storage(args.backend, storage.filepath)
+        start = time.perf_counter()
+        storage.find_bets("document", documents[0])
+        print(f"open:     {(time.perf_counter() - start) * 1000:>12.1f} ms")
+
+        latencies = []
+        for document in documents:
+            start = time.perf_counter()
+            total, bets = storage.find_bets("document", document)
+            latencies.append(time.perf_counter() - start)
+            assert total >= 1 and any(int(bet.document) == document for bet in bets)
+        print(f"document: {percentile(latencies, 0.5) * 1000:>12.3f} ms p50, "
+              f"{percentile(latencies, 0.99) * 1000:.3f} ms p99 over {len(latencies)} lookups")
+
+        start = time.perf_counter()
+        total, _ = storage.find_bets("agency", 1, limit=0)
+        print(f"agency:   {(time.perf_counter() - start) * 1000:>12.3f} ms to count {total} bets")
+
+        start = time.perf_counter()
+        found = sum(1 for _, chunk_documents, _ in storage.scan_columns() for document in chunk_documents if document == documents[0])
+        print(f"scan:     {(time.perf_counter() - start) * 1000:>12.1f} ms for a document over the column cache ({found} found)")
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
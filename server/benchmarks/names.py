@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Disk size and load memory of dictionary-encoded names
+
+Stores the given number of bets of the agencies dataset (`.data/dataset.zip`),
+wrapping around it, in a binary storage and in a CSV storage, and compares
+the size of the binary log plus its names table against the CSV file and
+against the log with inline names it replaced. Then compares the memory
+taken by the `Bet` objects of `load_bets` of the binary storage, which
+share one object per name, against bets holding their own copy of every
+name, as loaded before. Memory is measured with tracemalloc.
+
+Usage (from the server directory): python -m benchmarks.names [--bets N]
+"""
+import argparse
+import logging
+import os
+import tempfile
+import tracemalloc
+from benchmarks.load import load_dataset, DEFAULT_DATASET
+from common.storage import BinaryBetStorage, CsvBetStorage
+from common.utils import Bet, BetBatch, pack_date
+
+BATCH_BETS = 10_000
+""" Size of a record of the log with inline names, without the names. """
+LEGACY_RECORD_HEADER_SIZE = 20
+
+
+def fill(storages, rows, num_bets):
+    legacy_size = 0
+    for start in range(0, num_bets, BATCH_BETS):
+        batch = BetBatch(start // BATCH_BETS % 5 + 1)
+        for i in range(start, min(start + BATCH_BETS, num_bets)):
+            first_name, last_name, document, birthdate, number = rows[i % len(rows)]
+            batch.append(first_name, last_name, int(document), int(birthdate.replace('-', '')), int(number))
+            legacy_size += LEGACY_RECORD_HEADER_SIZE + len(first_name.encode('utf-8')) + len(last_name.encode('utf-8'))
+        for storage in storages:
+            storage.append(batch)
+    for storage in storages:
+        storage.flush(sync=False)
+        storage.close()
+    return legacy_size
+
+
+def measure(build):
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=1_000_000, help="stored bets")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="zip with the agency-N.csv files")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    rows = [row for agency in load_dataset(args.dataset) for row in agency]
+    with tempfile.TemporaryDirectory() as directory:
+        binary = BinaryBetStorage(os.path.join(directory, "bets.log"))
+        csv = CsvBetStorage(os.path.join(directory, "bets.csv"))
+        legacy_size = fill([binary, csv], rows, args.bets)
+        log_size = os.path.getsize(binary.filepath)
+        names_size = os.path.getsize(binary.filepath + ".names")
+
+        print(f"storage: {args.bets} bets")
+        print(f"disk  csv:            {os.path.getsize(csv.filepath) / 2**20:>8.1f} MiB")
+        print(f"disk  inline names:   {legacy_size / 2**20:>8.1f} MiB")
+        print(f"disk  encoded names:  {(log_size + names_size) / 2**20:>8.1f} MiB  "
+              f"(names table {names_size / 2**10:.0f} KiB, {legacy_size / (log_size + names_size):.2f}x)")
+
+        def copied_names():
+            return [Bet.from_packed(bet.agency, ''.join(bet.first_name), ''.join(bet.last_name),
+                                    int(bet.document), pack_date(bet.birthdate), bet.number)
+                    for bet in binary.load_bets()]
+
+        # Names of the copies are built from characters, so they are not shared
+        legacy = measure(copied_names)
+        current = measure(lambda: list(binary.load_bets()))
+        print(f"load  copied names:   {legacy / args.bets:>8.1f} bytes/bet")
+        print(f"load  shared names:   {current / args.bets:>8.1f} bytes/bet  ({legacy / current:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Throughput of the parallel load of a storage
+
+Fills a storage of the given backend with the given number of bets and
+compares the sequential `load_bets`, which builds a `Bet` per row on one
+core, against `parallel_load.load_batches` and
+`parallel_load.winners_per_agency` with 1 up to the given number of
+worker processes. Reports the CPUs available, since the speedup is bound
+by them.
+
+Usage (from the server directory): python -m benchmarks.parallel_load [--bets N] [--backend binary|csv] [--workers W]
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from common import parallel_load
+from common.storage import create_storage, STORAGE_BACKENDS, STORAGE_BACKEND_CSV
+from common.utils import BetBatch
+
+BATCH_BETS = 10_000
+AGENCIES = 5
+
+
+def fill(storage, num_bets: int) -> None:
+    rand = random.Random(1)
+    for start in range(0, num_bets, BATCH_BETS):
+        batch = BetBatch(start // BATCH_BETS % AGENCIES + 1)
+        for i in range(start, min(start + BATCH_BETS, num_bets)):
+            batch.append("Santiago Lionel", "Lorca", 10_000_000 + i, 19990317, rand.randrange(10_000))
+        storage.append(batch)
+    storage.flush(sync=False)
+    storage.close()
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=2_000_000, help="stored bets")
+    parser.add_argument("--backend", choices=STORAGE_BACKENDS, default=STORAGE_BACKEND_CSV, help="storage backend")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="most worker processes measured")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = "bets.csv" if args.backend == STORAGE_BACKEND_CSV else "bets.log"
+        storage = create_storage(args.backend, os.path.join(directory, filename))
+        fill(storage, args.bets)
+        print(f"storage: {args.backend}, {args.bets} bets, {os.path.getsize(storage.filepath) / 2**20:.0f} MiB, "
+              f"cpus: {os.cpu_count()}")
+
+        sequential = timed(lambda: sum(1 for _ in storage.load_bets()))
+        print(f"load_bets:                  {args.bets / sequential:>12,.0f} bets/s")
+        workers = 1
+        while workers <= args.workers:
+            batches = timed(lambda: sum(len(batch) for batch in parallel_load.load_batches(storage, workers)))
+            winners = timed(parallel_load.winners_per_agency, storage, parallel_load.DEFAULT_DRAW_ENGINE, workers)
+            print(f"{workers:>2} workers load_batches:    {args.bets / batches:>12,.0f} bets/s  ({sequential / batches:.2f}x)")
+            print(f"{workers:>2} workers winners:         {args.bets / winners:>12,.0f} bets/s  ({sequential / winners:.2f}x)")
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
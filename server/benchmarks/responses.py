@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the winners response encoding and sending
+
+Compares `encode_winners` and `send_winners` against the concatenation
+encoder and the slicing `send_all` they replaced, for a winners list of
+the given size, and sending the response the winners index published at
+the draw, as every query after the draw does.
+
+Usage (from the server directory): python -m benchmarks.responses [--winners N] [--rounds R]
+"""
+import argparse
+import logging
+import socket
+import threading
+from benchmarks.decoder import best_of
+from common.protocol import encode_winners, pack_uint32_be, send_all, send_winners, RESPONSE_OK
+from common.winners import WinnersIndex
+
+
+def legacy_encode_winners(winners):
+    """Concatenation encoder as it was before array encoding"""
+    message_length = 1 + 4 + (len(winners) * 4)
+    message = pack_uint32_be(message_length) + bytes([RESPONSE_OK])
+    message += pack_uint32_be(len(winners))
+    for winner_documento in winners:
+        message += pack_uint32_be(int(winner_documento))
+    return message
+
+
+def legacy_send_all(sock, data):
+    """Slicing send loop as it was before memoryview sends"""
+    total_sent = 0
+    while total_sent < len(data):
+        sent = sock.send(data[total_sent:])
+        total_sent += sent
+
+
+def bench_encode(winners, rounds):
+    if encode_winners(winners) != legacy_encode_winners(winners):
+        raise AssertionError("encoders disagree")
+
+    legacy = best_of(rounds, legacy_encode_winners, winners)
+    current = best_of(rounds, encode_winners, winners)
+    print(f"encode  legacy:  {len(winners) / legacy:>12,.0f} winners/s")
+    print(f"encode  current: {len(winners) / current:>12,.0f} winners/s  ({legacy / current:.2f}x)")
+
+
+def bench_send(winners, rounds):
+    size = len(encode_winners(winners))
+
+    def send(send_fn):
+        sender, receiver = socket.socketpair()
+
+        def drain():
+            remaining = size
+            while remaining:
+                remaining -= len(receiver.recv(1 << 20))
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        try:
+            send_fn(sender)
+        finally:
+            reader.join()
+            sender.close()
+            receiver.close()
+
+    index = WinnersIndex()
+    for document in winners:
+        index.add_winner('1', document)
+    index.publish()
+
+    legacy = best_of(rounds, send, lambda sock: legacy_send_all(sock, legacy_encode_winners(winners)))
+    current = best_of(rounds, send, lambda sock: send_winners(sock, winners))
+    published = best_of(rounds, send, lambda sock: send_all(sock, index.winners_response('1')))
+    print(f"send    legacy:  {len(winners) / legacy:>12,.0f} winners/s")
+    print(f"send    current: {len(winners) / current:>12,.0f} winners/s  ({legacy / current:.2f}x)")
+    print(f"send    published: {len(winners) / published:>10,.0f} winners/s  ({legacy / published:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--winners", type=int, default=100_000, help="winners in the response")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds, the best one is reported")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    winners = [str(30000000 + i) for i in range(args.winners)]
+    print(f"response: {args.winners} winners")
+    bench_encode(winners, args.rounds)
+    bench_send(winners, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
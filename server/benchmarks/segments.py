@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Winners scans over the segments of the column cache
+
+Fills a storage of the given backend with bets of uniformly random numbers
+in batches flushed one by one, as the storage writer does, reporting the
+append rate while the compactor merges the small segments of each flush,
+and the segments left once it settles. Then compares
+`draw.compute_winners`, which skips the segments whose bloom filter rules
+out every winning number, against classifying every segment, for one
+winning number and for a range of them.
+
+Usage (from the server directory): python -m benchmarks.segments [--bets N] [--backend binary|csv] [--batch B]
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from benchmarks.decoder import best_of
+from common import draw
+from common.storage import create_storage, STORAGE_BACKENDS, STORAGE_BACKEND_BINARY
+from common.utils import BetBatch
+
+AGENCIES = 5
+
+
+def fill(storage, num_bets: int, batch_bets: int) -> None:
+    rand = random.Random(1)
+    for start in range(0, num_bets, batch_bets):
+        batch = BetBatch(start // batch_bets % AGENCIES + 1)
+        for i in range(start, min(start + batch_bets, num_bets)):
+            batch.append("Santiago Lionel", "Lorca", 10_000_000 + i, 19990317, rand.randrange(10_000))
+        storage.append(batch)
+        storage.flush(sync=False)
+
+
+def wait_for_compaction(directory: str) -> int:
+    """
+    Wait until the compactor leaves the segments alone, returning their count
+    """
+    segments = -1
+    while segments != len(os.listdir(directory)):
+        segments = len(os.listdir(directory))
+        time.sleep(0.5)
+    return segments
+
+
+def full_scan(storage, engine):
+    """Classification of every segment, as before they could be skipped"""
+    winners = {}
+    for agencies, documents, numbers in storage.scan_columns():
+        for agency, document, tier in engine.classify_columns(agencies, documents, numbers):
+            winners.setdefault(str(agency), []).append((str(document), tier))
+    return winners
+
+
+def scanned_bets(storage, engine) -> int:
+    return sum(len(numbers) for _, _, numbers in storage.scan_columns(numbers_of=engine.winning_numbers_of))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=2_000_000, help="stored bets")
+    parser.add_argument("--backend", choices=STORAGE_BACKENDS, default=STORAGE_BACKEND_BINARY, help="storage backend")
+    parser.add_argument("--batch", type=int, default=1000, help="bets per flushed batch")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds, the best one is reported")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = "bets.log" if args.backend == STORAGE_BACKEND_BINARY else "bets.csv"
+        storage = create_storage(args.backend, os.path.join(directory, filename))
+        start = time.perf_counter()
+        fill(storage, args.bets, args.batch)
+        elapsed = time.perf_counter() - start
+        segments = wait_for_compaction(storage.filepath + ".cols")
+        print(f"storage: {args.backend}, {args.bets} bets in batches of {args.batch}, numpy: {'yes' if draw.numpy is not None else 'no'}")
+        print(f"append:   {args.bets / elapsed:>12,.0f} bets/s, {segments} segments once compacted")
+
+        for name, rules in (("1 number", "1:7574"), ("100 numbers", "1:7500-7599")):
+            engine = draw.DrawEngine(draw.parse_draw_rules(rules))
+            if draw.compute_winners(storage, engine) != full_scan(storage, engine):
+                raise AssertionError("winners disagree")
+            skipping = best_of(args.rounds, draw.compute_winners, storage, engine)
+            full = best_of(args.rounds, full_scan, storage, engine)
+            print(f"{name:<12} scanned: {scanned_bets(storage, engine) / args.bets:>6.1%} of the bets, "
+                  f"{skipping * 1000:.1f} ms vs {full * 1000:.1f} ms classifying every segment ({full / skipping:.2f}x)")
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
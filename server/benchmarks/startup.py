@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the server startup over a large existing storage
+
+Fills a storage with the given number of bets, then measures the time
+from starting a server process until it accepts its first connection,
+which includes the interpreter startup, the imports and the recovery of
+the storage, in each of these cases:
+
+    rebuild     the storage alone, without column cache nor write-ahead log,
+                as left by a server from before both: every bet is walked
+    columns     no write-ahead log configured: winners are loaded from the
+                column cache
+    wal         a write-ahead log with a record per stored chunk, as
+                written by the storage writer
+    compacted   the same log, compacted by a previous start
+
+Every round starts from a fresh copy of the files of its case.
+
+Usage (from the server directory): python -m benchmarks.startup [--bets N] [--backend binary|csv] [--rounds R]
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+from benchmarks.draw import fill
+from benchmarks.load import spawn_server
+from common.draw import compute_winners
+from common.storage import create_storage
+from common.wal import WriteAheadLog, recover
+
+# Bets per record of the write-ahead log, as a batch is stored in chunks of this size
+CHUNK_BETS = 1024
+
+
+def write_wal(filepath: str, storage, num_bets: int) -> None:
+    """
+    Write the log the storage writer would have written while filling the storage
+    """
+    wal = WriteAheadLog(filepath)
+    size = storage.size()
+    chunks = max(1, num_bets // CHUNK_BETS)
+    for chunk in range(1, chunks + 1):
+        wal.append_batch(1, 0, size * chunk // chunks, [])
+    for agency_id, winners in compute_winners(storage).items():
+        wal.append_batch(int(agency_id), 0, size, [(int(document), tier) for document, tier in winners])
+    wal.flush(sync=False)
+    wal.close()
+
+
+def prepare(directory: str, backend: str, num_bets: int, num_agencies: int) -> dict:
+    """
+    Return the files of every case, by name of the file in the server directory
+    """
+    storage_name = "bets.log" if backend == "binary" else "bets.csv"
+    storage_filepath = os.path.join(directory, storage_name)
+    storage = create_storage(backend, storage_filepath)
+    fill(storage, num_bets, num_agencies)
+
+    wal_filepath = os.path.join(directory, "bets.wal")
+    write_wal(wal_filepath, storage, num_bets)
+    compacted_filepath = os.path.join(directory, "bets.compacted.wal")
+    shutil.copy(wal_filepath, compacted_filepath)
+    recover(storage, WriteAheadLog(compacted_filepath))
+    storage.close()
+
+    stored = {storage_name: storage_filepath}
+    if os.path.exists(storage_filepath + ".names"):
+        stored[storage_name + ".names"] = storage_filepath + ".names"
+    columns = dict(stored, **{storage_name + ".cols": storage_filepath + ".cols"})
+    return {
+        "rebuild": stored,
+        "columns": columns,
+        "wal": dict(columns, **{"bets.wal": wal_filepath}),
+        "compacted": dict(columns, **{"bets.wal": compacted_filepath}),
+    }
+
+
+def time_to_first_accept(files: dict, backend: str, port: int, wal: bool) -> float:
+    datadir = tempfile.mkdtemp(prefix="bets-startup-")
+    try:
+        for name, source in files.items():
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(datadir, name))
+            else:
+                shutil.copy(source, os.path.join(datadir, name))
+        storage_name = "bets.log" if backend == "binary" else "bets.csv"
+        env = {
+            "STORAGE_BACKEND": backend,
+            "STORAGE_FILEPATH": os.path.join(datadir, storage_name),
+            "STORAGE_WAL_FILEPATH": os.path.join(datadir, "bets.wal") if wal else "",
+        }
+        start = time.perf_counter()
+        server, workdir = spawn_server(port, 1, env, timeout=600, poll_interval=0.002)
+        elapsed = time.perf_counter() - start
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+        return elapsed
+    finally:
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bets", type=int, default=2_000_000, help="stored bets")
+    parser.add_argument("--agencies", type=int, default=5, help="agencies the bets are spread over")
+    parser.add_argument("--backend", choices=("binary", "csv"), default="binary")
+    parser.add_argument("--port", type=int, default=12346)
+    parser.add_argument("--rounds", type=int, default=3, help="rounds, the best one is reported")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        cases = prepare(directory, args.backend, args.bets, args.agencies)
+        print(f"storage: {args.bets} bets, backend: {args.backend}, "
+              f"{os.path.getsize(cases['rebuild'][next(iter(cases['rebuild']))]) / 2**20:.0f} MiB")
+        for name, files in cases.items():
+            best = min(time_to_first_accept(files, args.backend, args.port, name in ("wal", "compacted"))
+                       for _ in range(args.rounds))
+            print(f"{name:<10} time to first accept: {best * 1000:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
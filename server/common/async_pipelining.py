@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from .pipelining import _FAILED, _wait_stored
+from .protocol import encode_batch_ack
+
+
+class AsyncBatchAcker:
+    """
+    `BatchAcker` for the asyncio engine, acking from a task of the connection
+    """
+    def __init__(self, writer, winners_index, max_in_flight: int):
+        self._writer = writer
+        self._winners_index = winners_index
+        self._queue = asyncio.Queue()
+        self._window = asyncio.Semaphore(max_in_flight)
+        self._broken = False
+        self._task = asyncio.create_task(self.__run())
+
+    async def submit(self, sequence_number: int, in_flight, cantidad: int) -> None:
+        await self._window.acquire()
+        self._queue.put_nowait((sequence_number, in_flight, cantidad))
+
+    async def submit_error(self, sequence_number: int) -> None:
+        await self.submit(sequence_number, _FAILED, 0)
+
+    async def drain(self) -> None:
+        await self._queue.join()
+
+    async def close(self) -> None:
+        await self.drain()
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def __run(self):
+        pending = None
+        unacked = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pending, unacked = await self.__flush(pending, unacked)
+                item = await self._queue.get()
+            if item is None:
+                await self.__flush(pending, unacked)
+                self._queue.task_done()
+                return
+
+            sequence_number, in_flight, cantidad = item
+            if in_flight not in (None, _FAILED) and not in_flight[1].done():
+                pending, unacked = await self.__flush(pending, unacked)
+                await asyncio.wait([in_flight[1]])
+
+            if _wait_stored(self._winners_index, in_flight, cantidad):
+                pending = sequence_number
+                unacked += 1
+            else:
+                await self.__flush(pending, unacked)
+                await self.__send(encode_batch_ack(False, sequence_number))
+                pending, unacked = await self.__flush(None, 1)
+
+    async def __flush(self, pending, unacked):
+        if pending is not None:
+            await self.__send(encode_batch_ack(True, pending))
+        for _ in range(unacked):
+            self._window.release()
+            self._queue.task_done()
+        return None, 0
+
+    async def __send(self, ack: bytes):
+        if self._broken:
+            return
+        try:
+            self._writer.write(ack)
+            await self._writer.drain()
+        except OSError as e:
+            logging.error(f"action: send_batch_ack | result: fail | error: {e}")
+            self._broken = True
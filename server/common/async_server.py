@@ -0,0 +1,371 @@
+import asyncio
+import socket
+import logging
+import signal
+import time
+from typing import Optional
+from .logs import log_batch_received
+from .lottery import Lottery
+from .async_pipelining import AsyncBatchAcker
+from .metrics import CONNECTED_CLIENTS, CONNECTIONS_REJECTED, WINNERS_QUERY_SECONDS
+from .winners import load_winners_index
+from .compression import choose_codec, COMPRESSION_NONE
+from .protocol import new_bet_batch_decoder, parse_client_id, parse_lookup, encode_response, encode_lookup_response, encode_busy_response, encode_compression_response, unpack_uint32_be, MESSAGE_TYPE_BATCH, MESSAGE_TYPE_FINISHED_SENDING, MESSAGE_TYPE_QUERY_WINNERS, MESSAGE_TYPE_QUERY_TIERED_WINNERS, MESSAGE_TYPE_SEQUENCED_BATCH, MESSAGE_TYPE_NEGOTIATE_COMPRESSION, MESSAGE_TYPE_QUERY_TALLIES, MESSAGE_TYPE_LOOKUP_BETS, MAX_CLIENT_ID_MESSAGE_SIZE, MAX_LOOKUP_MESSAGE_SIZE, MAX_LOOKUP_BETS, MAX_COMPRESSION_OFFER_SIZE, ProtocolError, MessageTooLargeError
+
+
+class AsyncServer:
+    """
+    Server engine that serves every client connection from one asyncio event loop
+
+    It speaks the same protocol and keeps the same lottery barrier as
+    `Server`, but each connection costs a coroutine instead of an OS thread.
+    Handlers await the storage writer futures instead of blocking on them.
+
+    Connections are cheap, so there is no accept queue and no limit unless
+    `max_clients` is given: a connection beyond it gets a busy response and
+    is closed right away. A client
+    that sends nothing for `idle_timeout` seconds is disconnected.
+    Sequenced batches are acked by an `AsyncBatchAcker` of the connection.
+    A connection may negotiate one of `compression_codecs` for its batches.
+    `on_ready` is called once the server accepts connections.
+    """
+    def __init__(self, port, listen_backlog, num_agencies, storage_writer, max_message_size, lottery=None, winners_index=None, reuse_port=False,
+                 max_clients=None, idle_timeout=None, max_in_flight_batches=32, on_ready=None, compression_codecs=()):
+        # Initialize server socket
+        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Let every worker process bind its own socket to the port
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._server_socket.bind(('', port))
+        self._server_socket.listen(listen_backlog)
+        self._listen_backlog = listen_backlog
+        self._max_message_size = max_message_size
+        self._max_clients = max_clients
+        self._idle_timeout = idle_timeout
+        self._max_in_flight_batches = max_in_flight_batches
+        self._on_ready = on_ready
+        self._compression_codecs = tuple(compression_codecs)
+
+        self._lottery = lottery or Lottery(num_agencies)
+        self._storage_writer = storage_writer
+        self._winners_index = winners_index or load_winners_index(storage_writer.storage)
+        self._lottery.add_draw_hook(self._winners_index.publish)
+
+        self._client_connections = {}
+        self._lottery_event = None
+        self._shutdown_event = None
+
+    def run(self):
+        """
+        Serve client connections until SIGTERM is received
+        """
+        try:
+            asyncio.run(self.__serve())
+        except KeyboardInterrupt:
+            logging.info("action: sigterm_received | result: success")
+
+    def _signal_handler(self):
+        logging.info("action: sigterm_received | result: success")
+        self._shutdown_event.set()
+
+    async def __serve(self):
+        loop = asyncio.get_running_loop()
+        self._lottery_event = asyncio.Event()
+        self._shutdown_event = asyncio.Event()
+        self._lottery.add_listener(lambda: loop.call_soon_threadsafe(self._lottery_event.set))
+        loop.add_signal_handler(signal.SIGTERM, self._signal_handler)
+
+        self._storage_writer.start()
+        server = await asyncio.start_server(
+            self.__handle_client_connection,
+            sock=self._server_socket,
+            backlog=self._listen_backlog,
+        )
+        logging.info('action: accept_connections | result: in_progress')
+        if self._on_ready:
+            self._on_ready()
+
+        await self._shutdown_event.wait()
+
+        self._lottery.cancel()
+        # Queries waiting for the draw answer an error before their connections are closed
+        self._lottery_event.set()
+        await asyncio.sleep(0)
+
+        logging.info("action: close_server_socket | result: success")
+        server.close()
+
+        for writer in list(self._client_connections):
+            writer.close()
+        await asyncio.gather(*self._client_connections.values(), return_exceptions=True)
+        await server.wait_closed()
+        self._storage_writer.stop()
+
+        logging.info("action: server_shutdown | result: success")
+
+    async def __handle_client_connection(self, reader, writer):
+        """
+        Handle multiple messages from a single client connection
+        Keep the connection open until client disconnects or an error occurs
+        """
+        client_addr = writer.get_extra_info('peername')
+        logging.info('action: accept_connections | result: success | ip: %s', client_addr[0])
+        if self._max_clients is not None and len(self._client_connections) >= self._max_clients:
+            CONNECTIONS_REJECTED.inc()
+            logging.warning("action: admit_connection | result: fail | error: server busy")
+            writer.write(encode_busy_response())
+            writer.close()
+            return
+
+        self._client_connections[writer] = asyncio.current_task()
+        CONNECTED_CLIENTS.inc()
+        acker = None
+        agencies = set()
+        sequence_number = None
+        compression = COMPRESSION_NONE
+        try:
+            while True:
+                msg_type = await self.__receive_uint32(reader)
+                if msg_type is None:
+                    logging.debug("action: client_disconnected | result: success | ip: %s", client_addr[0])
+                    break
+
+                if msg_type == MESSAGE_TYPE_SEQUENCED_BATCH:
+                    if acker is None:
+                        acker = AsyncBatchAcker(writer, self._winners_index, self._max_in_flight_batches)
+                    sequence_number = await self.__receive_uint32(reader)
+                    if sequence_number is None:
+                        break
+                    await self.__handle_bet_batch(reader, acker, sequence_number, compression, agencies)
+                    sequence_number = None
+                    continue
+
+                if acker is not None:
+                    # Replies to other messages go after the acks of the batches sent before them
+                    await acker.drain()
+
+                if msg_type == MESSAGE_TYPE_BATCH:
+                    response = await self.__handle_bet_batch(reader, compression=compression)
+                elif msg_type == MESSAGE_TYPE_NEGOTIATE_COMPRESSION:
+                    message_data = await self.__receive_message_data(reader, MAX_COMPRESSION_OFFER_SIZE)
+                    if message_data is None:
+                        logging.error(f"action: receive_message | result: fail | message_type: {msg_type} | error: failed to receive data")
+                        break
+                    compression = choose_codec(message_data, self._compression_codecs)
+                    logging.debug("action: negotiate_compression | result: success | codec: %s", compression)
+                    response = encode_compression_response(compression)
+                elif msg_type == MESSAGE_TYPE_LOOKUP_BETS:
+                    message_data = await self.__receive_message_data(reader, MAX_LOOKUP_MESSAGE_SIZE)
+                    if message_data is None:
+                        logging.error(f"action: receive_message | result: fail | message_type: {msg_type} | error: failed to receive data")
+                        break
+                    response = await self.__handle_lookup_bets(message_data)
+                elif msg_type in (MESSAGE_TYPE_FINISHED_SENDING, MESSAGE_TYPE_QUERY_WINNERS, MESSAGE_TYPE_QUERY_TIERED_WINNERS,
+                                  MESSAGE_TYPE_QUERY_TALLIES):
+                    message_data = await self.__receive_message_data(reader, MAX_CLIENT_ID_MESSAGE_SIZE)
+                    if message_data is None:
+                        logging.error(f"action: receive_message | result: fail | message_type: {msg_type} | error: failed to receive data")
+                        break
+                    if msg_type == MESSAGE_TYPE_FINISHED_SENDING:
+                        response = await self.__handle_finished_notification(message_data)
+                    elif msg_type == MESSAGE_TYPE_QUERY_TALLIES:
+                        response = await self.__handle_query_tallies(message_data)
+                    else:
+                        response = await self.__handle_query_winners(message_data, msg_type == MESSAGE_TYPE_QUERY_TIERED_WINNERS)
+                else:
+                    logging.error(f"action: handle_client_connection | result: fail | error: unknown message type: {msg_type}")
+                    writer.write(encode_response(False))
+                    await writer.drain()
+                    break
+
+                writer.write(response)
+                await writer.drain()
+
+        except MessageTooLargeError as e:
+            logging.error(f"action: receive_bet_batch | result: fail | error: {e}")
+            if sequence_number is None:
+                writer.write(encode_response(False))
+                await writer.drain()
+            else:
+                await acker.submit_error(sequence_number)
+        except asyncio.TimeoutError:
+            logging.info(f"action: client_idle_timeout | result: success | ip: {client_addr[0]}")
+        except Exception as e:
+            logging.error(f"action: handle_client_connection | result: fail | error: {e}")
+        finally:
+            if acker is not None:
+                await acker.close()
+            for agency in agencies:
+                self._lottery.release_agency(agency)
+            CONNECTED_CLIENTS.dec()
+            logging.info("action: close_client_socket | result: success")
+            self._client_connections.pop(writer, None)
+            writer.close()
+
+    async def __handle_bet_batch(self, reader, acker=None, sequence_number=None, compression=COMPRESSION_NONE,
+                                 agencies=None) -> Optional[bytes]:
+        """
+        Read batch bet data from client and store it without blocking the event loop
+
+        Same atomic storage as `Server`: the batch is handed to the storage
+        writer once its last bet is decoded. A sequenced batch is answered
+        by `acker` instead, and None is returned. Its agency is acquired
+        from the lottery, off the event loop, as `Server` does.
+        """
+        cantidad = 0
+        try:
+            batch = None
+            async for chunk in self.__receive_bet_batch_stream(reader, compression):
+                if batch is None:
+                    batch = chunk
+                else:
+                    batch.extend(chunk)
+                cantidad += len(chunk)
+            in_flight = None
+            if cantidad:
+                if sequence_number is not None and batch.agency not in agencies:
+                    await asyncio.get_running_loop().run_in_executor(None, self._lottery.acquire_agency, batch.agency)
+                    agencies.add(batch.agency)
+                in_flight = batch, asyncio.wrap_future(self._storage_writer.submit(batch, sequence_number))
+            if acker is None and in_flight is not None:
+                await self.__wait_stored(*in_flight)
+
+        except (MessageTooLargeError, OSError, asyncio.TimeoutError):
+            # The connection cannot be answered or must be closed
+            raise
+        except ProtocolError as e:
+            logging.error(f"action: receive_bet_batch | result: fail | error: {e}")
+            logging.info('action: apuesta_recibida | result: fail | cantidad: %d', cantidad)
+            return await self.__reject_bet_batch(acker, sequence_number)
+        except Exception as e:
+            logging.error(f"action: receive_message | result: fail | error: {e}")
+            logging.info('action: apuesta_recibida | result: fail | cantidad: %d', cantidad)
+            return await self.__reject_bet_batch(acker, sequence_number)
+
+        if acker is not None:
+            await acker.submit(sequence_number, in_flight, cantidad)
+            return None
+
+        log_batch_received(cantidad)
+        return encode_response(True)
+
+    async def __reject_bet_batch(self, acker, sequence_number) -> Optional[bytes]:
+        if acker is None:
+            return encode_response(False)
+        await acker.submit_error(sequence_number)
+        return None
+
+    async def __wait_stored(self, batch, future):
+        if await future:
+            self._winners_index.add_batch(batch)
+
+    async def __receive_bet_batch_stream(self, reader, compression):
+        """
+        Receive a batch message yielding its bets in chunks as they arrive,
+        as `protocol.receive_bet_batch_stream` does for blocking sockets
+        """
+        message_length = await self.__receive_uint32(reader)
+        if message_length is None:
+            raise ConnectionError("failed to receive message length")
+        if message_length > self._max_message_size:
+            raise MessageTooLargeError(f"message length {message_length} exceeds maximum {self._max_message_size}")
+
+        decoder = new_bet_batch_decoder(message_length, compression, self._max_message_size)
+        try:
+            while not decoder.done:
+                for chunk in decoder.feed(await self.__read_into(reader, decoder.writable_view())):
+                    yield chunk
+            yield decoder.finish()
+        except ProtocolError:
+            decoder.skip_rest()
+            while not decoder.done:
+                decoder.feed(await self.__read_into(reader, decoder.writable_view()))
+            raise
+
+    async def __read_into(self, reader, view) -> int:
+        data = await asyncio.wait_for(reader.read(len(view)), self._idle_timeout)
+        if not data:
+            raise ConnectionError("connection closed in the middle of a batch")
+        view[:len(data)] = data
+        return len(data)
+
+    async def __handle_finished_notification(self, message_data: bytes) -> bytes:
+        client_id = parse_client_id(message_data, "receive_finished_notification")
+        if client_id is None:
+            return encode_response(False)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._storage_writer.record_finished, client_id)
+        # The last agency runs the draw hooks, or the worker sends it to the coordinator, off the event loop
+        await loop.run_in_executor(None, self._lottery.mark_finished, client_id)
+        return encode_response(True)
+
+    async def __handle_query_winners(self, message_data: bytes, tiered: bool) -> bytes:
+        client_id = parse_client_id(message_data, "receive_query_winners")
+        if client_id is None:
+            return encode_response(False)
+
+        await self._lottery_event.wait()
+        if not self._lottery.done:
+            return encode_response(False)
+
+        # Published by the winners index at the draw, answered as is
+        start = time.perf_counter()
+        response = self._winners_index.winners_response(client_id, tiered)
+        WINNERS_QUERY_SECONDS.observe(time.perf_counter() - start)
+        logging.debug("action: get_winners_for_agency | result: success | agency_id: %s", client_id)
+        return response
+
+    async def __handle_query_tallies(self, message_data: bytes) -> bytes:
+        client_id = parse_client_id(message_data, "receive_query_tallies")
+        if client_id is None:
+            return encode_response(False)
+
+        # Kept up to date by the winners index, neither the draw nor the storage are waited for,
+        # but with several workers the lottery gathers them from every worker, off the event loop
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, self._lottery.tallies_response, self._winners_index)
+        except Exception as e:
+            logging.error(f"action: handle_query_tallies | result: fail | error: {e}")
+            return encode_response(False)
+        logging.debug("action: send_tallies | result: success | agency_id: %s", client_id)
+        return response
+
+    async def __handle_lookup_bets(self, message_data: bytes) -> bytes:
+        lookup = parse_lookup(message_data)
+        if lookup is None:
+            return encode_response(False)
+
+        # Bets are read from the storage files, or gathered from every worker, off the event loop
+        field, value = lookup
+        try:
+            total, bets = await asyncio.get_running_loop().run_in_executor(
+                None, self._lottery.find_bets, self._storage_writer.storage, field, value, MAX_LOOKUP_BETS)
+        except Exception as e:
+            logging.error(f"action: handle_lookup_bets | result: fail | error: {e}")
+            return encode_response(False)
+        logging.debug("action: lookup_bets | result: success | field: %s | value: %s | cantidad: %s", field, value, total)
+        return encode_lookup_response(total, bets)
+
+    async def __receive_uint32(self, reader) -> Optional[int]:
+        try:
+            return unpack_uint32_be(await asyncio.wait_for(reader.readexactly(4), self._idle_timeout))
+        except asyncio.IncompleteReadError:
+            return None
+
+    async def __receive_message_data(self, reader, max_length: int) -> Optional[bytes]:
+        """
+        Receive the payload of a message
+
+        Protocol: total_message_length(4), then total_message_length bytes
+        A payload longer than max_length is not received.
+        """
+        message_length = await self.__receive_uint32(reader)
+        if message_length is None or message_length > max_length:
+            return None
+        try:
+            return await asyncio.wait_for(reader.readexactly(message_length), self._idle_timeout)
+        except asyncio.IncompleteReadError:
+            return None
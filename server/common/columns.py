@@ -0,0 +1,413 @@
+import logging
+import os
+import shutil
+import struct
+import sys
+import threading
+from array import array
+from collections import Counter
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+from .utils import BetBatch
+
+
+_NATIVE_BIG_ENDIAN = sys.byteorder == 'big'
+
+""" Bets per chunk of columns scanned from a storage. """
+DEFAULT_CHUNK_BETS = 65536
+
+
+class ColumnCache:
+    """
+    Fixed-width agency, document and number columns of the bets of a storage
+
+    Kept next to the storage as the `<filepath>` directory of segments,
+    `<first bet>.seg` files of one big-endian agency(4), document(4),
+    number(4) row per bet followed by a footer: the bytes of the storage
+    the segment covers (0 if unknown), its first bet and its number of
+    bets, its min and max agency, its bets per agency, and a bloom filter
+    of its numbers. Scanning it needs neither decoding names nor walking
+    variable-length records, so every stored bet can be matched in bulk,
+    and segments whose footer rules out every number looked for are
+    skipped.
+
+    Each flush writes the appended rows as a new segment, without a bloom
+    filter. A background compactor merges runs of consecutive segments
+    without one into segments of at least `SEGMENT_BETS` bets with one, so
+    small batches do not leave the scans with many small segments, and
+    flushes never wait for it.
+
+    It is only a cache of the storage: bets the storage got past the
+    covered size are caught up by walking the storage when the cache is
+    opened, and segments past a truncated storage are dropped.
+    Not thread-safe/process-safe.
+    """
+    MAGIC = b'BETSEG\x00\x01'
+    ROW_SIZE = 12
+    FOOTER = struct.Struct('>QQIIII')
+    AGENCY_COUNT = struct.Struct('>II')
+    TRAILER = struct.Struct('>I8s')
+    """ Bets of a full segment, at least, which the compactor merges smaller ones into. """
+    SEGMENT_BETS = 8192
+    """ Consecutive tiny segments merged even if they do not add up to a full one. """
+    COMPACT_SEGMENTS = 8
+    """ Bits of the bloom filter of a segment per bet, and bits set per number. """
+    BLOOM_BITS_PER_BET = 8
+    BLOOM_HASHES = 3
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._condition = threading.Condition()
+        self._compactor = None
+        self._stopping = False
+        self._segments = []
+        self._covered = 0
+        self._bets = 0
+        self._pending = new_columns()
+        self._scans = 0
+        self._obsolete = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._compactor is not None
+
+    def open(self, storage_size: int, walk_columns: Callable[[int], Iterator[Tuple[array, array, array]]]) -> None:
+        """
+        Open the cache for appends, catching up with the first storage_size
+        bytes of the storage through walk_columns(offset), which yields the
+        columns of the bets stored from offset on
+        """
+        if self._compactor is not None:
+            return
+        os.makedirs(self.filepath, exist_ok=True)
+        self._segments = self.__load_segments(storage_size)
+        self._covered = self._segments[-1].covered if self._segments else 0
+        self._bets = sum(segment.bets for segment in self._segments)
+
+        if self._covered < storage_size:
+            caught_up = 0
+            columns = new_columns()
+            for chunk in walk_columns(self._covered):
+                for column, values in zip(columns, chunk):
+                    column.extend(values)
+                while len(columns[2]) > self.SEGMENT_BETS:
+                    self.__add_segment([column[:self.SEGMENT_BETS] for column in columns], 0, bloom=True)
+                    columns = [column[self.SEGMENT_BETS:] for column in columns]
+                caught_up += len(chunk[2])
+            if columns[2]:
+                self.__add_segment(columns, storage_size, bloom=True)
+            logging.debug(f"action: catch_up_columns | result: success | bets: {caught_up}")
+
+        self._stopping = False
+        self._compactor = threading.Thread(target=self.__compact, name="columns-compactor", daemon=True)
+        self._compactor.start()
+
+    def append(self, batch: BetBatch) -> None:
+        """
+        Append the columns of a batch, written by the next `flush`
+        """
+        self._pending[0].extend(array('I', [batch.agency]) * len(batch))
+        self._pending[1].extend(batch.documents)
+        self._pending[2].extend(batch.numbers)
+
+    def flush(self, storage_size: int, sync: bool) -> None:
+        """
+        Write the appended rows as a segment covering storage_size bytes
+        """
+        if self._compactor is None or not self._pending[2]:
+            return
+        columns, self._pending = self._pending, new_columns()
+        self.__add_segment(columns, storage_size, bloom=False, sync=sync)
+
+    def close(self) -> None:
+        if self._compactor is not None:
+            with self._condition:
+                self._stopping = True
+                self._condition.notify_all()
+            self._compactor.join()
+            self._compactor = None
+        self._segments = []
+        self._pending = new_columns()
+
+    def drop(self) -> None:
+        """
+        Remove the cache, so it is rebuilt from the storage on the next open
+        """
+        self.close()
+        if os.path.isdir(self.filepath):
+            shutil.rmtree(self.filepath)
+        elif os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def bet_counts(self) -> dict:
+        """
+        Return the number of cached bets per agency, from the segment footers
+        """
+        with self._condition:
+            segments = list(self._segments)
+        counts = Counter()
+        for segment in segments:
+            counts.update(segment.counts)
+        return dict(counts)
+
+    def scan(self, chunk_bets: int, numbers_of: Optional[Callable[[Iterable[int]], Iterable[int]]] = None
+             ) -> Iterator[Tuple[array, array, array]]:
+        """
+        Yield the agency, document and number columns of the cached bets,
+        in chunks of up to about chunk_bets bets. If numbers_of is given,
+        segments that cannot hold any of the numbers numbers_of(agencies)
+        returns for their agencies are skipped
+        """
+        if self._compactor is None:
+            return
+        with self._condition:
+            segments = list(self._segments)
+            self._scans += 1
+        try:
+            columns = new_columns()
+            for segment in segments:
+                if numbers_of is not None and not segment.may_contain(numbers_of(segment.counts)):
+                    continue
+                for column, values in zip(columns, segment.read()):
+                    column.extend(values)
+                if len(columns[2]) >= chunk_bets:
+                    yield columns
+                    columns = new_columns()
+            if columns[2]:
+                yield columns
+        finally:
+            with self._condition:
+                self._scans -= 1
+                if not self._scans:
+                    self.__remove_obsolete()
+
+    @classmethod
+    def encode_rows(cls, agencies: array, documents: array, numbers: array) -> bytes:
+        rows = array('I', bytes(len(numbers) * cls.ROW_SIZE))
+        rows[0::3] = agencies
+        rows[1::3] = documents
+        rows[2::3] = numbers
+        if not _NATIVE_BIG_ENDIAN:
+            rows.byteswap()
+        return rows.tobytes()
+
+    def __add_segment(self, columns, covered: int, bloom: bool, sync: bool = False) -> None:
+        segment = self.__write_segment(self._bets, columns, covered, bloom, sync)
+        with self._condition:
+            self._segments.append(segment)
+            self._covered = covered or self._covered
+            self._bets += segment.bets
+            self._condition.notify_all()
+
+    def __write_segment(self, first: int, columns, covered: int, bloom: bool, sync: bool = False) -> '_Segment':
+        agencies, documents, numbers = columns
+        counts = Counter(agencies)
+        bloom_filter = _bloom_filter(numbers, self.BLOOM_BITS_PER_BET, self.BLOOM_HASHES) if bloom else b''
+        footer = (self.FOOTER.pack(covered, first, len(numbers), min(counts, default=0), max(counts, default=0), len(counts))
+                  + b''.join(self.AGENCY_COUNT.pack(agency, count) for agency, count in sorted(counts.items()))
+                  + struct.pack('>I', len(bloom_filter)) + bloom_filter)
+        filepath = os.path.join(self.filepath, f"{first:016d}.seg")
+        with open(filepath + ".tmp", 'wb') as file:
+            file.write(self.encode_rows(agencies, documents, numbers))
+            file.write(footer)
+            file.write(self.TRAILER.pack(len(footer), self.MAGIC))
+            file.flush()
+            if sync:
+                os.fsync(file.fileno())
+        os.replace(filepath + ".tmp", filepath)
+        bloom_offset = len(numbers) * self.ROW_SIZE + len(footer) - len(bloom_filter)
+        return _Segment(filepath, first, len(numbers), covered, dict(counts), bloom_offset, len(bloom_filter))
+
+    def __compact(self):
+        while True:
+            with self._condition:
+                compactable = self.__compactable()
+                while not self._stopping and compactable is None:
+                    self._condition.wait()
+                    compactable = self.__compactable()
+                if self._stopping:
+                    return
+                run, bloom = compactable
+
+            try:
+                compacted = self.__rewrite(run, bloom)
+            except OSError as e:
+                # Scans keep reading the segments that were not compacted
+                logging.error(f"action: compact_columns | result: fail | error: {e}")
+                return
+            with self._condition:
+                start = self._segments.index(run[0])
+                self._segments[start:start + len(run)] = [compacted]
+                self._obsolete.extend(segment.filepath for segment in run[1:])
+                if not self._scans:
+                    self.__remove_obsolete()
+            logging.debug(f"action: compact_columns | result: success | segments: {len(run)} | bets: {compacted.bets}")
+
+    def __compactable(self) -> Optional[Tuple[list, bool]]:
+        """
+        Return the first run of consecutive segments worth rewriting, if
+        any, and whether to rewrite it with a bloom filter: the shortest one
+        adding up to `SEGMENT_BETS` bets, or `COMPACT_SEGMENTS` tiny ones,
+        merged without a bloom filter until they add up to a full segment
+        """
+        tiny_bets = self.SEGMENT_BETS // self.COMPACT_SEGMENTS
+        run, tiny = [], []
+        for segment in self._segments:
+            if segment.bets >= self.SEGMENT_BETS and segment.bloom_size:
+                run, tiny = [], []
+                continue
+            run.append(segment)
+            if sum(small.bets for small in run) >= self.SEGMENT_BETS:
+                return run, True
+            tiny = tiny + [segment] if segment.bets < tiny_bets else []
+            if len(tiny) >= self.COMPACT_SEGMENTS:
+                return tiny, False
+        return None
+
+    def __rewrite(self, run: list, bloom: bool) -> '_Segment':
+        columns = new_columns()
+        for segment in run:
+            for column, values in zip(columns, segment.read()):
+                column.extend(values)
+        # Replaces the segment the run starts with, whose rows it begins with
+        return self.__write_segment(run[0].first, columns, run[-1].covered, bloom)
+
+    def __load_segments(self, storage_size: int) -> list:
+        """
+        Return the chain of consecutive segments of the directory from the
+        first bet on, up to the last one known to cover at most storage_size
+        bytes, removing the rest: past a truncated storage, or left by an
+        interrupted compaction
+        """
+        segments = {}
+        for name in os.listdir(self.filepath):
+            filepath = os.path.join(self.filepath, name)
+            segment = _Segment.load(filepath) if name.endswith(".seg") else None
+            if segment is None:
+                os.remove(filepath)
+                continue
+            segments[segment.first] = segment
+
+        chain = []
+        first = 0
+        while first in segments:
+            chain.append(segments.pop(first))
+            first += chain[-1].bets
+        while chain and (chain[-1].covered == 0 or chain[-1].covered > storage_size):
+            segments[chain[-1].first] = chain.pop()
+        for segment in segments.values():
+            os.remove(segment.filepath)
+        return chain
+
+    def __remove_obsolete(self) -> None:
+        for filepath in self._obsolete:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        self._obsolete = []
+
+
+class _Segment:
+    """ Segment of a `ColumnCache`, as described by its footer. """
+    def __init__(self, filepath: str, first: int, bets: int, covered: int, counts: dict,
+                 bloom_offset: int, bloom_size: int):
+        self.filepath = filepath
+        self.first = first
+        self.bets = bets
+        self.covered = covered
+        self.counts = counts
+        self.bloom_offset = bloom_offset
+        self.bloom_size = bloom_size
+
+    @classmethod
+    def load(cls, filepath: str) -> Optional['_Segment']:
+        """
+        Read the footer of a segment file, None if it is not a complete segment
+        """
+        trailer = ColumnCache.TRAILER
+        with open(filepath, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < trailer.size:
+                return None
+            file.seek(size - trailer.size)
+            footer_size, magic = trailer.unpack(file.read(trailer.size))
+            if magic != ColumnCache.MAGIC or not ColumnCache.FOOTER.size + 4 <= footer_size <= size - trailer.size:
+                return None
+            footer_offset = size - trailer.size - footer_size
+            file.seek(footer_offset)
+            footer = file.read(footer_size)
+        covered, first, bets, _, _, agencies = ColumnCache.FOOTER.unpack_from(footer)
+        offset = ColumnCache.FOOTER.size + agencies * ColumnCache.AGENCY_COUNT.size
+        if bets * ColumnCache.ROW_SIZE != footer_offset or offset + 4 > footer_size:
+            return None
+        counts = dict(ColumnCache.AGENCY_COUNT.iter_unpack(footer[ColumnCache.FOOTER.size:offset]))
+        bloom_size, = struct.unpack_from('>I', footer, offset)
+        return cls(filepath, first, bets, covered, counts, footer_offset + offset + 4, bloom_size)
+
+    def may_contain(self, numbers: Iterable[int]) -> bool:
+        """
+        Tell whether the segment may hold one of the numbers, by its bloom filter
+        """
+        if not self.bloom_size:
+            return True
+        # Read on every scan rather than kept, as it takes a byte per bet
+        with open(self.filepath, 'rb') as file:
+            file.seek(self.bloom_offset)
+            bloom = file.read(self.bloom_size)
+        return any(_bloom_may_contain(bloom, number, ColumnCache.BLOOM_HASHES) for number in numbers)
+
+    def read(self) -> Tuple[array, array, array]:
+        """
+        Return the columns of the segment, the prefix of the file a
+        compaction may have replaced it with
+        """
+        rows = array('I')
+        with open(self.filepath, 'rb') as file:
+            rows.frombytes(file.read(self.bets * ColumnCache.ROW_SIZE))
+        if not _NATIVE_BIG_ENDIAN:
+            rows.byteswap()
+        return rows[0::3], rows[1::3], rows[2::3]
+
+
+""" Bits set by each number in bloom filters of a given size, bounded to as many numbers. """
+_BLOOM_BITS = {}
+_BLOOM_BITS_NUMBERS = 1 << 16
+
+
+def _bloom_bits(number: int, bits: int, hashes: int) -> Tuple[Tuple[int, int], ...]:
+    """
+    Return the (byte, mask) of the bits a number sets in a bloom filter of
+    the given bits, cached since the same numbers recur in every segment
+    """
+    table = _BLOOM_BITS.setdefault((bits, hashes), {})
+    cached = table.get(number)
+    if cached is None:
+        if len(table) >= _BLOOM_BITS_NUMBERS:
+            table.clear()
+        # Double hashing over a 64-bit multiplicative hash of the number
+        digest = (number * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        first, step = digest >> 32, digest & 0xFFFFFFFF | 1
+        positions = ((first + i * step) % bits for i in range(hashes))
+        cached = table[number] = tuple((position >> 3, 1 << (position & 7)) for position in positions)
+    return cached
+
+
+def _bloom_filter(numbers: array, bits_per_number: int, hashes: int) -> bytes:
+    """
+    Return the bits of a bloom filter of the numbers, a power of two of them
+    """
+    bits = 64
+    while bits < len(numbers) * bits_per_number:
+        bits *= 2
+    bloom = bytearray(bits // 8)
+    table = _BLOOM_BITS.setdefault((bits, hashes), {})
+    for number in set(numbers):
+        for byte, mask in table.get(number) or _bloom_bits(number, bits, hashes):
+            bloom[byte] |= mask
+    return bytes(bloom)
+
+
+def _bloom_may_contain(bloom: bytes, number: int, hashes: int) -> bool:
+    return all(bloom[byte] & mask for byte, mask in _bloom_bits(number, len(bloom) * 8, hashes))
+
+
+def new_columns() -> Tuple[array, array, array]:
+    return array('I'), array('I'), array('I')
@@ -0,0 +1,117 @@
+import zlib
+from typing import Iterable
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZ4 = 2
+
+""" Codec ids by the names used in the configuration. """
+COMPRESSION_CODECS = {"zlib": COMPRESSION_ZLIB, "lz4": COMPRESSION_LZ4}
+""" zlib level of `compress`, fast enough for agencies to compress every batch. """
+DEFAULT_ZLIB_LEVEL = 6
+
+
+def available_codecs() -> list[int]:
+    """
+    Return the codecs this process can decompress, LZ4 needs the optional `lz4` package
+    """
+    codecs = [COMPRESSION_ZLIB]
+    if lz4 is not None:
+        codecs.append(COMPRESSION_LZ4)
+    return codecs
+
+
+def parse_compression_codecs(text: str) -> tuple:
+    """
+    Parse a comma separated list of the names of the codecs to accept
+    """
+    codecs = []
+    for name in filter(None, (name.strip() for name in text.split(','))):
+        if name not in COMPRESSION_CODECS:
+            raise ValueError(f"unknown compression codec: {name}")
+        if COMPRESSION_CODECS[name] not in available_codecs():
+            raise ValueError(f"compression codec {name} needs the {name} package")
+        codecs.append(COMPRESSION_CODECS[name])
+    return tuple(codecs)
+
+
+def choose_codec(offered: Iterable[int], accepted: Iterable[int]) -> int:
+    """
+    Return the first codec offered by the client that the server accepts,
+    or COMPRESSION_NONE if there is none
+    """
+    accepted = set(accepted)
+    return next((codec for codec in offered if codec in accepted), COMPRESSION_NONE)
+
+
+def compress(codec: int, data: bytes, level: int = DEFAULT_ZLIB_LEVEL) -> bytes:
+    """
+    Compress data as a single block of the given codec, as clients do
+    """
+    if codec == COMPRESSION_ZLIB:
+        return zlib.compress(data, level)
+    if codec == COMPRESSION_LZ4 and lz4 is not None:
+        return lz4.frame.compress(data)
+    raise ValueError(f"unsupported compression codec: {codec}")
+
+
+def new_decompressor(codec: int):
+    """
+    Return an incremental decompressor of the given codec
+
+    Decompressors share the interface `decompress(data, max_length)`,
+    which keeps the input it could not decompress within max_length,
+    `pending`, whether calling it again with no data yields more output,
+    and `eof`, whether the end of the compressed stream was reached.
+    """
+    if codec == COMPRESSION_ZLIB:
+        return _ZlibDecompressor()
+    if codec == COMPRESSION_LZ4 and lz4 is not None:
+        return _Lz4Decompressor()
+    raise ValueError(f"unsupported compression codec: {codec}")
+
+
+class _ZlibDecompressor:
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+        self._tail = b''
+        self._full = False
+
+    def decompress(self, data, max_length: int) -> bytes:
+        if self._tail:
+            data = self._tail + bytes(data)
+        output = self._decompressor.decompress(data, max_length)
+        self._tail = self._decompressor.unconsumed_tail
+        # Output may be left inside zlib even with no input left
+        self._full = len(output) == max_length
+        return output
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._tail) or (self._full and not self._decompressor.eof)
+
+    @property
+    def eof(self) -> bool:
+        return self._decompressor.eof
+
+
+class _Lz4Decompressor:
+    def __init__(self):
+        self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data, max_length: int) -> bytes:
+        return self._decompressor.decompress(bytes(data), max_length)
+
+    @property
+    def pending(self) -> bool:
+        return not self._decompressor.needs_input and not self._decompressor.eof
+
+    @property
+    def eof(self) -> bool:
+        return self._decompressor.eof
@@ -0,0 +1,188 @@
+import hashlib
+import logging
+import time
+from array import array
+from typing import Iterable, Iterator, Optional, Tuple
+from .columns import DEFAULT_CHUNK_BETS
+from .utils import LOTTERY_WINNER_NUMBER
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+""" Prize tier of the bets that match `LOTTERY_WINNER_NUMBER` when no draw rules are configured. """
+DEFAULT_TIER = 1
+""" Above this many winning numbers, the column is matched number by number instead of searched per winning number. """
+_BYTES_SEARCH_MAX_NUMBERS = 32
+
+
+class DrawRule:
+    """
+    Prize tier awarded to the bets with one of the given numbers, of any
+    agency or only of the given agencies
+    """
+    __slots__ = ('tier', 'numbers', 'agencies')
+
+    def __init__(self, tier: int, numbers: Iterable[int], agencies: Optional[Iterable[int]] = None):
+        if tier < 1:
+            raise ValueError(f"invalid prize tier: {tier}")
+        self.tier = tier
+        self.numbers = frozenset(numbers)
+        self.agencies = None if agencies is None else frozenset(agencies)
+
+
+def parse_draw_rules(text: str) -> list[DrawRule]:
+    """
+    Parse draw rules written as `tier:numbers[@agencies]` separated by `;`
+
+    Numbers and agencies are comma separated, and numbers may be given as
+    `first-last` ranges, e.g. `1:7574;2:7500-7599;3:1234@1,2`.
+    """
+    rules = []
+    for rule in filter(None, (rule.strip() for rule in text.split(';'))):
+        tier, _, targets = rule.partition(':')
+        numbers, _, agencies = targets.partition('@')
+        parsed_numbers = set()
+        for number in numbers.split(','):
+            first, _, last = number.strip().partition('-')
+            parsed_numbers.update(range(int(first), int(last or first) + 1))
+        parsed_agencies = [int(agency) for agency in agencies.split(',')] if agencies else None
+        rules.append(DrawRule(int(tier), parsed_numbers, parsed_agencies))
+    if not rules:
+        raise ValueError("no draw rules")
+    return rules
+
+
+class DrawEngine:
+    """
+    Draw rules compiled once into a lookup from winning number to prize tier
+
+    Agencies with rules of their own get a lookup that merges them with the
+    general rules, the other agencies share the lookup of the general rules.
+    When several rules award the same number, the lowest tier wins.
+    Classifying a bet is then a single hashed lookup, whatever the number
+    of rules, and a stored column is matched once against the union of
+    every winning number.
+    """
+    def __init__(self, rules: Iterable[DrawRule]):
+        self._general = {}
+        by_agency = {}
+        for rule in rules:
+            lookups = [self._general] if rule.agencies is None else [by_agency.setdefault(agency, {}) for agency in rule.agencies]
+            for lookup in lookups:
+                _award(lookup, rule.numbers, rule.tier)
+
+        self._lookups = {}
+        for agency, lookup in by_agency.items():
+            merged = dict(self._general)
+            for number, tier in lookup.items():
+                _award(merged, (number,), tier)
+            self._lookups[agency] = merged
+        self.winning_numbers = frozenset(self._general).union(*self._lookups.values())
+        self._general_numbers = frozenset(self._general)
+        compiled = (sorted(self._general.items()), sorted((agency, sorted(lookup.items())) for agency, lookup in self._lookups.items()))
+        # Digest of the compiled lookups, which differs for rules that classify any bet differently
+        self.fingerprint = int.from_bytes(hashlib.blake2b(repr(compiled).encode(), digest_size=8).digest(), 'big')
+
+    def winning_numbers_of(self, agencies: Iterable[int]) -> frozenset:
+        """
+        Return the numbers that win for any of the given agencies
+        """
+        lookups = [self._lookups[agency] for agency in agencies if agency in self._lookups]
+        return self._general_numbers.union(*lookups) if lookups else self._general_numbers
+
+    def tier(self, agency: int, number: int) -> int:
+        """
+        Return the prize tier of a bet, or 0 if it did not win
+        """
+        return self._lookups.get(agency, self._general).get(number, 0)
+
+    def batch_winners(self, batch) -> list[Tuple[int, int]]:
+        """
+        Return the (document, tier) of the winning bets of a batch
+        """
+        lookup = self._lookups.get(batch.agency, self._general)
+        documents = batch.documents
+        return [(documents[i], lookup[number]) for i, number in enumerate(batch.numbers) if number in lookup]
+
+    def classify_columns(self, agencies: array, documents: array, numbers: array) -> Iterator[Tuple[int, int, int]]:
+        """
+        Yield the (agency, document, tier) of the winning bets of a chunk of columns
+        """
+        for index in matching_indexes(numbers, self.winning_numbers):
+            agency = agencies[index]
+            tier = self.tier(agency, numbers[index])
+            if tier:
+                yield agency, documents[index], tier
+
+
+def _award(lookup: dict, numbers: Iterable[int], tier: int) -> None:
+    for number in numbers:
+        if tier < lookup.get(number, tier + 1):
+            lookup[number] = tier
+
+
+""" Engine of the single winning number of the original draw. """
+DEFAULT_DRAW_ENGINE = DrawEngine([DrawRule(DEFAULT_TIER, [LOTTERY_WINNER_NUMBER])])
+
+
+def matching_indexes(numbers: array, winning_numbers: Iterable[int]) -> list[int]:
+    """
+    Return the positions of the numbers column that hold a winning number
+
+    The column is compared as a whole: with `numpy.isin` when NumPy is
+    installed, or otherwise by searching the raw bytes of the column for
+    each of a few winning numbers, keeping only matches aligned to a bet.
+    """
+    if numpy is not None:
+        column = numpy.frombuffer(numbers, dtype=numpy.uint32)
+        return numpy.flatnonzero(numpy.isin(column, numpy.fromiter(winning_numbers, dtype=numpy.uint32))).tolist()
+    if len(winning_numbers) > _BYTES_SEARCH_MAX_NUMBERS:
+        return [i for i, number in enumerate(numbers) if number in winning_numbers]
+
+    data = numbers.tobytes()
+    itemsize = numbers.itemsize
+    indexes = []
+    for winning_number in winning_numbers:
+        pattern = array(numbers.typecode, [winning_number]).tobytes()
+        position = data.find(pattern)
+        while position != -1:
+            if position % itemsize:
+                position = data.find(pattern, position + 1)
+                continue
+            indexes.append(position // itemsize)
+            position = data.find(pattern, position + itemsize)
+    indexes.sort()
+    return indexes
+
+
+def compute_winners(storage, engine: DrawEngine = DEFAULT_DRAW_ENGINE, chunk_bets: int = DEFAULT_CHUNK_BETS,
+                    bets: Optional[dict] = None) -> dict:
+    """
+    Return the (document, tier) of the winning bets per agency id of every stored bet
+
+    The storage is scanned once as agency, document and number columns,
+    from its column cache, without building a `Bet` per row, and each
+    chunk is classified by the engine in a single pass over its numbers column.
+    Segments of the cache whose bloom filter rules out every number that
+    wins for their agencies are not read at all.
+    If bets is given, the number of stored bets per agency id is added to it,
+    from the footers of the segments.
+    """
+    winners = {}
+    if not storage.exists():
+        return winners
+
+    start = time.perf_counter()
+    scanned = 0
+    for agencies, documents, numbers in storage.scan_columns(chunk_bets, engine.winning_numbers_of):
+        scanned += len(numbers)
+        for agency, document, tier in engine.classify_columns(agencies, documents, numbers):
+            winners.setdefault(str(agency), []).append((str(document), tier))
+    if bets is not None:
+        for agency, count in storage.bet_counts().items():
+            bets[str(agency)] = bets.get(str(agency), 0) + count
+    logging.debug(f"action: compute_winners | result: success | scanned_bets: {scanned} | seconds: {time.perf_counter() - start:.3f}")
+    return winners
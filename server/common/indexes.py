@@ -0,0 +1,515 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_NATIVE_BIG_ENDIAN = sys.byteorder == 'big'
+_UINT32 = struct.Struct('>I')
+_UINT64 = struct.Struct('>Q')
+_VALUE_BITS = 64
+
+""" Fields of the bets with a secondary index. """
+INDEXED_FIELDS = ("document", "agency")
+
+
+class SortedRunIndex:
+    """
+    On-disk index from a uint32 key to the offsets of the records that have it
+
+    Kept next to the storage as sorted runs, `<filepath>.<id>` files of
+    the big-endian keys of their entries in order followed by their
+    offsets, listed by the `<filepath>` manifest with the bytes of the
+    storage the index covers. Appended entries are buffered in memory and,
+    every `RUN_ENTRIES` of them, handed to a background thread that writes
+    them as a run. Another one merges every `FANOUT` runs of a level into
+    one of the next level as they pile up, so a lookup only binary-searches
+    a few runs, whatever the size of the storage. Entries still in memory
+    are searched linearly.
+
+    It is only a cache of the storage, like `ColumnCache`: entries the
+    storage got past the covered size are caught up when it is opened,
+    and it is rebuilt if the storage was truncated below it.
+    Appends must come from a single thread, lookups from any thread.
+    """
+    MAGIC = b'BETIDX\x00\x01'
+    HEADER = struct.Struct('>8sQQI')
+    RUN = struct.Struct('>IQQ')
+    """ Entries buffered in memory before they are written as a run. """
+    RUN_ENTRIES = 65536
+    """ Runs of a level merged into a single run of the next level. """
+    FANOUT = 8
+    """ Buffers handed to the background thread that appends wait for. """
+    MAX_PENDING_BUFFERS = 4
+    """ Entries merged at a time, taken from every merged run. """
+    MERGE_BLOCK_ENTRIES = 65536
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._condition = threading.Condition()
+        self.__reset()
+
+    @property
+    def is_open(self) -> bool:
+        return bool(self._threads)
+
+    @property
+    def covered(self) -> int:
+        return self._covered
+
+    def open(self, storage_size: int) -> None:
+        """
+        Load the runs of the manifest and start the background threads, the
+        entries past `covered` must be caught up with `catch_up`
+        """
+        with self._condition:
+            if self._threads:
+                return
+            self.__load_manifest()
+            if self._covered > storage_size:
+                logging.warning(f"action: open_index | result: warning | index: {self.filepath} | "
+                                f"error: storage truncated below the index, rebuilding it")
+                self.__remove_runs(self._runs)
+                self._runs = []
+                self._covered = 0
+            self._threads = [threading.Thread(target=self.__write_buffers, name="index-writer", daemon=True),
+                             threading.Thread(target=self.__merge_runs, name="index-merger", daemon=True)]
+            for thread in self._threads:
+                thread.start()
+
+    def catch_up(self, keys: array, offsets: array, covered: int) -> None:
+        """
+        Add the entries of offsets not yet covered among the given ones,
+        which cover the storage up to covered
+        """
+        if covered <= self._covered:
+            return
+        start = bisect_left(offsets, self._covered)
+        self.add(keys[start:], offsets[start:])
+        self.flush(covered)
+
+    def add(self, keys: array, offsets: array) -> None:
+        """
+        Add entries in storage order, written once `flush` covers them
+        """
+        with self._condition:
+            self._keys.extend(keys)
+            self._offsets.extend(offsets)
+
+    def flush(self, storage_size: int) -> None:
+        """
+        Hand the added entries to the background thread once there are
+        enough of them for a run, as covering storage_size bytes
+        """
+        with self._condition:
+            if len(self._keys) >= self.RUN_ENTRIES:
+                self.__hand_buffer(storage_size)
+
+    def close(self, storage_size: int) -> None:
+        """
+        Write every added entry, as covering storage_size bytes, and stop
+        the background threads, without waiting for pending merges
+        """
+        with self._condition:
+            if not self._threads:
+                return
+            if self._keys or storage_size > self.__pending_covered():
+                self.__hand_buffer(storage_size)
+            self._stopping = True
+            self._condition.notify_all()
+            threads = self._threads
+        for thread in threads:
+            thread.join()
+        with self._condition:
+            self.__reset()
+
+    def count(self, key: int) -> int:
+        """
+        Return the number of entries with the given key
+        """
+        with self._condition:
+            runs = list(self._runs)
+            total = sum(keys.count(key) for keys, _, _ in self._buffers) + self._keys.count(key)
+        for run in runs:
+            start, end = run.find(key)
+            total += end - start
+        return total
+
+    def lookup(self, key: int, limit: Optional[int] = None) -> list[int]:
+        """
+        Return the offsets of the entries with the given key in storage
+        order, only the first limit of them if given
+        """
+        with self._condition:
+            runs = list(self._runs)
+            offsets = []
+            for keys, buffer_offsets, _ in self._buffers + [(self._keys, self._offsets, None)]:
+                offsets.extend(_find_in_buffer(keys, buffer_offsets, key, limit))
+        for run in runs:
+            start, end = run.find(key)
+            if limit is not None:
+                end = min(end, start + limit)
+            offsets.extend(run.offsets(start, end))
+        offsets.sort()
+        return offsets[:limit] if limit is not None else offsets
+
+    def __reset(self):
+        self._runs = []
+        self._buffers = []
+        self._keys = array('I')
+        self._offsets = array('Q')
+        self._covered = 0
+        self._next_run_id = 0
+        self._stopping = False
+        self._failed = False
+        self._threads = []
+
+    def __pending_covered(self) -> int:
+        return self._buffers[-1][2] if self._buffers else self._covered
+
+    def __hand_buffer(self, storage_size: int) -> None:
+        while len(self._buffers) >= self.MAX_PENDING_BUFFERS and not self._failed:
+            self._condition.wait()
+        self._buffers.append((self._keys, self._offsets, storage_size))
+        self._keys = array('I')
+        self._offsets = array('Q')
+        self._condition.notify_all()
+
+    def __write_buffers(self):
+        while True:
+            with self._condition:
+                while not self._buffers and not self._stopping:
+                    self._condition.wait()
+                if not self._buffers:
+                    return
+                keys, offsets, covered = self._buffers[0]
+
+            try:
+                run = self.__write_run(0, len(keys), [_sort_by_key(keys, offsets)]) if keys else None
+            except OSError as e:
+                # Buffers stay in memory and are still searched, the next open catches up from the manifest
+                logging.error(f"action: write_index_run | result: fail | index: {self.filepath} | error: {e}")
+                with self._condition:
+                    self._failed = True
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                if run is not None:
+                    self._runs.append(run)
+                self._buffers.pop(0)
+                self._covered = covered
+                self.__write_manifest()
+                self._condition.notify_all()
+
+    def __merge_runs(self):
+        while True:
+            with self._condition:
+                while not self._stopping and self.__mergeable_runs() is None:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                runs = self.__mergeable_runs()
+
+            entries = sum(run.entries for run in runs)
+            try:
+                merged = self.__write_run(runs[0].level + 1, entries, self.__merged_blocks(runs))
+            except OSError as e:
+                # Lookups keep searching the runs that were not merged
+                logging.error(f"action: merge_index_runs | result: fail | index: {self.filepath} | error: {e}")
+                return
+            if merged is None:
+                return
+            with self._condition:
+                self._runs = [run for run in self._runs if run not in runs] + [merged]
+                self.__write_manifest()
+            self.__remove_runs(runs)
+            logging.debug(f"action: merge_index_runs | result: success | index: {self.filepath} | "
+                          f"level: {merged.level} | entries: {entries}")
+
+    def __merged_blocks(self, runs: list) -> Iterator[Tuple[array, array]]:
+        """
+        Yield the entries of the runs merged in order, a block of up to
+        MERGE_BLOCK_ENTRIES at a time
+        """
+        step = max(1, self.MERGE_BLOCK_ENTRIES // len(runs))
+        starts = [0] * len(runs)
+        while any(start < run.entries for run, start in zip(runs, starts)):
+            # Entries below the boundary take at most step from every run, and all of them from one
+            boundary = min((run.entry(start + step) for run, start in zip(runs, starts) if start + step < run.entries),
+                           default=None)
+            ends = [run.entries if boundary is None else run.bisect(boundary, start) for run, start in zip(runs, starts)]
+            slices = [run.read(start, end) for run, start, end in zip(runs, starts, ends) if start < end]
+            starts = ends
+            if len(slices) == 1:
+                yield slices[0]
+                continue
+            # Runs of a level cover consecutive parts of the storage, oldest first
+            keys, offsets = array('I'), array('Q')
+            for run_keys, run_offsets in slices:
+                keys.extend(run_keys)
+                offsets.extend(run_offsets)
+            yield _sort_by_key(keys, offsets)
+
+    def __write_run(self, level: int, entries: int, blocks: Iterable[Tuple[array, array]]) -> Optional['_Run']:
+        """
+        Write a run of the given sorted blocks of keys and offsets, None if
+        the index was closed meanwhile
+        """
+        with self._condition:
+            run_id = self._next_run_id
+            self._next_run_id += 1
+        run = _Run(f"{self.filepath}.{run_id}", level, entries, run_id)
+        written = 0
+        with open(run.filepath, 'wb') as file:
+            file.truncate(entries * 12)
+            for keys, offsets in blocks:
+                if level > 0 and self._stopping:
+                    break
+                if not _NATIVE_BIG_ENDIAN:
+                    keys.byteswap()
+                    offsets.byteswap()
+                file.seek(written * 4)
+                file.write(keys.tobytes())
+                file.seek(entries * 4 + written * 8)
+                file.write(offsets.tobytes())
+                written += len(keys)
+        if written < entries:
+            os.remove(run.filepath)
+            return None
+        return run
+
+    def __mergeable_runs(self) -> Optional[list]:
+        levels = {}
+        for run in self._runs:
+            levels.setdefault(run.level, []).append(run)
+        for level in sorted(levels):
+            if len(levels[level]) >= self.FANOUT:
+                return levels[level][:self.FANOUT]
+        return None
+
+    def __load_manifest(self) -> None:
+        if not os.path.exists(self.filepath):
+            return
+        with open(self.filepath, 'rb') as file:
+            data = file.read()
+        try:
+            magic, covered, next_run_id, count = self.HEADER.unpack_from(data)
+            runs = [_Run(f"{self.filepath}.{run_id}", level, entries, run_id)
+                    for level, entries, run_id in self.RUN.iter_unpack(data[self.HEADER.size:self.HEADER.size + count * self.RUN.size])]
+        except struct.error:
+            magic = None
+        if magic != self.MAGIC or any(not run.is_valid() for run in runs):
+            logging.warning(f"action: open_index | result: warning | index: {self.filepath} | error: invalid index, rebuilding it")
+            return
+        self._runs = runs
+        self._covered = covered
+        self._next_run_id = next_run_id
+
+    def __write_manifest(self) -> None:
+        manifest = (self.HEADER.pack(self.MAGIC, self._covered, self._next_run_id, len(self._runs))
+                    + b''.join(self.RUN.pack(run.level, run.entries, run.run_id) for run in self._runs))
+        with open(self.filepath + ".tmp", 'wb') as file:
+            file.write(manifest)
+        os.replace(self.filepath + ".tmp", self.filepath)
+
+    @staticmethod
+    def __remove_runs(runs: list) -> None:
+        # Lookups may still hold a map of the runs, which outlives the removed file
+        for run in runs:
+            if os.path.exists(run.filepath):
+                os.remove(run.filepath)
+
+
+def _find_in_buffer(keys: array, offsets: array, key: int, limit: Optional[int]) -> list[int]:
+    """
+    Return the offsets of the first limit entries of a buffer with the given key
+    Keys are searched as bytes, matches off a key boundary are skipped.
+    """
+    data = keys.tobytes()
+    needle = array('I', [key]).tobytes()
+    found = []
+    position = data.find(needle)
+    while position != -1 and (limit is None or len(found) < limit):
+        if position % keys.itemsize == 0:
+            found.append(offsets[position // keys.itemsize])
+            position = data.find(needle, position + keys.itemsize)
+        else:
+            position = data.find(needle, position + 1)
+    return found
+
+
+def _sort_by_key(keys: array, offsets: array) -> Tuple[array, array]:
+    """
+    Sort entries by key, keeping the order of the offsets of equal keys
+
+    Entries come in storage order, so this also sorts them by offset. It is
+    a stable argsort, with NumPy when it is installed.
+    """
+    if numpy is not None:
+        order = numpy.argsort(numpy.frombuffer(keys, dtype=numpy.uint32), kind='stable')
+        sorted_keys, sorted_offsets = array('I'), array('Q')
+        sorted_keys.frombytes(numpy.frombuffer(keys, dtype=numpy.uint32)[order].tobytes())
+        sorted_offsets.frombytes(numpy.frombuffer(offsets, dtype=numpy.uint64)[order].tobytes())
+        return sorted_keys, sorted_offsets
+    if len(keys) < 2:
+        return keys, offsets
+    gather = itemgetter(*sorted(range(len(keys)), key=keys.__getitem__))
+    return array('I', gather(keys)), array('Q', gather(offsets))
+
+
+class _Run:
+    """ Immutable sorted run of an index, memory-mapped on the first lookup. """
+    def __init__(self, filepath: str, level: int, entries: int, run_id: int):
+        self.filepath = filepath
+        self.level = level
+        self.entries = entries
+        self.run_id = run_id
+        self._map = None
+
+    def is_valid(self) -> bool:
+        return os.path.exists(self.filepath) and os.path.getsize(self.filepath) == self.entries * 12
+
+    def find(self, key: int) -> Tuple[int, int]:
+        """
+        Return the range of the entries with the given key
+        """
+        keys = _RunKeys(self.__map(), self.entries)
+        start = bisect_left(keys, key)
+        return start, bisect_right(keys, key, start)
+
+    def offsets(self, start: int, end: int) -> array:
+        return self.read(start, end)[1]
+
+    def read(self, start: int, end: int) -> Tuple[array, array]:
+        """
+        Return the keys and offsets of the entries from start to end
+        """
+        keys = array('I')
+        offsets = array('Q')
+        if start < end:
+            data = self.__map()
+            base = self.entries * 4
+            keys.frombytes(data[start * 4:end * 4])
+            offsets.frombytes(data[base + start * 8:base + end * 8])
+            if not _NATIVE_BIG_ENDIAN:
+                keys.byteswap()
+                offsets.byteswap()
+        return keys, offsets
+
+    def entry(self, i: int) -> int:
+        """
+        Return the i-th entry as key << 64 | offset, which sorts as the run
+        """
+        data = self.__map()
+        return (_UINT32.unpack_from(data, i * 4)[0] << _VALUE_BITS) | _UINT64.unpack_from(data, self.entries * 4 + i * 8)[0]
+
+    def bisect(self, entry: int, start: int = 0) -> int:
+        """
+        Return the position of the first entry from start on not below the given one
+        """
+        return bisect_left(_RunEntries(self), entry, start)
+
+    def __map(self):
+        if self._map is None:
+            with open(self.filepath, 'rb') as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+
+class _RunEntries:
+    """ Entries of a run, as a sequence for bisect. """
+    def __init__(self, run: _Run):
+        self._run = run
+
+    def __len__(self) -> int:
+        return self._run.entries
+
+    def __getitem__(self, i: int) -> int:
+        return self._run.entry(i)
+
+
+class _RunKeys:
+    """ Big-endian keys of a memory-mapped run, as a sequence for bisect. """
+    def __init__(self, data, entries: int):
+        self._data = data
+        self._entries = entries
+
+    def __len__(self) -> int:
+        return self._entries
+
+    def __getitem__(self, i: int) -> int:
+        return _UINT32.unpack_from(self._data, i * 4)[0]
+
+
+class BetIndexes:
+    """
+    Document and agency `SortedRunIndex` of a storage, from the field
+    value to the offsets of the records of the bets that have it
+
+    Kept next to the storage as `<filepath>.document.idx` and
+    `<filepath>.agency.idx`. Opening them catches both up with the records
+    yielded by walk(offset): (agencies, documents, offsets, covered) chunks
+    of the records stored from offset on.
+    """
+    def __init__(self, filepath: str):
+        self._indexes = {field: SortedRunIndex(f"{filepath}.{field}.idx") for field in INDEXED_FIELDS}
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return all(index.is_open for index in self._indexes.values())
+
+    def open(self, storage_size: int, walk: Callable[[int], Iterator[Tuple[array, array, array, int]]]) -> None:
+        with self._lock:
+            if self.is_open:
+                return
+            for index in self._indexes.values():
+                index.open(storage_size)
+            start = min(index.covered for index in self._indexes.values())
+            if start >= storage_size:
+                return
+            caught_up = 0
+            for agencies, documents, offsets, covered in walk(start):
+                self._indexes["agency"].catch_up(agencies, offsets, covered)
+                self._indexes["document"].catch_up(documents, offsets, covered)
+                caught_up += len(offsets)
+            for index in self._indexes.values():
+                index.flush(storage_size)
+            logging.debug(f"action: catch_up_indexes | result: success | bets: {caught_up}")
+
+    def add(self, agencies: array, documents: array, offsets: array) -> None:
+        """
+        Index bets stored at the given offsets, in storage order
+        """
+        self._indexes["agency"].add(agencies, offsets)
+        self._indexes["document"].add(documents, offsets)
+
+    def flush(self, storage_size: int) -> None:
+        for index in self._indexes.values():
+            index.flush(storage_size)
+
+    def close(self, storage_size: int) -> None:
+        with self._lock:
+            for index in self._indexes.values():
+                index.close(storage_size)
+
+    def lookup(self, field: str, key: int, limit: Optional[int] = None) -> Tuple[int, list[int]]:
+        """
+        Return the number of bets whose field has the given value, and the
+        offsets of the first limit of them
+        """
+        if field not in self._indexes:
+            raise ValueError(f"field without index: {field}")
+        index = self._indexes[field]
+        return index.count(key), index.lookup(key, limit)
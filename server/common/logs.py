@@ -0,0 +1,113 @@
+import atexit
+import itertools
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+""" Format of every log line, with the timestamp of the record and not of its output. """
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_listener = None
+_handlers = []
+_batch_log_sample = 1
+_batches_received = itertools.count()
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting of the records to the
+    listener, since its queue never leaves the process
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def initialize_log(logging_level: str, asynchronous: bool = False, batch_log_sample: int = 1) -> None:
+    """
+    Log to stderr in the `LOG_FORMAT` at the given level
+
+    If asynchronous, records are only queued by the threads that log them,
+    and a listener thread formats and writes them, so handlers never wait
+    for the logging I/O. Forked processes get a listener of their own.
+    Only one of every batch_log_sample batches received is logged by
+    `log_batch_received`.
+    """
+    global _batch_log_sample
+    _batch_log_sample = batch_log_sample
+    logging.basicConfig(format=LOG_FORMAT, level=logging_level, datefmt=LOG_DATE_FORMAT)
+    if asynchronous and _listener is None:
+        root = logging.getLogger()
+        _handlers[:] = root.handlers
+        for handler in _handlers:
+            root.removeHandler(handler)
+        root.addHandler(_LazyQueueHandler(queue.SimpleQueue()))
+        _start_listener(root.handlers[-1].queue)
+
+
+def stop_log() -> None:
+    """
+    Write the records still queued and log synchronously from then on
+    """
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, _LazyQueueHandler):
+            root.removeHandler(handler)
+    for handler in _handlers:
+        root.addHandler(handler)
+
+
+def log_batch_received(cantidad: int) -> None:
+    """
+    Log a batch received successfully, only one of every batch_log_sample
+    given to `initialize_log`
+    """
+    if next(_batches_received) % _batch_log_sample == 0:
+        logging.info('action: apuesta_recibida | result: success | cantidad: %d', cantidad)
+
+
+def _start_listener(records: queue.SimpleQueue) -> None:
+    global _listener
+    _listener = QueueListener(records, *_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _drain_before_fork() -> None:
+    # Records queued before a fork are written before any record of the child
+    if _listener is not None:
+        _listener.stop()
+
+
+def _resume_in_parent() -> None:
+    if _listener is not None:
+        _listener.start()
+
+
+def _restart_in_child() -> None:
+    # The listener thread of the parent does not survive the fork, nor do the records it had queued
+    if _listener is None:
+        return
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _LazyQueueHandler):
+            handler.queue = queue.SimpleQueue()
+            _start_listener(handler.queue)
+    # Processes of multiprocessing exit without running atexit, but with its
+    # finalizers, which it clears after the fork and before its after-fork hooks
+    import multiprocessing.util
+    multiprocessing.util.register_after_fork(_listener, _finalize_in_child)
+
+
+def _finalize_in_child(listener: QueueListener) -> None:
+    import multiprocessing.util
+    multiprocessing.util.Finalize(None, stop_log, exitpriority=0)
+
+
+atexit.register(stop_log)
+os.register_at_fork(before=_drain_before_fork, after_in_parent=_resume_in_parent, after_in_child=_restart_in_child)
@@ -0,0 +1,152 @@
+import logging
+import threading
+from typing import Callable, Tuple
+
+
+class Lottery:
+    """
+    Barrier that holds the draw until every agency finished sending its bets
+
+    It is shared by every server engine: threads block on `wait`, while
+    event loops register a listener to be notified once the draw is done
+    or the lottery is cancelled because the server is shutting down.
+    Draw hooks run before anyone is notified, so whatever they publish is
+    ready for every waiter.
+    """
+    def __init__(self, num_agencies: int):
+        self._num_agencies = num_agencies
+        self._finished_agencies = set()
+        self._done = False
+        self._cancelled = False
+        self._listeners = []
+        self._draw_hooks = []
+        self._condition = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def mark_finished(self, agency_id: str) -> None:
+        """
+        Register that an agency finished sending its bets
+
+        The draw takes place when the last expected agency finishes.
+        """
+        with self._condition:
+            self._finished_agencies.add(agency_id)
+            logging.debug(f"action: finished_notification_received | result: success | client_id: {agency_id} | finished_agencies: {len(self._finished_agencies)}")
+
+            if len(self._finished_agencies) != self._num_agencies or self._done:
+                return
+
+            logging.info("action: sorteo | result: success")
+            listeners = self.__complete()
+
+        for listener in listeners:
+            listener()
+
+    def draw(self) -> None:
+        """
+        Do the draw without waiting for the finished agencies, for lotteries
+        whose barrier is held elsewhere
+        """
+        with self._condition:
+            if self._done:
+                return
+            listeners = self.__complete()
+
+        for listener in listeners:
+            listener()
+
+    def __complete(self) -> list:
+        for hook in self._draw_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logging.error(f"action: draw_hook | result: fail | error: {e}")
+        self._done = True
+        self._condition.notify_all()
+        return list(self._listeners)
+
+    def wait(self) -> bool:
+        """
+        Block until the draw is done or the lottery is cancelled
+
+        Returns whether the draw was done.
+        """
+        if self._done:
+            # Agencies querying after the draw do not contend for the lock
+            return True
+        with self._condition:
+            while not self._done and not self._cancelled:
+                self._condition.wait()
+            return self._done
+
+    def cancel(self) -> None:
+        """
+        Wake up every waiter without doing the draw
+        """
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            listener()
+
+    def acquire_agency(self, agency: int) -> None:
+        """
+        Hold the sequenced batches of an agency to this process until
+        `release_agency`, so its retried batches are checked against the
+        sequence numbers its previous batches were stored with
+
+        A single process stores every batch, so there is nothing to hold.
+        """
+
+    def release_agency(self, agency: int) -> None:
+        """
+        Release an agency held by `acquire_agency` once its batches are stored
+        """
+
+    def find_bets(self, storage, field: str, value: int, limit: int) -> Tuple[int, list]:
+        """
+        Return the number of stored bets whose field has the given value,
+        and the first limit of them
+
+        A single process stores every bet, so storage has them all.
+        """
+        return storage.find_bets(field, value, limit)
+
+    def tallies_response(self, winners_index) -> bytes:
+        """
+        Return the encoded running tallies of every agency
+
+        A single process indexes every bet, so winners_index has them all.
+        """
+        return winners_index.tallies_response()
+
+    def add_draw_hook(self, hook: Callable[[], None]) -> None:
+        """
+        Register a callback run when the draw is done, before waiters and
+        listeners are notified
+
+        The callback runs right away if the draw was already done.
+        """
+        with self._condition:
+            if not self._done:
+                self._draw_hooks.append(hook)
+                return
+        hook()
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """
+        Register a callback run once the draw is done or the lottery is cancelled
+
+        The callback runs in the thread that triggered the event, or right
+        away if that already happened.
+        """
+        with self._condition:
+            if not self._done and not self._cancelled:
+                self._listeners.append(listener)
+                return
+        listener()
@@ -0,0 +1,171 @@
+import logging
+import threading
+from bisect import bisect_left
+
+
+""" Histogram buckets, in seconds, fit for the sub-millisecond operations of the hot path. """
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Counter:
+    """ Monotonically increasing value. """
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def samples(self):
+        yield self.name, self._value
+
+
+class Gauge(Counter):
+    """ Value that goes up and down. """
+    type = "gauge"
+
+    def dec(self, amount=1) -> None:
+        self.inc(-amount)
+
+    def set(self, value) -> None:
+        with self._lock:
+            self._value = value
+
+
+class Histogram:
+    """
+    Count of observations per bucket, plus their count and sum
+
+    Observing only bisects the fixed bucket bounds, buckets are made
+    cumulative when rendered.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self._bounds, counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        cumulative += counts[-1]
+        yield f'{self.name}_bucket{{le="+Inf"}}', cumulative
+        yield f'{self.name}_sum', total
+        yield f'{self.name}_count', cumulative
+
+
+class MetricsRegistry:
+    """
+    Metrics of the process, rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.__register(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.__register(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def __register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+REGISTRY = MetricsRegistry()
+
+BYTES_RECEIVED = REGISTRY.counter("bets_received_bytes_total", "Bytes of bet batch messages received")
+BETS_DECODED = REGISTRY.counter("bets_decoded_total", "Bets decoded from batch messages")
+BATCH_PARSE_SECONDS = REGISTRY.histogram("batch_parse_seconds", "Time spent decoding each batch message")
+COMPRESSED_BYTES_RECEIVED = REGISTRY.counter("bets_received_compressed_bytes_total", "Bytes of compressed batch messages received, before decompressing")
+BATCH_DECOMPRESS_SECONDS = REGISTRY.histogram("batch_decompress_seconds", "Time spent decompressing each compressed batch message")
+STORAGE_QUEUE_WAIT_SECONDS = REGISTRY.histogram("storage_queue_wait_seconds", "Time a batch waits for the storage writer")
+STORAGE_COMMIT_SECONDS = REGISTRY.histogram("storage_commit_seconds", "Time the storage writer takes to store a group of batches")
+BETS_STORED = REGISTRY.counter("bets_stored_total", "Bets stored by the storage writer")
+CONNECTED_CLIENTS = REGISTRY.gauge("connected_clients", "Client connections currently open")
+CONNECTIONS_REJECTED = REGISTRY.counter("connections_rejected_total", "Client connections answered busy because the server was at capacity")
+WINNERS_QUERY_SECONDS = REGISTRY.histogram("winners_query_seconds", "Time to answer a winners query once the draw is done")
+SERVER_READY = REGISTRY.gauge("server_ready", "1 once the server recovered its storage and accepts connections")
+STARTUP_SECONDS = REGISTRY.gauge("server_startup_seconds", "Time from the process start until the server was ready")
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint that serves the registry at /metrics, from a daemon thread
+
+    `http.server` is only imported when the endpoint is created, so processes
+    without metrics do not pay for it at startup.
+    """
+    def __init__(self, port: int, registry: MetricsRegistry = REGISTRY):
+        from http.server import ThreadingHTTPServer
+        self._server = ThreadingHTTPServer(('', port), _metrics_handler(registry))
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        logging.info(f"action: serve_metrics | result: success | port: {self.port}")
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _metrics_handler(registry: MetricsRegistry):
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
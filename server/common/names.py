@@ -0,0 +1,115 @@
+import os
+import struct
+import sys
+from typing import Optional
+
+
+class NameTable:
+    """
+    String table of the names of a storage, which records refer to by id
+
+    Kept next to the storage as `<filepath>.names`: a magic header followed
+    by one length(2) + UTF-8 name entry per distinct name, so the id of a
+    name is the position of its entry. Names are only ever appended, and
+    they reach the file before the records that refer to them, so a record
+    on disk never refers to a name that is not. Entries past the last
+    complete one, left by an interrupted flush, are dropped on open.
+    Names are interned, so every loaded bet shares them.
+    Not thread-safe/process-safe.
+    """
+    MAGIC = b'BETNAMES'
+    LENGTH = struct.Struct('>H')
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.names = []
+        self._ids = None
+        self._file = None
+        self._pending = []
+        self._valid_size = 0
+        self._unsynced = False
+
+    def load(self) -> None:
+        """
+        Read the names of the file, once
+        """
+        if self._ids is not None:
+            return
+        self._ids = {}
+        if not os.path.exists(self.filepath):
+            return
+        with open(self.filepath, 'rb') as file:
+            data = file.read()
+        if not data:
+            return
+        if data[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"{self.filepath} is not a names table")
+        offset = len(self.MAGIC)
+        unpack_length = self.LENGTH.unpack_from
+        intern = sys.intern
+        while offset + self.LENGTH.size <= len(data):
+            length, = unpack_length(data, offset)
+            end = offset + self.LENGTH.size + length
+            if end > len(data):
+                break
+            name = intern(str(data[offset + self.LENGTH.size:end], 'utf-8'))
+            self._ids[name] = len(self.names)
+            self.names.append(name)
+            offset = end
+        self._valid_size = offset
+
+    def id(self, name: str) -> int:
+        """
+        Return the id of a name, adding it to the table if it is new
+        It is not written to the file until `flush` is called.
+        """
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            encoded = name.encode('utf-8')
+            if len(encoded) > 0xFFFF:
+                raise ValueError(f"name of {len(encoded)} bytes does not fit in the names table")
+            name = sys.intern(name)
+            self._ids[name] = name_id
+            self.names.append(name)
+            self._pending.append(self.LENGTH.pack(len(encoded)) + encoded)
+        return name_id
+
+    def name(self, name_id: int) -> Optional[str]:
+        """
+        Return the name of an id, None if it is not in the table
+        """
+        return self.names[name_id] if name_id < len(self.names) else None
+
+    def flush(self, sync: bool) -> None:
+        """
+        Hand the added names to the OS, and to the disk if sync is set
+        """
+        if self._pending:
+            if self._file is None:
+                self._file = open(self.filepath, 'r+b' if os.path.exists(self.filepath) else 'w+b')
+                # Drop an entry left half-written by an interrupted flush
+                self._file.truncate(self._valid_size)
+                self._file.seek(self._valid_size)
+                if self._valid_size == 0:
+                    self._file.write(self.MAGIC)
+            self._file.write(b''.join(self._pending))
+            self._file.flush()
+            self._pending = []
+            self._unsynced = True
+        if sync and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+
+    def close(self) -> None:
+        """
+        Close the file, forgetting the names not yet flushed
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.names = []
+        self._ids = None
+        self._pending = []
+        self._valid_size = 0
+        self._unsynced = False
@@ -0,0 +1,114 @@
+import functools
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, Optional, Tuple
+from .draw import DrawEngine, DEFAULT_DRAW_ENGINE
+from .storage import create_storage, STORAGE_BACKENDS
+from .utils import BetBatch
+
+
+""" Bytes of the storage parsed by each task of a parallel load. """
+DEFAULT_CHUNK_BYTES = 16 * 2**20
+
+""" Storage read by the tasks of a worker process. """
+_storage = None
+
+
+def map_batches(storage, func: Callable[[list[BetBatch]], object], workers: Optional[int] = None,
+                chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> Iterator:
+    """
+    Yield func(batches) for every chunk of about chunk_bytes bytes of the
+    storage, in storage order, batches being the `BetBatch` list of the
+    chunk, parsed in parallel by a pool of worker processes
+
+    Chunks are split at row boundaries by `storage.split`, and each worker
+    reads its own chunks, so only the results of func travel back: an
+    aggregate costs its size, not the size of the chunk. func must be
+    picklable, e.g. a module level function or a `functools.partial` of one.
+    At most two chunks per worker are in flight, so results do not pile
+    up faster than they are consumed. With a single worker (the default
+    is one per CPU) chunks are parsed in the calling process.
+    """
+    ranges = storage.split(chunk_bytes)
+    workers = min(workers or os.cpu_count() or 1, len(ranges))
+    if workers <= 1:
+        for start, end in ranges:
+            yield func(list(storage.load_batches(start, end)))
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_open_storage, initargs=(type(storage), storage.filepath)) as executor:
+        pending = deque()
+        try:
+            for start, end in ranges:
+                pending.append(executor.submit(_map_chunk, func, start, end))
+                if len(pending) == 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def load_batches(storage, workers: Optional[int] = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> Iterator[BetBatch]:
+    """
+    Yield the stored bets as batches of consecutive bets of an agency, in
+    storage order, parsed in parallel as in `map_batches`
+    """
+    for batches in map_batches(storage, _batches, workers, chunk_bytes):
+        yield from batches
+
+
+def winners_per_agency(storage, engine: DrawEngine = DEFAULT_DRAW_ENGINE, workers: Optional[int] = None,
+                       chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> Tuple[dict, dict]:
+    """
+    Return the (document, tier) of the winning bets per agency id, as
+    `draw.compute_winners`, and the number of stored bets per agency id,
+    reading every stored bet instead of the column cache
+
+    Each worker classifies and counts its chunks, and the partial results
+    are merged in storage order, so they match a sequential pass.
+    """
+    winners, bets = {}, {}
+    for chunk_winners, chunk_bets in map_batches(storage, functools.partial(_chunk_winners, engine), workers, chunk_bytes):
+        for agency_id, documents in chunk_winners.items():
+            winners.setdefault(agency_id, []).extend(documents)
+        for agency_id, count in chunk_bets.items():
+            bets[agency_id] = bets.get(agency_id, 0) + count
+    return winners, bets
+
+
+def _open_storage(storage_class, filepath: str) -> None:
+    global _storage
+    _storage = storage_class(filepath)
+
+
+def _map_chunk(func, start: int, end: int):
+    return func(list(_storage.load_batches(start, end)))
+
+
+def _batches(batches: list[BetBatch]) -> list[BetBatch]:
+    return batches
+
+
+def _chunk_winners(engine: DrawEngine, batches: list[BetBatch]) -> Tuple[dict, dict]:
+    winners, bets = {}, {}
+    for batch in batches:
+        agency_id = str(batch.agency)
+        bets[agency_id] = bets.get(agency_id, 0) + len(batch)
+        for document, tier in engine.batch_winners(batch):
+            winners.setdefault(agency_id, []).append((str(document), tier))
+    return winners, bets
+
+
+if __name__ == "__main__":
+    # Audit a storage: python -m common.parallel_load <backend> <storage> [workers]
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in STORAGE_BACKENDS:
+        sys.exit(f"usage: {sys.argv[0]} <{'|'.join(STORAGE_BACKENDS)}> <storage> [workers]")
+    audited_winners, audited_bets = winners_per_agency(create_storage(sys.argv[1], sys.argv[2]),
+                                                       workers=int(sys.argv[3]) if len(sys.argv) == 4 else None)
+    for audited_agency in sorted(audited_bets, key=int):
+        print(f"agency: {audited_agency} | bets: {audited_bets[audited_agency]} | "
+              f"winners: {len(audited_winners.get(audited_agency, ()))}")
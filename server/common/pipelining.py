@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+from .logs import log_batch_received
+from .protocol import encode_batch_ack, send_all
+
+
+""" Stands for the batch in flight that could not be received. """
+_FAILED = object()
+
+
+class BatchAcker:
+    """
+    Acknowledges the sequenced batches of a connection once they are stored
+
+    Batches are acked in the order they were received, from a thread of
+    the connection, so the handler can go on receiving the next batches
+    while the previous ones are stored. Batches found stored together get
+    a single cumulative ack. At most `max_in_flight` batches are unacked
+    at a time: past that, `submit` blocks the handler, and so the reading
+    of the connection, until a batch is acked.
+    """
+    def __init__(self, client_sock, winners_index, max_in_flight: int):
+        self._client_sock = client_sock
+        self._winners_index = winners_index
+        self._queue = queue.Queue()
+        self._window = threading.Semaphore(max_in_flight)
+        self._broken = False
+        self._thread = threading.Thread(target=self.__run, name="batch-acker", daemon=True)
+        self._thread.start()
+
+    def submit(self, sequence_number: int, in_flight, cantidad: int) -> None:
+        """
+        Ack a received batch once it is stored, given as a (batch, future)
+        still in flight or None if the batch was empty
+        """
+        self._window.acquire()
+        self._queue.put((sequence_number, in_flight, cantidad))
+
+    def submit_error(self, sequence_number: int) -> None:
+        self.submit(sequence_number, _FAILED, 0)
+
+    def drain(self) -> None:
+        """
+        Block until every submitted batch is acked
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        self.drain()
+        self._queue.put(None)
+        self._thread.join()
+
+    def __run(self):
+        pending = None
+        unacked = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                pending, unacked = self.__flush(pending, unacked)
+                item = self._queue.get()
+            if item is None:
+                self.__flush(pending, unacked)
+                self._queue.task_done()
+                return
+
+            sequence_number, in_flight, cantidad = item
+            if in_flight not in (None, _FAILED) and not in_flight[1].done():
+                # Do not hold back the ack of stored batches while this one is stored
+                pending, unacked = self.__flush(pending, unacked)
+
+            if _wait_stored(self._winners_index, in_flight, cantidad):
+                pending = sequence_number
+                unacked += 1
+            else:
+                self.__flush(pending, unacked)
+                self.__send(encode_batch_ack(False, sequence_number))
+                pending, unacked = self.__flush(None, 1)
+
+    def __flush(self, pending, unacked):
+        if pending is not None:
+            self.__send(encode_batch_ack(True, pending))
+        for _ in range(unacked):
+            self._window.release()
+            self._queue.task_done()
+        return None, 0
+
+    def __send(self, ack: bytes):
+        if self._broken:
+            return
+        try:
+            send_all(self._client_sock, ack)
+        except OSError as e:
+            logging.error(f"action: send_batch_ack | result: fail | error: {e}")
+            self._broken = True
+
+
+def _wait_stored(winners_index, in_flight, cantidad: int) -> bool:
+    """
+    Wait for a batch to be stored and index it, unless it was a retry of a
+    batch already stored
+
+    Futures of the asyncio engine must be done before calling it.
+    """
+    if in_flight is _FAILED:
+        return False
+    if in_flight is not None:
+        batch, future = in_flight
+        try:
+            stored = future.result()
+        except Exception as e:
+            logging.error(f"action: store_bets | result: fail | error: {e}")
+            logging.info('action: apuesta_recibida | result: fail | cantidad: %d', cantidad)
+            return False
+        if stored:
+            winners_index.add_batch(batch)
+    log_batch_received(cantidad)
+    return True
@@ -1,12 +1,66 @@
 import logging
-from typing import Optional, Tuple
+import socket
+import struct
+import sys
+import time
+from array import array
+from typing import Iterator, Optional, Tuple
+from .compression import compress, new_decompressor, COMPRESSION_NONE, DEFAULT_ZLIB_LEVEL
+from .metrics import BATCH_DECOMPRESS_SECONDS, BATCH_PARSE_SECONDS, BETS_DECODED, BYTES_RECEIVED, COMPRESSED_BYTES_RECEIVED
+from .utils import BetBatch, pack_date
 
 RESPONSE_OK = 0
 RESPONSE_ERROR = 1
+RESPONSE_BUSY = 2
 
 MESSAGE_TYPE_BATCH = 1
 MESSAGE_TYPE_FINISHED_SENDING = 2
 MESSAGE_TYPE_QUERY_WINNERS = 3
+MESSAGE_TYPE_SEQUENCED_BATCH = 4
+MESSAGE_TYPE_QUERY_TIERED_WINNERS = 5
+MESSAGE_TYPE_NEGOTIATE_COMPRESSION = 6
+MESSAGE_TYPE_QUERY_TALLIES = 7
+MESSAGE_TYPE_LOOKUP_BETS = 8
+
+LOOKUP_FIELD_DOCUMENT = 1
+LOOKUP_FIELD_AGENCY = 2
+""" Indexed storage field looked up by each lookup field id. """
+LOOKUP_FIELDS = {LOOKUP_FIELD_DOCUMENT: "document", LOOKUP_FIELD_AGENCY: "agency"}
+
+_UINT32 = struct.Struct('>I')
+_BATCH_HEADER = struct.Struct('>II')
+_BET_FIXED_FIELDS = struct.Struct('>III')
+_BATCH_ACK = struct.Struct('>IBI')
+_COMPRESSION_RESPONSE = struct.Struct('>IBB')
+_WINNERS_HEADER = struct.Struct('>IBI')
+_TALLY = struct.Struct('>III')
+_LOOKUP = struct.Struct('>II')
+_LOOKUP_HEADER = struct.Struct('>IBII')
+_NATIVE_BIG_ENDIAN = sys.byteorder == 'big'
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+""" Default size of the buffer batches are received into, which bounds the size of a single bet. """
+DEFAULT_RECV_BUFFER_SIZE = 64 * 1024
+""" Default maximum number of bets decoded before handing them to the storage. """
+DEFAULT_CHUNK_BETS = 1024
+""" Largest payload accepted for messages that only carry a client id. """
+MAX_CLIENT_ID_MESSAGE_SIZE = 4
+""" Largest payload accepted for compression negotiation messages, one byte per codec offered. """
+MAX_COMPRESSION_OFFER_SIZE = 16
+""" Largest payload accepted for lookup messages. """
+MAX_LOOKUP_MESSAGE_SIZE = _LOOKUP.size
+""" Most bets sent back by a lookup, the rest are only counted. """
+MAX_LOOKUP_BETS = 1000
+""" Winner documents encoded at a time when streaming a winners response. """
+WINNERS_CHUNK_SIZE = 16 * 1024
+
+
+class ProtocolError(Exception):
+    """ A received message does not follow the protocol. """
+
+
+class MessageTooLargeError(ProtocolError):
+    """ A message declares a length above the accepted maximum, it cannot be read nor skipped. """
 
 def unpack_uint32_be(data: bytes) -> int:
     """Helper function to unpack a 4-byte big-endian unsigned integer from bytes"""
@@ -15,23 +69,56 @@ def unpack_uint32_be(data: bytes) -> int:
     return (data[0] << 24) | (data[1] << 16) | (data[2] << 8) | data[3]
 
 def recv_all(sock, n):
-    """Helper function to receive exactly n bytes"""
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
+    """
+    Helper function to receive exactly n bytes
+
+    Bytes are received straight into a preallocated buffer, so receiving
+    a large message costs a single allocation.
+    """
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        packet_size = sock.recv_into(view[received:])
+        if not packet_size:
             return None
-        data += packet
+        received += packet_size
     return data
 
 def send_all(sock, data):
-    """Helper function to send all data, handling short writes"""
-    total_sent = 0
-    while total_sent < len(data):
-        sent = sock.send(data[total_sent:])
+    """
+    Helper function to send all data, handling short writes
+
+    Short writes advance a memoryview instead of copying the rest of the data.
+    """
+    view = memoryview(data).cast('B')
+    while view:
+        sent = sock.send(view)
+        if sent == 0:
+            raise RuntimeError("Socket connection broken")
+        view = view[sent:]
+
+def send_buffers(sock, buffers) -> None:
+    """
+    Send several buffers in order, with scatter-gather writes when available
+    so they do not need to be joined first
+    """
+    if not _HAS_SENDMSG:
+        for buffer in buffers:
+            send_all(sock, buffer)
+        return
+
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while views:
+        sent = sock.sendmsg(views)
         if sent == 0:
             raise RuntimeError("Socket connection broken")
-        total_sent += sent
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
 
 def receive_bet_batch(client_sock) -> Optional[Tuple[str, list]]:
     """
@@ -41,58 +128,411 @@ def receive_bet_batch(client_sock) -> Optional[Tuple[str, list]]:
     Where each bet: nombre_len(4), nombre, apellido_len(4), apellido, documento(4), nacimiento(4), numero(4)
     """
     try:
-        message_length_bytes = recv_all(client_sock, 4)
-        if not message_length_bytes:
-            logging.error("action: receive_bet_batch | result: fail | field: message_length | error: failed to receive data")
-            return None
-        message_length = unpack_uint32_be(message_length_bytes)
-        
-        message_data = recv_all(client_sock, message_length)
-        if not message_data:
-            logging.error(f"action: receive_bet_batch | result: fail | field: message_data | expected_length: {message_length} | error: failed to receive data")
+        message_data = receive_message_data(client_sock, "receive_bet_batch")
+        if message_data is None:
             return None
         
-        offset = 0
+        return parse_bet_batch(message_data)
         
-        # Client ID (4 bytes)
-        if offset + 4 > len(message_data):
-            logging.error("action: receive_bet_batch | result: fail | field: client_id | error: insufficient data")
-            return None
-        client_id = str(unpack_uint32_be(message_data[offset:offset+4]))
-        offset += 4
-        
-        # Batch size (4 bytes)
-        if offset + 4 > len(message_data):
-            logging.error("action: receive_bet_batch | result: fail | field: batch_size | error: insufficient data")
+    except Exception as e:
+        logging.error(f"action: receive_bet_batch | result: fail | error: {e}")
+        return None
+
+def receive_bet_batch_stream(client_sock, max_message_size: int, buffer_size: int = DEFAULT_RECV_BUFFER_SIZE,
+                             compression: int = COMPRESSION_NONE) -> Iterator[BetBatch]:
+    """
+    Receive a batch of bets from client socket, yielding them in chunks as they arrive
+
+    Same protocol as `receive_bet_batch`, but the payload is never held in
+    memory as a whole: it is received through a `BetBatchDecoder` of
+    `buffer_size` bytes. The last chunk yielded may be empty. On connections
+    that negotiated a compression codec, the payload is compressed and
+    decompressed as it arrives by a `CompressedBetBatchDecoder`.
+
+    Raises MessageTooLargeError if the message is larger than
+    `max_message_size`, and ProtocolError if it is malformed, in which case
+    the rest of the message is skipped so the next one can still be read.
+    """
+    message_length_bytes = recv_all(client_sock, 4)
+    if not message_length_bytes:
+        raise ConnectionError("failed to receive message length")
+    message_length = unpack_uint32_be(message_length_bytes)
+    if message_length > max_message_size:
+        raise MessageTooLargeError(f"message length {message_length} exceeds maximum {max_message_size}")
+
+    decoder = new_bet_batch_decoder(message_length, compression, max_message_size, buffer_size)
+    try:
+        while not decoder.done:
+            received = client_sock.recv_into(decoder.writable_view())
+            if not received:
+                raise ConnectionError("connection closed in the middle of a batch")
+            yield from decoder.feed(received)
+        yield decoder.finish()
+    except ProtocolError:
+        decoder.skip_rest()
+        while not decoder.done:
+            received = client_sock.recv_into(decoder.writable_view())
+            if not received:
+                break
+            decoder.feed(received)
+        raise
+
+def receive_message_data(client_sock, action: str, max_length: Optional[int] = None) -> Optional[bytearray]:
+    """
+    Receive the payload of a message
+
+    Protocol: total_message_length(4), then total_message_length bytes
+    A payload longer than max_length is not received.
+    """
+    message_length_bytes = recv_all(client_sock, 4)
+    if not message_length_bytes:
+        logging.error(f"action: {action} | result: fail | field: message_length | error: failed to receive data")
+        return None
+    message_length = unpack_uint32_be(message_length_bytes)
+    if max_length is not None and message_length > max_length:
+        logging.error(f"action: {action} | result: fail | field: message_length | message_length: {message_length} | error: message too large")
+        return None
+
+    message_data = recv_all(client_sock, message_length)
+    if not message_data:
+        logging.error(f"action: {action} | result: fail | field: message_data | expected_length: {message_length} | error: failed to receive data")
+        return None
+    return message_data
+
+def parse_bet_batch(message_data: bytes) -> Optional[Tuple[str, list]]:
+    """
+    Parse the payload of a batch message, without its message length
+
+    Payload: client_id(4), batch_size(4), then batch_size number of bets
+    Every bet is returned as a tuple of strings:
+    (nombre, apellido, documento, nacimiento as YYYY-MM-DD, numero)
+    """
+    batch = parse_bet_batch_columns(message_data)
+    if batch is None:
+        return None
+
+    bets_data = []
+    for nombre, apellido, documento, nacimiento_int, numero in zip(
+            batch.first_names, batch.last_names, batch.documents, batch.birthdates, batch.numbers):
+        year, month_day = divmod(nacimiento_int, 10000)
+        month, day = divmod(month_day, 100)
+        bets_data.append((nombre, apellido, str(documento), f"{year:04d}-{month:02d}-{day:02d}", str(numero)))
+    return (str(batch.agency), bets_data)
+
+def parse_bet_batch_columns(message_data: bytes) -> Optional[BetBatch]:
+    """
+    Parse the payload of a batch message into a columnar BetBatch
+
+    Integer fields are kept as decoded, without going through strings.
+    """
+    try:
+        view = memoryview(message_data)
+        end = len(view)
+
+        # Client ID (4 bytes) and batch size (4 bytes)
+        if end < _BATCH_HEADER.size:
+            field = "client_id" if end < 4 else "batch_size"
+            logging.error(f"action: receive_bet_batch | result: fail | field: {field} | error: insufficient data")
             return None
-        batch_size = unpack_uint32_be(message_data[offset:offset+4])
-        offset += 4
-        
-        logging.debug(f"action: receive_bet_batch | result: in_progress | client_id: {client_id} | batch_size: {batch_size}")
-        
-        if batch_size == 0:
-            logging.info(f"action: receive_bet_batch | result: success | client_id: {client_id} | batch_size: 0")
-            return (client_id, [])
+        client_id, batch_size = _BATCH_HEADER.unpack_from(view, 0)
+        offset = _BATCH_HEADER.size
         
-        bets_data = []
+        logging.debug("action: receive_bet_batch | result: in_progress | client_id: %d | batch_size: %d", client_id, batch_size)
         
-        for i in range(batch_size):
-            bet_result, new_offset = parse_bet_from_data(message_data, offset)
-            if bet_result is None:
-                logging.error(f"action: receive_bet_batch | result: fail | bet_number: {i+1} | error: failed to parse bet")
-                return None
-            
-            bets_data.append(bet_result)
-            offset = new_offset
+        batch = BetBatch(client_id)
+        offset, _ = parse_available_bets(view, offset, end, batch_size, batch)
+        if len(batch) < batch_size:
+            # Parse the malformed bet again field by field to log which one failed
+            parse_bet_from_data(view, offset)
+            logging.error(f"action: receive_bet_batch | result: fail | bet_number: {len(batch)+1} | error: failed to parse bet")
+            return None
         
-        logging.info(f"action: receive_bet_batch | result: success | client_id: {client_id} | batch_size: {batch_size}")
-        return (client_id, bets_data)
+        logging.debug("action: receive_bet_batch | result: success | client_id: %d | batch_size: %d", client_id, batch_size)
+        return batch
         
     except Exception as e:
         logging.error(f"action: receive_bet_batch | result: fail | error: {e}")
         return None
 
-def parse_bet_from_data(message_data: bytes, offset: int) -> Tuple[Optional[Tuple[str, str, str, str, str]], int]:
+def parse_available_bets(view: memoryview, offset: int, end: int, max_bets: int, batch: BetBatch) -> Tuple[int, bool]:
+    """
+    Decode into batch the complete bets found in view[offset:end], up to max_bets
+
+    Returns the offset right after the last decoded bet, and whether
+    decoding stopped at a malformed bet rather than at an incomplete one.
+    Names are interned, so the bets of every batch share one object per name.
+    """
+    append_bet = batch.append
+    intern = sys.intern
+    unpack_uint32 = _UINT32.unpack_from
+    unpack_fixed_fields = _BET_FIXED_FIELDS.unpack_from
+    fixed_fields_size = _BET_FIXED_FIELDS.size
+
+    for _ in range(max_bets):
+        if offset + 4 > end:
+            break
+        nombre_len, = unpack_uint32(view, offset)
+        nombre_start = offset + 4
+        nombre_end = nombre_start + nombre_len
+        if nombre_end + 4 > end:
+            break
+        apellido_len, = unpack_uint32(view, nombre_end)
+        apellido_start = nombre_end + 4
+        apellido_end = apellido_start + apellido_len
+        if apellido_end + fixed_fields_size > end:
+            break
+
+        try:
+            nombre = intern(str(view[nombre_start:nombre_end], 'utf-8'))
+            apellido = intern(str(view[apellido_start:apellido_end], 'utf-8'))
+        except UnicodeDecodeError:
+            return offset, True
+        documento, nacimiento_int, numero = unpack_fixed_fields(view, apellido_end)
+        append_bet(nombre, apellido, documento, nacimiento_int, numero)
+        offset = apellido_end + fixed_fields_size
+
+    return offset, False
+
+class BetBatchDecoder:
+    """
+    Incremental decoder of the payload of a batch message
+
+    The payload is received into a fixed size buffer and complete bets are
+    decoded as soon as they arrive, in chunks of at most `chunk_bets` bets,
+    so the memory used per connection does not depend on the batch size.
+    It does no I/O: engines receive into `writable_view()` and report the
+    amount of bytes received to `feed()`, which returns the full chunks.
+    """
+    def __init__(self, message_length: int, buffer_size: int = DEFAULT_RECV_BUFFER_SIZE, chunk_bets: int = DEFAULT_CHUNK_BETS):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._remaining = message_length
+        self._chunk_bets = chunk_bets
+        self._batch_size = None
+        self._chunk = None
+        self._skipping = False
+        self._parse_time = 0.0
+        self.decoded = 0
+
+    @property
+    def done(self) -> bool:
+        """ Whether the whole payload was received. """
+        return self._remaining == 0
+
+    def writable_view(self) -> memoryview:
+        """
+        Free space of the buffer, limited to the bytes of the payload yet to receive
+        """
+        if self._skipping:
+            return self._view[:min(len(self._buffer), self._remaining)]
+
+        if self._start > 0:
+            # Move the incomplete bet at the tail to the front of the buffer
+            pending = self._end - self._start
+            self._buffer[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+        free = min(len(self._buffer) - self._end, self._remaining)
+        if free == 0:
+            raise ProtocolError(f"bet {self.decoded + 1} does not fit in a {len(self._buffer)} bytes buffer")
+        return self._view[self._end:self._end + free]
+
+    def feed(self, received: int) -> list[BetBatch]:
+        """
+        Decode the bets completed by the bytes just received into `writable_view()`
+        """
+        self._remaining -= received
+        BYTES_RECEIVED.inc(received)
+        if self._skipping:
+            return []
+        self._end += received
+
+        start = time.perf_counter()
+        try:
+            return self.__decode()
+        finally:
+            self._parse_time += time.perf_counter() - start
+
+    def __decode(self) -> list[BetBatch]:
+        if self._batch_size is None:
+            if self._end - self._start < _BATCH_HEADER.size:
+                if self.done:
+                    raise ProtocolError("insufficient data for batch header")
+                return []
+            client_id, self._batch_size = _BATCH_HEADER.unpack_from(self._view, self._start)
+            self._start += _BATCH_HEADER.size
+            self._chunk = BetBatch(client_id)
+            logging.debug("action: receive_bet_batch | result: in_progress | client_id: %d | batch_size: %d", client_id, self._batch_size)
+
+        chunks = []
+        while self.decoded < self._batch_size:
+            chunk_size = len(self._chunk)
+            wanted = min(self._chunk_bets - chunk_size, self._batch_size - self.decoded)
+            self._start, malformed = parse_available_bets(self._view, self._start, self._end, wanted, self._chunk)
+            new_bets = len(self._chunk) - chunk_size
+            self.decoded += new_bets
+            if malformed:
+                raise ProtocolError(f"bet {self.decoded + 1} is malformed")
+
+            if len(self._chunk) == self._chunk_bets:
+                chunks.append(self._chunk)
+                self._chunk = BetBatch(self._chunk.agency)
+            elif new_bets < wanted:
+                # The next bet has not been completely received yet
+                break
+
+        if self.decoded == self._batch_size:
+            # Bytes after the last bet are ignored
+            self._start = self._end
+        elif self.done:
+            parse_bet_from_data(self._view[:self._end], self._start)
+            raise ProtocolError(f"bet {self.decoded + 1} is incomplete")
+        return chunks
+
+    def finish(self) -> BetBatch:
+        """
+        Return the last chunk, once the whole payload was received and decoded
+        """
+        if not self.done or self._batch_size is None or self.decoded < self._batch_size:
+            raise ProtocolError("batch was not completely received")
+        BETS_DECODED.inc(self.decoded)
+        BATCH_PARSE_SECONDS.observe(self._parse_time)
+        return self._chunk
+
+    def skip_rest(self) -> None:
+        """
+        Discard the rest of the payload, to skip a malformed batch
+        """
+        self._skipping = True
+
+class CompressedBetBatchDecoder:
+    """
+    Incremental decoder of the compressed payload of a batch message
+
+    Payload: uncompressed_length(4), then the batch payload compressed as a
+    single block of the negotiated codec. Compressed bytes are received
+    into a fixed size buffer and decompressed as they arrive straight into
+    the free space of a `BetBatchDecoder` of the uncompressed payload, so
+    neither payload is ever held as a whole. It has the same interface as
+    `BetBatchDecoder`.
+    """
+    def __init__(self, message_length: int, compression: int, max_payload_size: int,
+                 buffer_size: int = DEFAULT_RECV_BUFFER_SIZE, chunk_bets: int = DEFAULT_CHUNK_BETS):
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._remaining = message_length
+        self._header = b''
+        self._decompressor = new_decompressor(compression)
+        self._max_payload_size = max_payload_size
+        self._buffer_size = buffer_size
+        self._chunk_bets = chunk_bets
+        self._decoder = None
+        self._skipping = False
+        self._decompress_time = 0.0
+
+    @property
+    def done(self) -> bool:
+        """ Whether the whole compressed payload was received. """
+        return self._remaining == 0
+
+    @property
+    def decoded(self) -> int:
+        return self._decoder.decoded if self._decoder is not None else 0
+
+    def writable_view(self) -> memoryview:
+        """
+        Buffer for the compressed bytes yet to receive, every fed byte is consumed
+        """
+        return self._view[:min(len(self._buffer), self._remaining)]
+
+    def feed(self, received: int) -> list[BetBatch]:
+        """
+        Decompress and decode the bytes just received into `writable_view()`
+        """
+        self._remaining -= received
+        COMPRESSED_BYTES_RECEIVED.inc(received)
+        if self._skipping:
+            return []
+
+        data = self._view[:received]
+        if self._decoder is None:
+            missing = _UINT32.size - len(self._header)
+            self._header += bytes(data[:missing])
+            data = data[missing:]
+            if len(self._header) < _UINT32.size:
+                if self.done:
+                    raise ProtocolError("insufficient data for uncompressed length")
+                return []
+            uncompressed_length, = _UINT32.unpack(self._header)
+            if uncompressed_length > self._max_payload_size:
+                raise ProtocolError(f"uncompressed length {uncompressed_length} exceeds maximum {self._max_payload_size}")
+            self._decoder = BetBatchDecoder(uncompressed_length, self._buffer_size, self._chunk_bets)
+
+        chunks = self.__decompress(data)
+        if self.done and not (self._decompressor.eof and self._decoder.done):
+            raise ProtocolError("compressed batch is truncated")
+        return chunks
+
+    def __decompress(self, data) -> list[BetBatch]:
+        chunks = []
+        while data or self._decompressor.pending:
+            if self._decompressor.eof:
+                raise ProtocolError("data after the end of the compressed batch")
+            if self._decoder.done:
+                # Only the end of the compressed stream may be left
+                if self._decompressor.decompress(data, 1):
+                    raise ProtocolError("compressed batch is longer than its uncompressed length")
+                data = b''
+                continue
+
+            view = self._decoder.writable_view()
+            start = time.perf_counter()
+            try:
+                output = self._decompressor.decompress(data, len(view))
+            except Exception as e:
+                raise ProtocolError(f"failed to decompress batch: {e}")
+            finally:
+                self._decompress_time += time.perf_counter() - start
+            data = b''
+            view[:len(output)] = output
+            chunks.extend(self._decoder.feed(len(output)))
+        return chunks
+
+    def finish(self) -> BetBatch:
+        """
+        Return the last chunk, once the whole payload was received and decoded
+        """
+        if not self.done or self._decoder is None:
+            raise ProtocolError("batch was not completely received")
+        BATCH_DECOMPRESS_SECONDS.observe(self._decompress_time)
+        return self._decoder.finish()
+
+    def skip_rest(self) -> None:
+        """
+        Discard the rest of the compressed payload, to skip a malformed batch
+        """
+        self._skipping = True
+
+def encode_compressed_batch_payload(payload: bytes, compression: int, level: int = DEFAULT_ZLIB_LEVEL) -> bytes:
+    """
+    Compress the payload of a batch message as clients of a connection with compression do
+
+    Payload: uncompressed_length(4), then the payload compressed as a single block
+    """
+    return _UINT32.pack(len(payload)) + compress(compression, payload, level)
+
+def new_bet_batch_decoder(message_length: int, compression: int, max_payload_size: int,
+                          buffer_size: int = DEFAULT_RECV_BUFFER_SIZE):
+    """
+    Return the decoder of a batch payload, compressed with the given codec or not
+    """
+    if compression == COMPRESSION_NONE:
+        return BetBatchDecoder(message_length, buffer_size)
+    return CompressedBetBatchDecoder(message_length, compression, max_payload_size, buffer_size)
+
+def parse_bet_from_data(message_data, offset: int) -> Tuple[Optional[Tuple[str, str, str, str, str]], int]:
     try:
         original_offset = offset
         
@@ -100,42 +540,42 @@ def parse_bet_from_data(message_data: bytes, offset: int) -> Tuple[Optional[Tupl
         if offset + 4 > len(message_data):
             logging.error("action: parse_bet_from_data | result: fail | field: nombre_length | error: insufficient data")
             return None, original_offset
-        nombre_len = unpack_uint32_be(message_data[offset:offset+4])
+        nombre_len = _UINT32.unpack_from(message_data, offset)[0]
         offset += 4
 
         # Nombre
         if offset + nombre_len > len(message_data):
             logging.error(f"action: parse_bet_from_data | result: fail | field: nombre | expected_length: {nombre_len} | error: insufficient data")
             return None, original_offset
-        nombre = message_data[offset:offset+nombre_len].decode('utf-8')
+        nombre = str(message_data[offset:offset+nombre_len], 'utf-8')
         offset += nombre_len
 
         # Apellido length (4 bytes)
         if offset + 4 > len(message_data):
             logging.error("action: parse_bet_from_data | result: fail | field: apellido_length | error: insufficient data")
             return None, original_offset
-        apellido_len = unpack_uint32_be(message_data[offset:offset+4])
+        apellido_len = _UINT32.unpack_from(message_data, offset)[0]
         offset += 4
 
         # Apellido
         if offset + apellido_len > len(message_data):
             logging.error(f"action: parse_bet_from_data | result: fail | field: apellido | expected_length: {apellido_len} | error: insufficient data")
             return None, original_offset
-        apellido = message_data[offset:offset+apellido_len].decode('utf-8')
+        apellido = str(message_data[offset:offset+apellido_len], 'utf-8')
         offset += apellido_len
 
         # Documento (4 bytes)
         if offset + 4 > len(message_data):
             logging.error("action: parse_bet_from_data | result: fail | field: documento | error: insufficient data")
             return None, original_offset
-        documento = unpack_uint32_be(message_data[offset:offset+4])
+        documento = _UINT32.unpack_from(message_data, offset)[0]
         offset += 4
 
         # Nacimiento (4 bytes)
         if offset + 4 > len(message_data):
             logging.error("action: parse_bet_from_data | result: fail | field: nacimiento | error: insufficient data")
             return None, original_offset
-        nacimiento_int = unpack_uint32_be(message_data[offset:offset+4])
+        nacimiento_int = _UINT32.unpack_from(message_data, offset)[0]
         offset += 4
 
         year = nacimiento_int // 10000
@@ -147,7 +587,7 @@ def parse_bet_from_data(message_data: bytes, offset: int) -> Tuple[Optional[Tupl
         if offset + 4 > len(message_data):
             logging.error("action: parse_bet_from_data | result: fail | field: numero | error: insufficient data")
             return None, original_offset
-        numero = unpack_uint32_be(message_data[offset:offset+4])
+        numero = _UINT32.unpack_from(message_data, offset)[0]
         offset += 4
 
         return (nombre, apellido, str(documento), nacimiento, str(numero)), offset
@@ -162,14 +602,40 @@ def parse_bet_from_data(message_data: bytes, offset: int) -> Tuple[Optional[Tupl
         logging.error(f"action: parse_bet_from_data | result: fail | error: {e}")
         return None, original_offset
 
+_OK_RESPONSE = bytes([0, 0, 0, 1, RESPONSE_OK])
+_ERROR_RESPONSE = bytes([0, 0, 0, 1, RESPONSE_ERROR])
+
+def encode_response(success: bool) -> bytes:
+    """
+    Encode a response message
+
+    Protocol: total_message_length(4), response_code(1)
+    """
+    return _OK_RESPONSE if success else _ERROR_RESPONSE
+
+def encode_batch_ack(success: bool, sequence_number: int) -> bytes:
+    """
+    Encode the acknowledgement of sequenced batches
+
+    A successful ack is cumulative: every batch of the connection up to
+    sequence_number is stored, except the ones acked with an error.
+    Protocol: total_message_length(4), response_code(1), sequence_number(4)
+    """
+    return _BATCH_ACK.pack(_BATCH_ACK.size - 4, RESPONSE_OK if success else RESPONSE_ERROR, sequence_number)
+
+def encode_busy_response() -> bytes:
+    """
+    Encode the response sent instead of serving a connection when the server is at capacity
+
+    Protocol: total_message_length(4), response_code(1)
+    """
+    return pack_uint32_be(1) + bytes([RESPONSE_BUSY])
+
 def send_response(client_sock, success: bool) -> None:
     response_code = RESPONSE_OK if success else RESPONSE_ERROR
     try:
-        message_length = 1
-        message = pack_uint32_be(message_length) + bytes([response_code])
-        
-        send_all(client_sock, message)
-        logging.debug(f"action: send_response | result: success | response_code: {response_code}")
+        send_all(client_sock, encode_response(success))
+        logging.debug("action: send_response | result: success | response_code: %d", response_code)
     except Exception as e:
         logging.error(f"action: send_response | result: fail | response_code: {response_code} | error: {e}")
 
@@ -180,35 +646,29 @@ def receive_message_type(client_sock) -> Optional[int]:
         if not msg_type_bytes:
             return None
         msg_type = unpack_uint32_be(msg_type_bytes)
-        logging.debug(f"action: receive_message_type | result: success | message_type: {msg_type}")
+        logging.debug("action: receive_message_type | result: success | message_type: %d", msg_type)
         return msg_type
     except Exception as e:
         logging.error(f"action: receive_message_type | result: fail | error: {e}")
         return None
 
+def receive_sequence_number(client_sock) -> Optional[int]:
+    """Receive the sequence number (4 bytes) that precedes a sequenced batch"""
+    sequence_number_bytes = recv_all(client_sock, 4)
+    if not sequence_number_bytes:
+        return None
+    return unpack_uint32_be(sequence_number_bytes)
+
 def receive_finished_notification(client_sock) -> Optional[str]:
     """
     Receive finished notification message
     Protocol: total_message_length(4), client_id(4)
     """
     try:
-        message_length_bytes = recv_all(client_sock, 4)
-        if not message_length_bytes:
-            logging.error("action: receive_finished_notification | result: fail | field: message_length | error: failed to receive data")
-            return None
-        message_length = unpack_uint32_be(message_length_bytes)
-        
-        message_data = recv_all(client_sock, message_length)
-        if not message_data:
-            logging.error(f"action: receive_finished_notification | result: fail | field: message_data | expected_length: {message_length} | error: failed to receive data")
+        message_data = receive_message_data(client_sock, "receive_finished_notification", MAX_CLIENT_ID_MESSAGE_SIZE)
+        if message_data is None:
             return None
-        if len(message_data) != 4:
-            logging.error(f"action: receive_finished_notification | result: fail | field: client_id | expected_length: 4 | actual_length: {len(message_data)}")
-            return None
-        client_id = str(unpack_uint32_be(message_data))
-        
-        logging.debug(f"action: receive_finished_notification | result: success | client_id: {client_id}")
-        return client_id
+        return parse_client_id(message_data, "receive_finished_notification")
     except Exception as e:
         logging.error(f"action: receive_finished_notification | result: fail | error: {e}")
         return None
@@ -219,50 +679,178 @@ def receive_query_winners(client_sock) -> Optional[str]:
     Protocol: total_message_length(4), client_id(4)
     """
     try:
-        message_length_bytes = recv_all(client_sock, 4)
-        if not message_length_bytes:
-            logging.error("action: receive_query_winners | result: fail | field: message_length | error: failed to receive data")
+        message_data = receive_message_data(client_sock, "receive_query_winners", MAX_CLIENT_ID_MESSAGE_SIZE)
+        if message_data is None:
             return None
-        message_length = unpack_uint32_be(message_length_bytes)
-        
-        message_data = recv_all(client_sock, message_length)
-        if not message_data:
-            logging.error(f"action: receive_query_winners | result: fail | field: message_data | expected_length: {message_length} | error: failed to receive data")
+        return parse_client_id(message_data, "receive_query_winners")
+    except Exception as e:
+        logging.error(f"action: receive_query_winners | result: fail | error: {e}")
+        return None
+
+def receive_query_tallies(client_sock) -> Optional[str]:
+    """
+    Receive query tallies message
+    Protocol: total_message_length(4), client_id(4)
+    """
+    try:
+        message_data = receive_message_data(client_sock, "receive_query_tallies", MAX_CLIENT_ID_MESSAGE_SIZE)
+        if message_data is None:
             return None
-        
-        if len(message_data) != 4:
-            logging.error(f"action: receive_query_winners | result: fail | field: client_id | expected_length: 4 | actual_length: {len(message_data)}")
+        return parse_client_id(message_data, "receive_query_tallies")
+    except Exception as e:
+        logging.error(f"action: receive_query_tallies | result: fail | error: {e}")
+        return None
+
+def receive_lookup(client_sock) -> Optional[Tuple[str, int]]:
+    """
+    Receive lookup bets message, returning the looked up field and value
+    Protocol: total_message_length(4), field(4), value(4)
+    """
+    try:
+        message_data = receive_message_data(client_sock, "receive_lookup", MAX_LOOKUP_MESSAGE_SIZE)
+        if message_data is None:
             return None
-        client_id = str(unpack_uint32_be(message_data))
-        
-        logging.debug(f"action: receive_query_winners | result: success | client_id: {client_id}")
-        return client_id
+        return parse_lookup(message_data)
     except Exception as e:
-        logging.error(f"action: receive_query_winners | result: fail | error: {e}")
+        logging.error(f"action: receive_lookup | result: fail | error: {e}")
+        return None
+
+def parse_lookup(message_data: bytes) -> Optional[Tuple[str, int]]:
+    """
+    Parse the payload of a lookup bets message
+
+    Payload: field(4), value(4), where field is LOOKUP_FIELD_DOCUMENT or LOOKUP_FIELD_AGENCY
+    """
+    if len(message_data) != _LOOKUP.size:
+        logging.error(f"action: receive_lookup | result: fail | expected_length: {_LOOKUP.size} | actual_length: {len(message_data)}")
+        return None
+    field_id, value = _LOOKUP.unpack(message_data)
+    if field_id not in LOOKUP_FIELDS:
+        logging.error(f"action: receive_lookup | result: fail | error: unknown field: {field_id}")
+        return None
+
+    logging.debug("action: receive_lookup | result: success | field: %s | value: %d", LOOKUP_FIELDS[field_id], value)
+    return LOOKUP_FIELDS[field_id], value
+
+def encode_lookup_response(total: int, bets: list) -> bytes:
+    """
+    Encode a lookup bets response message, with the number of matching bets
+    and the ones sent back
+
+    Protocol: total_message_length(4), response_code(1), total_count(4),
+    bets_count(4), then bets_count bets, where each bet: agencia(4),
+    nombre_len(4), nombre, apellido_len(4), apellido, documento(4),
+    nacimiento(4) as YYYYMMDD, numero(4)
+    """
+    encoded = []
+    for bet in bets:
+        first_name = bet.first_name.encode('utf-8')
+        last_name = bet.last_name.encode('utf-8')
+        encoded.append(b''.join((_UINT32.pack(bet.agency), _UINT32.pack(len(first_name)), first_name,
+                                 _UINT32.pack(len(last_name)), last_name,
+                                 _BET_FIXED_FIELDS.pack(int(bet.document), pack_date(bet.birthdate), bet.number))))
+    payload = b''.join(encoded)
+    return _LOOKUP_HEADER.pack(_LOOKUP_HEADER.size - 4 + len(payload), RESPONSE_OK, total, len(bets)) + payload
+
+def receive_compression_offer(client_sock) -> Optional[list[int]]:
+    """
+    Receive compression negotiation message
+    Protocol: total_message_length(4), then one codec id(1) per codec the
+    client can compress with, in its order of preference
+    """
+    try:
+        message_data = receive_message_data(client_sock, "receive_compression_offer", MAX_COMPRESSION_OFFER_SIZE)
+        if message_data is None:
+            return None
+        return list(message_data)
+    except Exception as e:
+        logging.error(f"action: receive_compression_offer | result: fail | error: {e}")
+        return None
+
+def encode_compression_response(codec: int) -> bytes:
+    """
+    Encode the codec chosen for the batches of the connection, COMPRESSION_NONE if none
+
+    Protocol: total_message_length(4), response_code(1), codec(1)
+    """
+    return _COMPRESSION_RESPONSE.pack(_COMPRESSION_RESPONSE.size - 4, RESPONSE_OK, codec)
+
+def parse_client_id(message_data: bytes, action: str) -> Optional[str]:
+    """
+    Parse the payload of a message that only carries the client id
+
+    Payload: client_id(4)
+    """
+    if len(message_data) != 4:
+        logging.error(f"action: {action} | result: fail | field: client_id | expected_length: 4 | actual_length: {len(message_data)}")
         return None
+    client_id = str(unpack_uint32_be(message_data))
+
+    logging.debug("action: %s | result: success | client_id: %s", action, client_id)
+    return client_id
 
 def pack_uint32_be(value: int) -> bytes:
     """Pack a 4-byte big-endian unsigned integer to bytes"""
     return bytes([(value >> 24) & 0xFF, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF])
 
-def send_winners(client_sock, winners: list[str]) -> None:
+def encode_tallies(tallies: list) -> bytes:
+    """
+    Encode a tallies response message, from (agency, bets, winners) tallies
+
+    Protocol: total_message_length(4), response_code(1), agencies_count(4),
+    then agencies_count triples of agency(4), bets(4), winners(4)
+    """
+    rows = b''.join(_TALLY.pack(*tally) for tally in tallies)
+    return _WINNERS_HEADER.pack(1 + 4 + len(rows), RESPONSE_OK, len(tallies)) + rows
+
+def encode_winners(winners: list, tiered: bool = False) -> bytes:
+    """
+    Encode a winners response message
+
+    Protocol: total_message_length(4), response_code(1), winners_count(4),
+    then winners_count number of documents(4)
+    Tiered protocol, for (document, tier) winners: total_message_length(4),
+    response_code(1), winners_count(4), then winners_count pairs of document(4), tier(4)
+    """
+    return b''.join(encode_winners_chunks(winners, tiered=tiered))
+
+def encode_winners_chunks(winners: list, chunk_size: int = WINNERS_CHUNK_SIZE, tiered: bool = False) -> Iterator[bytes]:
+    """
+    Encode a winners response message as its header followed by chunks of
+    at most chunk_size winners, each packed with a single array conversion
+    """
+    fields = 2 if tiered else 1
+    yield _WINNERS_HEADER.pack(1 + 4 + len(winners) * 4 * fields, RESPONSE_OK, len(winners))
+    for start in range(0, len(winners), chunk_size):
+        chunk = winners[start:start + chunk_size]
+        if tiered:
+            values = array('I', bytes(len(chunk) * 8))
+            values[0::2] = array('I', (int(document) for document, _ in chunk))
+            values[1::2] = array('I', (tier for _, tier in chunk))
+        else:
+            values = array('I', map(int, chunk))
+        if not _NATIVE_BIG_ENDIAN:
+            values.byteswap()
+        yield memoryview(values).cast('B')
+
+def send_winners(client_sock, winners: list, tiered: bool = False) -> None:
+    """
+    Send a winners response, streaming large winner lists chunk by chunk
+    """
+    chunks = encode_winners_chunks(winners, tiered=tiered)
+    sent_any = False
     try:
-        message_length = 1 + 4 + (len(winners) * 4)
-        winners_count = len(winners)
-        
-        message = pack_uint32_be(message_length) + bytes([RESPONSE_OK])        
-        message += pack_uint32_be(winners_count)        
-        for winner_documento in winners:
-            documento_int = int(winner_documento)
-            message += pack_uint32_be(documento_int)
-        
-        send_all(client_sock, message)
-        logging.debug(f"action: send_winners | result: success | winners_count: {winners_count}")
+        # The header goes out in the same write as the first chunk
+        send_buffers(client_sock, [next(chunks), next(chunks, b'')])
+        sent_any = True
+        for chunk in chunks:
+            send_all(client_sock, chunk)
+        logging.debug("action: send_winners | result: success | winners_count: %d", len(winners))
     except Exception as e:
         logging.error(f"action: send_winners | result: fail | error: {e}")
+        if sent_any:
+            return
         try:
-            error_message_length = 1
-            error_message = pack_uint32_be(error_message_length) + bytes([RESPONSE_ERROR])
-            send_all(client_sock, error_message)
+            send_all(client_sock, encode_response(False))
         except:
             pass
@@ -1,55 +1,85 @@
 import socket
 import logging
+import queue
 import signal
 import sys
 import threading
-from .utils import Bet, store_bets, load_bets, has_won
-from .protocol import receive_bet_batch, send_response, receive_message_type, receive_finished_notification, receive_query_winners, send_winners, MESSAGE_TYPE_BATCH, MESSAGE_TYPE_FINISHED_SENDING, MESSAGE_TYPE_QUERY_WINNERS
+import time
+from .logs import log_batch_received
+from .lottery import Lottery
+from .pipelining import BatchAcker
+from .metrics import CONNECTED_CLIENTS, CONNECTIONS_REJECTED, WINNERS_QUERY_SECONDS
+from .winners import load_winners_index
+from .compression import choose_codec, COMPRESSION_NONE
+from .protocol import receive_bet_batch_stream, receive_sequence_number, send_all, send_response, encode_busy_response, receive_message_type, receive_finished_notification, receive_query_winners, receive_query_tallies, receive_lookup, encode_lookup_response, receive_compression_offer, encode_compression_response, MESSAGE_TYPE_BATCH, MESSAGE_TYPE_FINISHED_SENDING, MESSAGE_TYPE_QUERY_WINNERS, MESSAGE_TYPE_QUERY_TIERED_WINNERS, MESSAGE_TYPE_SEQUENCED_BATCH, MESSAGE_TYPE_NEGOTIATE_COMPRESSION, MESSAGE_TYPE_QUERY_TALLIES, MESSAGE_TYPE_LOOKUP_BETS, MAX_LOOKUP_BETS, ProtocolError, MessageTooLargeError
 
 
 class Server:
-    def __init__(self, port, listen_backlog, num_agencies):
+    """
+    Server engine that serves client connections from a fixed pool of handler threads
+
+    Accepted connections wait for a free handler in a queue of at most
+    `accept_queue_size` connections. Connections beyond that get a busy
+    response and are closed right away. A handler serves a connection
+    until the client disconnects, so `max_clients` must not be lower than
+    the number of agencies: agencies waiting for the draw keep their
+    handler. A client that sends nothing for `idle_timeout` seconds is
+    disconnected, which also frees handlers blocked in the middle of a message.
+
+    Sequenced batches are acked by a `BatchAcker` of the connection, with
+    up to `max_in_flight_batches` of them stored while the next ones are received.
+    A connection may negotiate one of `compression_codecs` for its batches.
+    `on_ready` is called once the server accepts connections.
+    """
+    def __init__(self, port, listen_backlog, num_agencies, storage_writer, max_message_size, lottery=None, winners_index=None, reuse_port=False,
+                 max_clients=32, accept_queue_size=16, idle_timeout=None, max_in_flight_batches=32, on_ready=None, compression_codecs=()):
         # Initialize server socket
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Let every worker process bind its own socket to the port
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._server_socket.bind(('', port))
         self._server_socket.listen(listen_backlog)
         self._running = True
+        self._serving = False
+        self._max_message_size = max_message_size
         
-        self._finished_agencies = set()
-        self._lottery_done = False
-        self._num_agencies = num_agencies
+        self._lottery = lottery or Lottery(num_agencies)
+        self._storage_writer = storage_writer
+        self._winners_index = winners_index or load_winners_index(storage_writer.storage)
+        self._lottery.add_draw_hook(self._winners_index.publish)
         
+        self._max_clients = max_clients
+        self._idle_timeout = idle_timeout
+        self._max_in_flight_batches = max_in_flight_batches
+        self._on_ready = on_ready
+        self._compression_codecs = tuple(compression_codecs)
+        self._pending_clients = queue.Queue(maxsize=accept_queue_size)
         self._client_threads = []
         self._client_sockets = []
-        self._storage_lock = threading.Lock()
-        self._finished_agencies_lock = threading.Lock()
-        self._lottery_lock = threading.Lock()
         self._client_sockets_lock = threading.Lock()
-        self._lottery_condition = threading.Condition(self._lottery_lock)
         
         signal.signal(signal.SIGTERM, self._signal_handler)
 
     def _signal_handler(self, sig, frame):
         logging.info("action: sigterm_received | result: success")
         self._running = False
+        if not self._serving:
+            # Received while starting: run() stops before serving connections
+            return
         
-        with self._lottery_condition:
-            self._lottery_condition.notify_all()
+        self._lottery.cancel()
         
         if self._server_socket:
             logging.info("action: close_server_socket | result: success")
             self._server_socket.shutdown(socket.SHUT_RDWR)
             self._server_socket.close()
         
-        with self._client_sockets_lock:
-            for client_sock in self._client_sockets:
-                client_sock.shutdown(socket.SHUT_RDWR)
-                client_sock.close()
+        self.__shutdown_client_sockets()
+        self.__stop_handlers()
 
-        for thread in self._client_threads:
-            if thread.is_alive():
-                thread.join()
+        self._storage_writer.stop()
         
         logging.info("action: server_shutdown | result: success")
         sys.exit(0)
@@ -58,26 +88,20 @@ class Server:
         """
         Server loop that accepts connections and handles them in parallel using threads
 
-        Server that accepts new connections and creates a new thread to handle
-        each client connection in parallel.
+        Server that accepts new connections and hands each one to the pool
+        of handler threads, which serve the client connections in parallel.
         """
 
         try:
+            self._storage_writer.start()
+            self.__start_handlers()
+            self._serving = True
+            if self._running and self._on_ready:
+                self._on_ready()
             while self._running:
                 try:
                     client_sock = self.__accept_new_connection()
-                    with self._client_sockets_lock:
-                        self._client_sockets.append(client_sock)
-                    
-                    client_thread = threading.Thread(
-                        target=self.__handle_client_connection,
-                        args=(client_sock,),
-                        daemon=True
-                    )
-                    
-                    self._client_threads.append(client_thread)
-                    client_thread.start()
-                    self._client_threads = [t for t in self._client_threads if t.is_alive()]
+                    self.__admit(client_sock)
                     
                 except OSError as e:
                     if self._running:
@@ -90,13 +114,76 @@ class Server:
                 logging.info("action: close_server_socket | result: success")
                 self._server_socket.close()
             
+            self.__shutdown_client_sockets()
+            self.__stop_handlers()
+
+            self._storage_writer.stop()
+
+    def __start_handlers(self):
+        for i in range(self._max_clients):
+            thread = threading.Thread(target=self.__handle_clients, name=f"client-handler-{i}", daemon=True)
+            thread.start()
+            self._client_threads.append(thread)
+
+    def __shutdown_client_sockets(self):
+        """
+        Wake up the handlers blocked on their connections, which close them
+        """
+        with self._client_sockets_lock:
+            for client_sock in self._client_sockets:
+                try:
+                    client_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    # The client already closed it
+                    pass
+
+    def __stop_handlers(self):
+        with self._client_sockets_lock:
+            threads, self._client_threads = self._client_threads, []
+        if not threads:
+            return
+
+        # Connections still waiting for a handler are dropped
+        while True:
+            try:
+                client_sock = self._pending_clients.get_nowait()
+            except queue.Empty:
+                break
+            if client_sock is not None:
+                client_sock.close()
+
+        for _ in threads:
+            self._pending_clients.put(None)
+        for thread in threads:
+            thread.join()
+
+    def __admit(self, client_sock):
+        """
+        Queue a new connection for the handler pool, or answer busy if the queue is full
+        """
+        client_sock.settimeout(self._idle_timeout)
+        try:
+            self._pending_clients.put_nowait(client_sock)
+        except queue.Full:
+            CONNECTIONS_REJECTED.inc()
+            logging.warning("action: admit_connection | result: fail | error: server busy")
+            try:
+                send_all(client_sock, encode_busy_response())
+            except OSError:
+                pass
+            client_sock.close()
+
+    def __handle_clients(self):
+        while True:
+            client_sock = self._pending_clients.get()
+            if client_sock is None:
+                return
             with self._client_sockets_lock:
-                for client_sock in self._client_sockets:
+                if not self._running:
                     client_sock.close()
-            
-            for thread in self._client_threads:
-                if thread.is_alive():
-                    thread.join()
+                    continue
+                self._client_sockets.append(client_sock)
+            self.__handle_client_connection(client_sock)
 
     def __handle_client_connection(self, client_sock):
         """
@@ -104,19 +191,44 @@ class Server:
         Keep the connection open until client disconnects or an error occurs
         """
         client_addr = client_sock.getpeername()
+        CONNECTED_CLIENTS.inc()
+        acker = None
+        agencies = set()
+        compression = COMPRESSION_NONE
         try:
             while True:
                 msg_type = receive_message_type(client_sock)
                 if msg_type is None:
-                    logging.debug(f"action: client_disconnected | result: success | ip: {client_addr[0]}")
+                    logging.debug("action: client_disconnected | result: success | ip: %s", client_addr[0])
                     break
+
+                if msg_type == MESSAGE_TYPE_SEQUENCED_BATCH:
+                    if acker is None:
+                        acker = BatchAcker(client_sock, self._winners_index, self._max_in_flight_batches)
+                    sequence_number = receive_sequence_number(client_sock)
+                    if sequence_number is None:
+                        break
+                    self.__handle_bet_batch(client_sock, acker, sequence_number, compression, agencies)
+                    continue
+
+                if acker is not None:
+                    # Replies to other messages go after the acks of the batches sent before them
+                    acker.drain()
                     
                 if msg_type == MESSAGE_TYPE_BATCH:
-                    self.__handle_bet_batch(client_sock)
+                    self.__handle_bet_batch(client_sock, compression=compression)
                 elif msg_type == MESSAGE_TYPE_FINISHED_SENDING:
                     self.__handle_finished_notification(client_sock)
                 elif msg_type == MESSAGE_TYPE_QUERY_WINNERS:
                     self.__handle_query_winners(client_sock)
+                elif msg_type == MESSAGE_TYPE_QUERY_TIERED_WINNERS:
+                    self.__handle_query_winners(client_sock, tiered=True)
+                elif msg_type == MESSAGE_TYPE_QUERY_TALLIES:
+                    self.__handle_query_tallies(client_sock)
+                elif msg_type == MESSAGE_TYPE_LOOKUP_BETS:
+                    self.__handle_lookup_bets(client_sock)
+                elif msg_type == MESSAGE_TYPE_NEGOTIATE_COMPRESSION:
+                    compression = self.__negotiate_compression(client_sock, compression)
                 else:
                     logging.error(f"action: handle_client_connection | result: fail | error: unknown message type: {msg_type}")
                     send_response(client_sock, False)
@@ -125,64 +237,91 @@ class Server:
         except Exception as e:
             logging.error(f"action: handle_client_connection | result: fail | error: {e}")
         finally:
-            logging.info("action: close_client_socket | result: success")
-            client_sock.close()
+            if acker is not None:
+                acker.close()
+            for agency in agencies:
+                self._lottery.release_agency(agency)
+            CONNECTED_CLIENTS.dec()
             with self._client_sockets_lock:
                 if client_sock in self._client_sockets:
                     self._client_sockets.remove(client_sock)
+            logging.info("action: close_client_socket | result: success")
+            client_sock.close()
 
-    def __handle_bet_batch(self, client_sock):
+    def __handle_bet_batch(self, client_sock, acker=None, sequence_number=None, compression=COMPRESSION_NONE, agencies=None):
         """
         Read batch bet data from client and store it
+
+        Bets are decoded in chunks as they arrive, and the batch is handed
+        to the storage writer whole once its last bet is decoded, so it is
+        stored atomically: a malformed batch, or one cut off by the
+        connection, stores none of its bets. Memory per connection is
+        bounded by the maximum message size.
+
+        A sequenced batch is answered by `acker` instead, which waits for
+        it to be stored while the next batch is received. Its agency is
+        acquired from the lottery the first time, and added to agencies for
+        the connection to release it.
         """
+        cantidad = 0
         try:
-            batch_data = receive_bet_batch(client_sock)
-            if batch_data is not None:
-                client_id, bets_data = batch_data
-                cantidad = len(bets_data)
-                
-                try:
-                    bets = []
-                    for bet_data in bets_data:
-                        nombre, apellido, documento, nacimiento, numero = bet_data
-                        bet = Bet(client_id, nombre, apellido, documento, nacimiento, numero)
-                        bets.append(bet)
-                    
-                    with self._storage_lock:
-                        store_bets(bets)
-                    
-                    logging.info(f'action: apuesta_recibida | result: success | cantidad: {cantidad}')
-                    
-                    send_response(client_sock, True)
-                    return
-                    
-                except Exception as batch_error:
-                    logging.info(f'action: apuesta_recibida | result: fail | cantidad: {cantidad}')
-                    send_response(client_sock, False)
-                    return
-            else:
-                # No batch data
-                send_response(client_sock, False)
-                return
+            batch = None
+            for chunk in receive_bet_batch_stream(client_sock, self._max_message_size, compression=compression):
+                if batch is None:
+                    batch = chunk
+                else:
+                    batch.extend(chunk)
+                cantidad += len(chunk)
+            in_flight = None
+            if cantidad:
+                if sequence_number is not None and batch.agency not in agencies:
+                    self._lottery.acquire_agency(batch.agency)
+                    agencies.add(batch.agency)
+                in_flight = batch, self._storage_writer.submit(batch, sequence_number)
+            if acker is None and in_flight is not None:
+                self.__wait_stored(*in_flight)
 
+        except MessageTooLargeError as e:
+            logging.error(f"action: receive_bet_batch | result: fail | error: {e}")
+            self.__reject_bet_batch(client_sock, acker, sequence_number)
+            raise
+        except OSError:
+            # Timed out or broken connection, it cannot be answered
+            raise
+        except ProtocolError as e:
+            logging.error(f"action: receive_bet_batch | result: fail | error: {e}")
+            logging.info('action: apuesta_recibida | result: fail | cantidad: %d', cantidad)
+            self.__reject_bet_batch(client_sock, acker, sequence_number)
+            return
         except Exception as e:
             logging.error(f"action: receive_message | result: fail | error: {e}")
+            logging.info('action: apuesta_recibida | result: fail | cantidad: %d', cantidad)
+            self.__reject_bet_batch(client_sock, acker, sequence_number)
+            return
+
+        if acker is not None:
+            acker.submit(sequence_number, in_flight, cantidad)
+            return
+
+        log_batch_received(cantidad)
+        send_response(client_sock, True)
+
+    def __reject_bet_batch(self, client_sock, acker, sequence_number):
+        if acker is None:
             send_response(client_sock, False)
+        else:
+            acker.submit_error(sequence_number)
+
+    def __wait_stored(self, batch, future):
+        if future.result():
+            self._winners_index.add_batch(batch)
 
     def __handle_finished_notification(self, client_sock):
         try:
             client_id = receive_finished_notification(client_sock)
             if client_id is not None:
-                with self._finished_agencies_lock:
-                    self._finished_agencies.add(client_id)
-                    logging.debug(f"action: finished_notification_received | result: success | client_id: {client_id} | finished_agencies: {len(self._finished_agencies)}")
-                    
-                    with self._lottery_condition:
-                        if len(self._finished_agencies) == self._num_agencies and not self._lottery_done:
-                            self._lottery_done = True
-                            logging.info("action: sorteo | result: success")
-                            self._lottery_condition.notify_all()
-            
+                self._storage_writer.record_finished(client_id)
+                self._lottery.mark_finished(client_id)
                 send_response(client_sock, True)
             else:
                 send_response(client_sock, False)
@@ -191,20 +330,39 @@ class Server:
             logging.error(f"action: handle_finished_notification | result: fail | error: {e}")
             send_response(client_sock, False)
 
-    def __handle_query_winners(self, client_sock):
+    def __negotiate_compression(self, client_sock, compression):
+        """
+        Choose the codec of the following batches of the connection among
+        the ones offered by the client, and answer it
+        """
+        offered = receive_compression_offer(client_sock)
+        if offered is None:
+            send_response(client_sock, False)
+            return compression
+        compression = choose_codec(offered, self._compression_codecs)
+        send_all(client_sock, encode_compression_response(compression))
+        logging.debug("action: negotiate_compression | result: success | codec: %s", compression)
+        return compression
+
+    def __handle_query_winners(self, client_sock, tiered=False):
+        """
+        Answer the winners of an agency once the draw is done, as documents,
+        or as (document, tier) pairs if tiered
+
+        The response is the one published by the winners index at the draw,
+        sent as is.
+        """
         try:
             client_id = receive_query_winners(client_sock)
             if client_id is not None:
-                with self._lottery_condition:
-                    while not self._lottery_done and self._running:
-                        self._lottery_condition.wait()
-                    
-                    if not self._running:
-                        send_response(client_sock, False)
-                        return
+                if not self._lottery.wait():
+                    send_response(client_sock, False)
+                    return
             
-                winners = self.__get_winners_for_agency(client_id)
-                send_winners(client_sock, winners)
+                start = time.perf_counter()
+                send_all(client_sock, self._winners_index.winners_response(client_id, tiered))
+                WINNERS_QUERY_SECONDS.observe(time.perf_counter() - start)
+                logging.debug("action: send_winners | result: success | agency_id: %s", client_id)
                 
             else:
                 send_response(client_sock, False)
@@ -213,20 +371,42 @@ class Server:
             logging.error(f"action: handle_query_winners | result: fail | error: {e}")
             send_response(client_sock, False)
 
-    def __get_winners_for_agency(self, agency_id: str) -> list[str]:
+    def __handle_query_tallies(self, client_sock):
+        """
+        Answer the running bets and winners of every agency, without
+        waiting for the draw nor reading the storage
+
+        With several workers, the lottery gathers them from every worker.
+        """
         try:
-            winners = []
-            with self._storage_lock:
-                for bet in load_bets():
-                    if str(bet.agency) == agency_id and has_won(bet):
-                        winners.append(bet.document)
-            
-            logging.debug(f"action: get_winners_for_agency | result: success | agency_id: {agency_id} | winners_count: {len(winners)}")
-            return winners
-            
+            client_id = receive_query_tallies(client_sock)
+            if client_id is None:
+                send_response(client_sock, False)
+                return
+            send_all(client_sock, self._lottery.tallies_response(self._winners_index))
+            logging.debug("action: send_tallies | result: success | agency_id: %s", client_id)
+        except Exception as e:
+            logging.error(f"action: handle_query_tallies | result: fail | error: {e}")
+            send_response(client_sock, False)
+
+    def __handle_lookup_bets(self, client_sock):
+        """
+        Answer the stored bets with a document, or of an agency, from the
+        indexes of the storage, or of every worker's storage through the
+        lottery
+        """
+        try:
+            lookup = receive_lookup(client_sock)
+            if lookup is None:
+                send_response(client_sock, False)
+                return
+            field, value = lookup
+            total, bets = self._lottery.find_bets(self._storage_writer.storage, field, value, MAX_LOOKUP_BETS)
+            send_all(client_sock, encode_lookup_response(total, bets))
+            logging.debug("action: lookup_bets | result: success | field: %s | value: %s | cantidad: %s", field, value, total)
         except Exception as e:
-            logging.error(f"action: get_winners_for_agency | result: fail | agency_id: {agency_id} | error: {e}")
-            return []
+            logging.error(f"action: handle_lookup_bets | result: fail | error: {e}")
+            send_response(client_sock, False)
 
     def __accept_new_connection(self):
         """
@@ -239,5 +419,5 @@ class Server:
         # Connection arrived
         logging.info('action: accept_connections | result: in_progress')
         c, addr = self._server_socket.accept()
-        logging.info(f'action: accept_connections | result: success | ip: {addr[0]}')
+        logging.info('action: accept_connections | result: success | ip: %s', addr[0])
         return c
@@ -0,0 +1,448 @@
+import itertools
+import logging
+import multiprocessing
+import signal
+import threading
+from multiprocessing.connection import wait
+from typing import Callable, Tuple
+from .lottery import Lottery
+from .protocol import encode_tallies
+
+
+_FINISHED = "finished"
+_COLLECT_WINNERS = "collect_winners"
+_WINNERS = "winners"
+_DRAW = "draw"
+_READY = "ready"
+_ACQUIRE = "acquire"
+_GRANT = "grant"
+_RELEASE = "release"
+_FIND_BETS = "find_bets"
+_FIND_SHARD_BETS = "find_shard_bets"
+_SHARD_BETS = "shard_bets"
+_QUERY_TALLIES = "query_tallies"
+_COLLECT_TALLIES = "collect_tallies"
+_TALLIES = "tallies"
+_RESPONSE = "response"
+
+
+class ShardLottery(Lottery):
+    """
+    Lottery of a worker process, whose barrier is held by the coordinator
+
+    Finished notifications are forwarded to the coordinator through the
+    worker pipe. When every agency finished, the coordinator collects the
+    winners and bet counts indexed by each worker, and sends them back
+    merged with the draw, so a worker can answer for agencies whose bets it
+    did not store.
+
+    Sequenced batches of an agency are stored by one worker at a time: the
+    coordinator grants an agency to a worker along with the last sequence
+    number stored for it by any worker, and the worker hands that number
+    back when it releases the agency, so retried batches are deduplicated
+    whichever worker their connection lands on.
+
+    Lookups, and the tallies before the draw, are gathered by the
+    coordinator from every worker, since each one only stored its share
+    of the bets.
+    """
+    def __init__(self, conn):
+        super().__init__(num_agencies=0)
+        self._conn = conn
+        self._send_lock = threading.Lock()
+        self._winners_index = None
+        self._storage_writer = None
+        # Connections holding each agency, and whether the coordinator granted it
+        self._agencies = {}
+        self._request_ids = itertools.count()
+        # Answers of the coordinator by request id, until their requester takes them
+        self._responses = {}
+
+    def start(self, winners_index, storage_writer=None) -> None:
+        """
+        Start listening to the coordinator, answering with the given index
+        and keeping the sequence numbers of storage_writer
+        """
+        self._winners_index = winners_index
+        self._storage_writer = storage_writer
+        threading.Thread(target=self.__listen, name="shard-lottery", daemon=True).start()
+
+    def notify_ready(self) -> None:
+        """
+        Tell the coordinator that the server of this worker accepts
+        connections, along with the sequence numbers it recovered
+        """
+        self.__send(_READY, self.__sequence_numbers())
+
+    def acquire_agency(self, agency: int) -> None:
+        """
+        Block until the coordinator grants the agency to this worker
+
+        Raises ConnectionAbortedError if the lottery is cancelled meanwhile.
+        """
+        with self._condition:
+            held = self._agencies.get(agency)
+            if held is None:
+                held = self._agencies[agency] = [0, False]
+                self.__send(_ACQUIRE, agency)
+            held[0] += 1
+            while not held[1] and not self._cancelled:
+                self._condition.wait()
+            if not held[1]:
+                self.__release(agency)
+                raise ConnectionAbortedError("the server is shutting down")
+
+    def release_agency(self, agency: int) -> None:
+        with self._condition:
+            self.__release(agency)
+
+    def __release(self, agency):
+        held = self._agencies[agency]
+        held[0] -= 1
+        if held[0]:
+            return
+        del self._agencies[agency]
+        if held[1]:
+            self.__send(_RELEASE, (agency, self.__sequence_numbers().get(agency, 0)))
+
+    def __grant(self, agency, sequence_number):
+        with self._condition:
+            held = self._agencies.get(agency)
+            if held is None:
+                # Every connection that asked for it is gone
+                self.__send(_RELEASE, (agency, sequence_number))
+                return
+            if self._storage_writer is not None:
+                self._storage_writer.advance_sequence_number(agency, sequence_number)
+            held[1] = True
+            self._condition.notify_all()
+
+    def find_bets(self, storage, field: str, value: int, limit: int) -> Tuple[int, list]:
+        """
+        Return the number of bets stored by every worker whose field has the
+        given value, and the first limit of them
+
+        Raises ConnectionAbortedError if the lottery is cancelled meanwhile,
+        or a worker could not answer.
+        """
+        return self.__request(_FIND_BETS, (field, value, limit))
+
+    def tallies_response(self, winners_index) -> bytes:
+        """
+        Return the encoded running tallies of the bets of every worker
+
+        Once the draw is done, winners_index holds the merged bets and
+        winners of every worker.
+        """
+        if self.done:
+            return winners_index.tallies_response()
+        return encode_tallies(self.__request(_QUERY_TALLIES, None))
+
+    def __request(self, command, payload):
+        with self._condition:
+            request_id = next(self._request_ids)
+            self.__send(command, (request_id, payload))
+            while request_id not in self._responses and not self._cancelled:
+                self._condition.wait()
+            response = self._responses.pop(request_id, None)
+        if response is None:
+            raise ConnectionAbortedError("the workers could not answer")
+        return response
+
+    def __respond(self, request_id, response):
+        with self._condition:
+            if not self._cancelled:
+                self._responses[request_id] = response
+                self._condition.notify_all()
+
+    def __find_shard_bets(self, field, value, limit):
+        if self._storage_writer is None:
+            return 0, []
+        try:
+            return self._storage_writer.storage.find_bets(field, value, limit)
+        except Exception as e:
+            logging.error(f"action: find_shard_bets | result: fail | error: {e}")
+            return None
+
+    def __sequence_numbers(self) -> dict:
+        return self._storage_writer.sequence_numbers() if self._storage_writer is not None else {}
+
+    def mark_finished(self, agency_id: str) -> None:
+        logging.debug(f"action: finished_notification_received | result: success | client_id: {agency_id}")
+        self.__send(_FINISHED, agency_id)
+
+    def __send(self, command, payload) -> None:
+        with self._send_lock:
+            self._conn.send((command, payload))
+
+    def __listen(self):
+        while True:
+            try:
+                command, payload = self._conn.recv()
+            except (EOFError, OSError):
+                # The coordinator is gone, the draw will not take place
+                self.cancel()
+                return
+
+            if command == _COLLECT_WINNERS:
+                self.__send(_WINNERS, (self._winners_index.snapshot(), self._winners_index.bet_counts()))
+            elif command == _DRAW:
+                winners, bets = payload
+                self._winners_index.replace(winners, bets)
+                self.draw()
+            elif command == _GRANT:
+                self.__grant(*payload)
+            elif command == _FIND_SHARD_BETS:
+                request_id, lookup = payload
+                self.__send(_SHARD_BETS, (request_id, self.__find_shard_bets(*lookup)))
+            elif command == _COLLECT_TALLIES:
+                self.__send(_TALLIES, (payload, self._winners_index.tallies()))
+            elif command == _RESPONSE:
+                self.__respond(*payload)
+
+
+class ShardCoordinator:
+    """
+    Finished agencies count and lottery barrier shared by the worker processes
+
+    Runs in the parent process, reading the pipe of every worker until all
+    of them exit. `on_ready` is called once every worker accepts connections.
+
+    It also grants each agency to one worker at a time, with the last
+    sequence number stored for it by any worker. Nothing is granted until
+    every worker reported the sequence numbers it recovered.
+
+    Lookups and tallies asked by a worker are forwarded to every worker,
+    and their answers merged back to it. Tallies asked after the draw are
+    answered from the merged bets and winners.
+    """
+    def __init__(self, num_agencies: int, conns: list, on_ready: Callable = None):
+        self._num_agencies = num_agencies
+        self._conns = list(conns)
+        self._on_ready = on_ready
+        self._pending_ready = len(self._conns)
+        self._finished_agencies = set()
+        self._pending_winners = None
+        self._winners = {}
+        self._bets = {}
+        self._sequence_numbers = {}
+        self._agency_owners = {}
+        self._agency_waiters = {}
+        self._gather_ids = itertools.count()
+        # Requests being gathered from the workers by gather id
+        self._gathers = {}
+
+    def run(self) -> None:
+        while self._conns:
+            for conn in wait(self._conns):
+                try:
+                    command, payload = conn.recv()
+                except (EOFError, OSError):
+                    self.__remove(conn)
+                    continue
+
+                if command == _FINISHED:
+                    self.__handle_finished(payload)
+                elif command == _WINNERS:
+                    self.__handle_winners(conn, payload)
+                elif command == _READY:
+                    self.__handle_ready(payload)
+                elif command == _ACQUIRE:
+                    self._agency_waiters.setdefault(payload, []).append(conn)
+                    self.__grant(payload)
+                elif command == _RELEASE:
+                    self.__handle_release(conn, *payload)
+                elif command == _FIND_BETS:
+                    request_id, lookup = payload
+                    self.__gather(conn, request_id, _FIND_SHARD_BETS, lookup, _merge_found_bets(lookup[2]))
+                elif command == _QUERY_TALLIES:
+                    self.__handle_query_tallies(conn, payload[0])
+                elif command in (_SHARD_BETS, _TALLIES):
+                    self.__handle_gathered(conn, *payload)
+
+    def __handle_query_tallies(self, conn, request_id):
+        if self._pending_winners is not None and not self._pending_winners:
+            # Drawn: every worker already holds the merged bets and winners
+            tallies = _merge_tallies([[(int(agency_id), bets, 0) for agency_id, bets in self._bets.items()],
+                                      [(int(agency_id), 0, len(winners)) for agency_id, winners in self._winners.items()]])
+            self.__send(conn, _RESPONSE, (request_id, tallies))
+            return
+        self.__gather(conn, request_id, _COLLECT_TALLIES, None, _merge_tallies)
+
+    def __gather(self, conn, request_id, command, payload, merge):
+        gather_id = next(self._gather_ids)
+        self._gathers[gather_id] = (conn, request_id, set(self._conns), [], merge)
+        for worker in self._conns:
+            self.__send(worker, command, gather_id if payload is None else (gather_id, payload))
+
+    def __handle_gathered(self, conn, gather_id, answer):
+        gather = self._gathers.get(gather_id)
+        if gather is None:
+            return
+        _, _, pending, answers, _ = gather
+        pending.discard(conn)
+        answers.append(answer)
+        self.__answer_if_gathered(gather_id)
+
+    def __answer_if_gathered(self, gather_id):
+        requester, request_id, pending, answers, merge = self._gathers[gather_id]
+        if pending:
+            return
+        del self._gathers[gather_id]
+        # A worker that failed or exited leaves the answer incomplete, answered as a failure
+        self.__send(requester, _RESPONSE, (request_id, None if None in answers else merge(answers)))
+
+    def __handle_ready(self, sequence_numbers):
+        self.__merge_sequence_numbers(sequence_numbers)
+        self._pending_ready -= 1
+        if self._pending_ready:
+            return
+        for agency in list(self._agency_waiters):
+            self.__grant(agency)
+        if self._on_ready:
+            self._on_ready()
+
+    def __handle_release(self, conn, agency, sequence_number):
+        self.__merge_sequence_numbers({agency: sequence_number})
+        if self._agency_owners.get(agency) is conn:
+            del self._agency_owners[agency]
+        self.__grant(agency)
+
+    def __grant(self, agency):
+        waiters = self._agency_waiters.get(agency)
+        if self._pending_ready or agency in self._agency_owners or not waiters:
+            return
+        conn = waiters.pop(0)
+        if not waiters:
+            del self._agency_waiters[agency]
+        self._agency_owners[agency] = conn
+        self.__send(conn, _GRANT, (agency, self._sequence_numbers.get(agency, 0)))
+
+    def __merge_sequence_numbers(self, sequence_numbers):
+        for agency, sequence_number in sequence_numbers.items():
+            self._sequence_numbers[agency] = max(sequence_number, self._sequence_numbers.get(agency, 0))
+
+    def __handle_finished(self, agency_id):
+        self._finished_agencies.add(agency_id)
+        logging.debug(f"action: finished_notification_received | result: success | client_id: {agency_id} | finished_agencies: {len(self._finished_agencies)}")
+        if len(self._finished_agencies) != self._num_agencies or self._pending_winners is not None:
+            return
+
+        # Every batch of the finished agencies was acked, so it is already indexed by its worker
+        self._pending_winners = set(self._conns)
+        for conn in self._conns:
+            self.__send(conn, _COLLECT_WINNERS, None)
+
+    def __handle_winners(self, conn, payload):
+        winners, bets = payload
+        for agency_id, documents in winners.items():
+            self._winners.setdefault(agency_id, []).extend(documents)
+        for agency_id, count in bets.items():
+            self._bets[agency_id] = self._bets.get(agency_id, 0) + count
+        self._pending_winners.discard(conn)
+        self.__draw_if_collected()
+
+    def __draw_if_collected(self):
+        if self._pending_winners is None or self._pending_winners:
+            return
+        self._pending_winners = frozenset()
+        logging.info("action: sorteo | result: success")
+        for conn in self._conns:
+            self.__send(conn, _DRAW, (self._winners, self._bets))
+
+    def __remove(self, conn):
+        self._conns.remove(conn)
+        # Agencies of a worker that exited stay granted to it: what it stored last is unknown
+        for agency, waiters in list(self._agency_waiters.items()):
+            waiters[:] = [waiter for waiter in waiters if waiter is not conn]
+            if not waiters:
+                del self._agency_waiters[agency]
+        if self._pending_winners:
+            self._pending_winners.discard(conn)
+            self.__draw_if_collected()
+        for gather_id, (_, _, pending, answers, _) in list(self._gathers.items()):
+            if conn in pending:
+                pending.discard(conn)
+                answers.append(None)
+                self.__answer_if_gathered(gather_id)
+
+    def __send(self, conn, command, payload):
+        try:
+            conn.send((command, payload))
+        except OSError as e:
+            logging.error(f"action: send_to_worker | result: fail | command: {command} | error: {e}")
+
+
+def _merge_found_bets(limit: int) -> Callable:
+    def merge(answers):
+        bets = [bet for _, shard_bets in answers for bet in shard_bets]
+        return sum(total for total, _ in answers), bets[:limit]
+    return merge
+
+
+def _merge_tallies(answers: list) -> list:
+    totals = {}
+    for tallies in answers:
+        for agency, bets, winners in tallies:
+            agency_bets, agency_winners = totals.get(agency, (0, 0))
+            totals[agency] = (agency_bets + bets, agency_winners + winners)
+    return sorted((agency, bets, winners) for agency, (bets, winners) in totals.items())
+
+
+class ShardedServer:
+    """
+    Server that spreads client connections over several worker processes
+
+    Every worker runs a whole server engine with its own storage shard,
+    listening on the same port with SO_REUSEPORT so the kernel balances
+    connections between them. Since the Go client keeps one connection per
+    agency, each agency ends up stored by a single worker. `create_server`
+    is called in each worker with the shard number and its `ShardLottery`,
+    whose `notify_ready` the server must call once it accepts connections
+    for `on_ready` to be called when every worker did.
+    """
+    def __init__(self, num_agencies: int, num_workers: int, create_server: Callable, on_ready: Callable = None):
+        self._num_agencies = num_agencies
+        self._num_workers = num_workers
+        self._create_server = create_server
+        self._on_ready = on_ready
+        self._workers = []
+
+    def run(self):
+        conns = []
+        for shard in range(self._num_workers):
+            parent_conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_run_worker, args=(self._create_server, shard, worker_conn),
+                                             name=f"shard-{shard}")
+            worker.start()
+            worker_conn.close()
+            conns.append(parent_conn)
+            self._workers.append(worker)
+        logging.info(f"action: start_workers | result: success | workers: {self._num_workers}")
+
+        signal.signal(signal.SIGTERM, self._signal_handler)
+        try:
+            ShardCoordinator(self._num_agencies, conns, self._on_ready).run()
+        except KeyboardInterrupt:
+            logging.info("action: sigterm_received | result: success")
+            self.__stop_workers()
+
+        for worker in self._workers:
+            worker.join()
+        logging.info("action: server_shutdown | result: success")
+
+    def _signal_handler(self, sig, frame):
+        logging.info("action: sigterm_received | result: success")
+        self.__stop_workers()
+
+    def __stop_workers(self):
+        # Each worker shuts down its own server on SIGTERM, closing its pipe
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def _run_worker(create_server: Callable, shard: int, conn):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    create_server(shard, ShardLottery(conn)).run()
@@ -0,0 +1,673 @@
+import csv
+import io
+import itertools
+import mmap
+import operator
+import os
+import struct
+import sys
+import threading
+from array import array
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+from .columns import ColumnCache, new_columns, DEFAULT_CHUNK_BETS
+from .indexes import BetIndexes
+from .names import NameTable
+from .utils import Bet, BetBatch, load_bets, pack_date, STORAGE_FILEPATH
+
+
+_NATIVE_BIG_ENDIAN = sys.byteorder == 'big'
+
+""" Default location of the binary bets log. """
+BINARY_STORAGE_FILEPATH = "./bets.log"
+
+STORAGE_BACKEND_CSV = "csv"
+STORAGE_BACKEND_BINARY = "binary"
+STORAGE_BACKENDS = (STORAGE_BACKEND_CSV, STORAGE_BACKEND_BINARY)
+
+
+class CsvBetStorage:
+    """
+    Bets stored as CSV rows, in the format of `utils.store_bets`
+    Appended bets are also kept in a `ColumnCache` for `scan_columns`, and
+    in `BetIndexes` by the byte offset of their row for `find_bets`.
+    Not thread-safe/process-safe, except for `find_bets`.
+    """
+    def __init__(self, filepath: str = STORAGE_FILEPATH):
+        self.filepath = filepath
+        self._file = None
+        self._end = 0
+        self._columns = ColumnCache(filepath + ".cols")
+        self._indexes = BetIndexes(filepath)
+        self._indexes_lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filepath)
+
+    def store_bets(self, bets: list[Bet]) -> None:
+        # Caught up by the column cache when it is opened again
+        self.flush(sync=False)
+        self._columns.close()
+        self.__open_indexes()
+        text, offsets = self.__encode_rows([[bet.agency, bet.first_name, bet.last_name,
+                                             bet.document, bet.birthdate, bet.number] for bet in bets])
+        with open(self.filepath, 'a') as file:
+            file.write(text)
+        self._indexes.add(array('I', [bet.agency for bet in bets]),
+                          array('I', [int(bet.document) for bet in bets]), offsets)
+
+    def append(self, batch: BetBatch) -> None:
+        """
+        Append a batch through a file handle kept open across calls
+        It is not visible to readers until `flush` is called.
+        """
+        rows = [[batch.agency, first_name, last_name, document,
+                 f"{birthdate // 10000:04d}-{birthdate // 100 % 100:02d}-{birthdate % 100:02d}", number]
+                for first_name, last_name, document, birthdate, number in zip(
+                    batch.first_names, batch.last_names, batch.documents, batch.birthdates, batch.numbers)]
+        self.__open_indexes()
+        if self._file is None:
+            self._file = open(self.filepath, 'a+')
+        self.__open_columns()
+        text, offsets = self.__encode_rows(rows)
+        self._file.write(text)
+        self._columns.append(batch)
+        self._indexes.add(array('I', [batch.agency]) * len(batch), batch.documents, offsets)
+
+    def __encode_rows(self, rows: list) -> Tuple[str, array]:
+        """
+        Return the CSV text of the rows to append, and the offset each of
+        them will be stored at
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_MINIMAL)
+        ends = []
+        for row in rows:
+            writer.writerow(row)
+            ends.append(buffer.tell())
+        text = buffer.getvalue()
+        offsets = array('Q')
+        start = 0
+        for end in ends:
+            offsets.append(self._end)
+            self._end += len(text[start:end].encode('utf-8'))
+            start = end
+        return text, offsets
+
+    def flush(self, sync: bool) -> None:
+        """
+        Hand the appended bets to the OS, and to the disk if sync is set
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._columns.flush(self.size(), sync)
+        self._indexes.flush(self.size())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+        self._indexes.close(self.size())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._columns.close()
+
+    def size(self) -> int:
+        """
+        Bytes of the stored bets, including the appended ones once flushed
+        """
+        return _file_size(self._file, self.filepath)
+
+    def truncate(self, size: int) -> None:
+        """
+        Drop the stored bytes past size, as left by an interrupted append
+        """
+        self.close()
+        _truncate_file(self.filepath, size)
+
+    def load_bets(self) -> Iterator[Bet]:
+        return load_bets(self.filepath)
+
+    def split(self, chunk_bytes: int) -> list[Tuple[int, int]]:
+        """
+        Return the (start, end) offsets of consecutive ranges of about
+        chunk_bytes bytes of the stored rows, split at line breaks, so
+        names must not hold any
+        """
+        ranges = []
+        if not self.exists():
+            return ranges
+        size = self.size()
+        with open(self.filepath, 'rb') as file:
+            start = 0
+            while start < size:
+                file.seek(min(start + chunk_bytes, size) - 1)
+                file.readline()
+                end = min(file.tell(), size)
+                ranges.append((start, end))
+                start = end
+        return ranges
+
+    def load_batches(self, start: int, end: int) -> Iterator[BetBatch]:
+        """
+        Yield the bets stored between two offsets of `split`, as batches
+        of up to DEFAULT_CHUNK_BETS consecutive bets of an agency
+        """
+        with open(self.filepath, 'rb') as file:
+            file.seek(start)
+            data = file.read(end - start)
+        # A row left half-written by an interrupted append is ignored
+        text = data[:data.rfind(b'\n') + 1].decode('utf-8')
+        reader = csv.reader(io.StringIO(text, newline=''), quoting=csv.QUOTE_MINIMAL)
+        intern = sys.intern
+        for agency, rows in itertools.groupby(reader, key=operator.itemgetter(0)):
+            while True:
+                run = list(itertools.islice(rows, DEFAULT_CHUNK_BETS))
+                if not run:
+                    break
+                batch = BetBatch(int(agency))
+                batch.first_names = [intern(row[1]) for row in run]
+                batch.last_names = [intern(row[2]) for row in run]
+                batch.documents = array('I', [int(row[3]) for row in run])
+                batch.birthdates = array('I', [int(row[4].replace('-', '')) for row in run])
+                batch.numbers = array('I', [int(row[5]) for row in run])
+                yield batch
+
+    def find_by_number(self, numbers: set) -> Iterator[Tuple[int, str]]:
+        """
+        Yield the (agency, document) of the stored bets whose number is one
+        of the given ones
+        """
+        with open(self.filepath, 'r') as file:
+            reader = csv.reader(file, quoting=csv.QUOTE_MINIMAL)
+            for row in reader:
+                if int(row[5]) in numbers:
+                    yield int(row[0]), row[3]
+
+    def scan_columns(self, chunk_bets: int = DEFAULT_CHUNK_BETS,
+                     numbers_of: Optional[Callable[[Iterable[int]], Iterable[int]]] = None) -> Iterator[Tuple[array, array, array]]:
+        """
+        Yield the agency, document and number columns of the stored bets,
+        in chunks of up to chunk_bets bets, read from the column cache,
+        skipping its segments that hold none of numbers_of(agencies) if given
+        """
+        self.__open_columns()
+        return self._columns.scan(chunk_bets, numbers_of)
+
+    def bet_counts(self) -> dict:
+        """
+        Return the number of stored bets per agency, from the column cache
+        """
+        self.__open_columns()
+        return self._columns.bet_counts()
+
+    def __open_columns(self):
+        if not self._columns.is_open:
+            self.flush(sync=False)
+            self._columns.open(self.size(), self.__walk_columns)
+
+    def __walk_columns(self, offset: int) -> Iterator[Tuple[array, array, array]]:
+        if not self.exists():
+            return
+        with open(self.filepath, 'rb') as file:
+            file.seek(offset)
+            reader = csv.reader(io.TextIOWrapper(file), quoting=csv.QUOTE_MINIMAL)
+            columns = new_columns()
+            for row in reader:
+                if len(row) != 6:
+                    # Row left half-written by an interrupted append
+                    break
+                columns[0].append(int(row[0]))
+                columns[1].append(int(row[3]))
+                columns[2].append(int(row[5]))
+                if len(columns[2]) == DEFAULT_CHUNK_BETS:
+                    yield columns
+                    columns = new_columns()
+            yield columns
+
+    def find_bets(self, field: str, value: int, limit: Optional[int] = None) -> Tuple[int, list[Bet]]:
+        """
+        Return the number of stored bets whose field (document or agency)
+        has the given value, and the first limit of them, from the indexes
+        Safe to call from threads other than the one appending.
+        """
+        self.__open_indexes()
+        total, offsets = self._indexes.lookup(field, value, limit)
+        if not offsets:
+            return total, []
+        bets = []
+        with open(self.filepath, 'rb') as file:
+            for offset in offsets:
+                file.seek(offset)
+                row = next(csv.reader(_CompleteLines(file), quoting=csv.QUOTE_MINIMAL), None)
+                if row is None or len(row) != 6:
+                    # Row not flushed yet by the appending thread
+                    continue
+                bets.append(Bet(row[0], row[1], row[2], row[3], row[4], row[5]))
+        return total, bets
+
+    def open_indexes(self) -> None:
+        """
+        Open the indexes, catching them up with the bets stored without them
+
+        Meant for startup, otherwise the first append or lookup catches
+        them up while holding the lock the other one waits for.
+        """
+        self.__open_indexes()
+
+    def __open_indexes(self):
+        # Indexes are opened before the appending handle, so this never flushes another thread's appends
+        with self._indexes_lock:
+            if not self._indexes.is_open:
+                self.flush(sync=False)
+                self._end = self.size()
+                self._indexes.open(self._end, self.__walk_indexed)
+
+    def __walk_indexed(self, offset: int) -> Iterator[Tuple[array, array, array, int]]:
+        if not self.exists():
+            return
+        with open(self.filepath, 'rb') as file:
+            file.seek(offset)
+            lines = _CompleteLines(file)
+            reader = csv.reader(lines, quoting=csv.QUOTE_MINIMAL)
+            agencies, documents, offsets = array('I'), array('I'), array('Q')
+            for row in reader:
+                if len(row) != 6:
+                    break
+                offsets.append(offset)
+                offset = lines.offset
+                agencies.append(int(row[0]))
+                documents.append(int(row[3]))
+                if len(offsets) == DEFAULT_CHUNK_BETS:
+                    yield agencies, documents, offsets, offset
+                    agencies, documents, offsets = array('I'), array('I'), array('Q')
+            yield agencies, documents, offsets, offset
+
+
+class _CompleteLines:
+    """
+    Decoded lines of a binary file from its position on, tracking the
+    offset past the last one, up to the last complete line
+    """
+    def __init__(self, file):
+        self._file = file
+        self.offset = file.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self._file.readline()
+        if not line.endswith(b'\n'):
+            # End of the file, or a line left half-written by an interrupted append
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+
+class BinaryBetStorage:
+    """
+    Bets stored as an append-only log of fixed-size binary records
+
+    The log starts with a magic header, followed by one record per bet:
+    agency(4), document(4), birthdate(4) as YYYYMMDD, number(4),
+    first_name_id(4), last_name_id(4). All integers are big-endian
+    unsigned. Names are dictionary-encoded: ids refer to the `NameTable`
+    kept next to the log as `<filepath>.names`, so each distinct name is
+    stored once per log, and loaded bets share a single object per name.
+
+    Reads memory-map the log and walk it in strides of the record size,
+    so it can be filtered on `number` without decoding names nor building
+    `Bet` objects. Appended bets are also kept in a `ColumnCache` for
+    `scan_columns`, and in `BetIndexes` by the offset of their record for
+    `find_bets`.
+    Not thread-safe/process-safe, except for `find_bets`.
+    """
+    MAGIC = b'BETLOG\x00\x02'
+    RECORD = struct.Struct('>IIIIII')
+    """ Records read at a time by the walks of the log. """
+    WALK_RECORDS = 16384
+
+    def __init__(self, filepath: str = BINARY_STORAGE_FILEPATH):
+        self.filepath = filepath
+        self._file = None
+        self._end = 0
+        self._names = NameTable(filepath + ".names")
+        self._lookup_names = None
+        self._columns = ColumnCache(filepath + ".cols")
+        self._indexes = BetIndexes(filepath)
+        self._indexes_lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filepath)
+
+    def store_bets(self, bets: list[Bet]) -> None:
+        # Caught up by the column cache when it is opened again
+        self.flush(sync=False)
+        self._columns.close()
+        self.__open_indexes()
+        self._names.load()
+        records = [self.encode_bet(bet) for bet in bets]
+        self._names.flush(sync=False)
+        with open(self.filepath, 'ab') as file:
+            if file.tell() == 0:
+                file.write(self.MAGIC)
+            file.write(b''.join(records))
+        self._indexes.add(array('I', [bet.agency for bet in bets]),
+                          array('I', [int(bet.document) for bet in bets]), self.__record_offsets(len(bets)))
+
+    def append(self, batch: BetBatch) -> None:
+        """
+        Append a batch through a file handle kept open across calls
+        It is not visible to readers until `flush` is called.
+        """
+        self._names.load()
+        records = self.encode_batch(batch)
+        # New names reach the OS before the records that refer to them
+        self._names.flush(sync=False)
+        self.__open_indexes()
+        if self._file is None:
+            self._file = open(self.filepath, 'ab')
+            if self._file.tell() == 0:
+                self._file.write(self.MAGIC)
+        self.__open_columns()
+        self._file.write(records)
+        self._columns.append(batch)
+        self._indexes.add(array('I', [batch.agency]) * len(batch), batch.documents, self.__record_offsets(len(batch)))
+
+    def __record_offsets(self, records: int) -> array:
+        offsets = array('Q', range(self._end, self._end + records * self.RECORD.size, self.RECORD.size))
+        self._end += records * self.RECORD.size
+        return offsets
+
+    def flush(self, sync: bool) -> None:
+        """
+        Hand the appended bets to the OS, and to the disk if sync is set
+        """
+        if self._file is None:
+            return
+        self._names.flush(sync)
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._columns.flush(self.size(), sync)
+        self._indexes.flush(self.size())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+        self._indexes.close(self.size())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._names.close()
+        self._lookup_names = None
+        self._columns.close()
+
+    def size(self) -> int:
+        return _file_size(self._file, self.filepath)
+
+    def truncate(self, size: int) -> None:
+        self.close()
+        _truncate_file(self.filepath, size)
+
+    def encode_bet(self, bet: Bet) -> bytes:
+        return self.RECORD.pack(bet.agency, int(bet.document), pack_date(bet.birthdate), bet.number,
+                                self._names.id(bet.first_name), self._names.id(bet.last_name))
+
+    def encode_batch(self, batch: BetBatch) -> bytes:
+        name_id = self._names.id
+        records = array('I', bytes(len(batch) * self.RECORD.size))
+        records[0::6] = array('I', [batch.agency]) * len(batch)
+        records[1::6] = batch.documents
+        records[2::6] = batch.birthdates
+        records[3::6] = batch.numbers
+        records[4::6] = array('I', [name_id(name) for name in batch.first_names])
+        records[5::6] = array('I', [name_id(name) for name in batch.last_names])
+        if not _NATIVE_BIG_ENDIAN:
+            records.byteswap()
+        return records.tobytes()
+
+    def load_bets(self) -> Iterator[Bet]:
+        self._names.load()
+        names = self._names.names
+        from_packed = Bet.from_packed
+        for records in self.__walk_records(len(self.MAGIC)):
+            for i in range(0, len(records), 6):
+                agency, document, birthdate, number, first_name_id, last_name_id = records[i:i + 6]
+                if first_name_id >= len(names) or last_name_id >= len(names):
+                    # Record referring to names lost by an interrupted append
+                    return
+                yield from_packed(agency, names[first_name_id], names[last_name_id], document, birthdate, number)
+
+    def split(self, chunk_bytes: int) -> list[Tuple[int, int]]:
+        """
+        Return the (start, end) offsets of consecutive ranges of about
+        chunk_bytes bytes of the complete stored records
+        """
+        end = len(self.MAGIC) + max(0, self.size() - len(self.MAGIC)) // self.RECORD.size * self.RECORD.size
+        step = max(1, chunk_bytes // self.RECORD.size) * self.RECORD.size
+        return [(start, min(start + step, end)) for start in range(len(self.MAGIC), end, step)]
+
+    def load_batches(self, start: int, end: int) -> Iterator[BetBatch]:
+        """
+        Yield the bets stored between two offsets of `split`, as batches
+        of consecutive bets of an agency, built from the record columns
+        """
+        self._names.load()
+        names = self._names.names
+        for records in self.__walk_records(start, end):
+            agencies, first_name_ids, last_name_ids = records[0::6], records[4::6], records[5::6]
+            count = len(agencies)
+            if max(first_name_ids) >= len(names) or max(last_name_ids) >= len(names):
+                # Records referring to names lost by an interrupted append
+                count = next(i for i in range(count) if max(first_name_ids[i], last_name_ids[i]) >= len(names))
+            first = 0
+            for i in range(1, count + 1):
+                if i < count and agencies[i] == agencies[first]:
+                    continue
+                batch = BetBatch(agencies[first])
+                batch.first_names = [names[name_id] for name_id in first_name_ids[first:i]]
+                batch.last_names = [names[name_id] for name_id in last_name_ids[first:i]]
+                batch.documents = records[6 * first + 1:6 * i:6]
+                batch.birthdates = records[6 * first + 2:6 * i:6]
+                batch.numbers = records[6 * first + 3:6 * i:6]
+                yield batch
+                first = i
+            if count < len(agencies):
+                return
+
+    def find_by_number(self, numbers: set) -> Iterator[Tuple[int, str]]:
+        """
+        Yield the (agency, document) of the stored bets whose number is one
+        of the given ones, without looking at their names
+        """
+        for records in self.__walk_records(len(self.MAGIC)):
+            for agency, document, number in zip(records[0::6], records[1::6], records[3::6]):
+                if number in numbers:
+                    yield agency, str(document)
+
+    def scan_columns(self, chunk_bets: int = DEFAULT_CHUNK_BETS,
+                     numbers_of: Optional[Callable[[Iterable[int]], Iterable[int]]] = None) -> Iterator[Tuple[array, array, array]]:
+        """
+        Yield the agency, document and number columns of the stored bets,
+        in chunks of up to chunk_bets bets, read from the column cache,
+        skipping its segments that hold none of numbers_of(agencies) if given
+        """
+        self.__open_columns()
+        return self._columns.scan(chunk_bets, numbers_of)
+
+    def bet_counts(self) -> dict:
+        """
+        Return the number of stored bets per agency, from the column cache
+        """
+        self.__open_columns()
+        return self._columns.bet_counts()
+
+    def __open_columns(self):
+        if not self._columns.is_open:
+            self.flush(sync=False)
+            self._columns.open(self.size(), self.__walk_columns)
+
+    def __walk_columns(self, offset: int) -> Iterator[Tuple[array, array, array]]:
+        if not self.exists():
+            return
+        columns = new_columns()
+        for records in self.__walk_records(max(offset, len(self.MAGIC))):
+            columns[0].extend(records[0::6])
+            columns[1].extend(records[1::6])
+            columns[2].extend(records[3::6])
+            if len(columns[2]) >= DEFAULT_CHUNK_BETS:
+                yield columns
+                columns = new_columns()
+        yield columns
+
+    def find_bets(self, field: str, value: int, limit: Optional[int] = None) -> Tuple[int, list[Bet]]:
+        """
+        Return the number of stored bets whose field (document or agency)
+        has the given value, and the first limit of them, from the indexes
+        Safe to call from threads other than the one appending.
+        """
+        self.__open_indexes()
+        total, offsets = self._indexes.lookup(field, value, limit)
+        if not offsets:
+            return total, []
+        bets = []
+        with self.__open_log() as log:
+            # Names of their own, since the appending thread owns the table
+            names = self._lookup_names
+            for offset in offsets:
+                if offset + self.RECORD.size > len(log):
+                    # Record not flushed yet by the appending thread
+                    continue
+                agency, document, birthdate, number, first_name_id, last_name_id = self.RECORD.unpack_from(log, offset)
+                if names is None or max(first_name_id, last_name_id) >= len(names.names):
+                    # Names reach the file before the records that refer to them
+                    names = NameTable(self._names.filepath)
+                    names.load()
+                    self._lookup_names = names
+                    if max(first_name_id, last_name_id) >= len(names.names):
+                        continue
+                bets.append(Bet.from_packed(agency, names.name(first_name_id), names.name(last_name_id),
+                                            document, birthdate, number))
+        return total, bets
+
+    def open_indexes(self) -> None:
+        """
+        Open the indexes, catching them up with the bets stored without them
+
+        Meant for startup, otherwise the first append or lookup catches
+        them up while holding the lock the other one waits for.
+        """
+        self.__open_indexes()
+
+    def __open_indexes(self):
+        # Indexes are opened before the appending handle, so this never flushes another thread's appends
+        with self._indexes_lock:
+            if not self._indexes.is_open:
+                self.flush(sync=False)
+                self._end = max(self.size(), len(self.MAGIC))
+                self._indexes.open(self.size(), self.__walk_indexed)
+
+    def __walk_indexed(self, offset: int) -> Iterator[Tuple[array, array, array, int]]:
+        offset = max(offset, len(self.MAGIC))
+        for records in self.__walk_records(offset):
+            count = len(records) // 6
+            yield (records[0::6], records[1::6],
+                   array('Q', range(offset, offset + count * self.RECORD.size, self.RECORD.size)),
+                   offset + count * self.RECORD.size)
+            offset += count * self.RECORD.size
+
+    def __walk_records(self, offset: int, end: Optional[int] = None) -> Iterator[array]:
+        """
+        Yield the fields of the complete records from offset on, up to end
+        if given, decoded WALK_RECORDS records at a time into a flat array
+        of six per record
+        """
+        if not self.exists():
+            return
+        with self.__open_log() as log:
+            # A record left half-written by an interrupted append is ignored
+            end = len(log) if end is None else min(len(log), end)
+            end = offset + (end - offset) // self.RECORD.size * self.RECORD.size
+            step = self.WALK_RECORDS * self.RECORD.size
+            while offset < end:
+                records = array('I')
+                records.frombytes(log[offset:min(offset + step, end)])
+                if not _NATIVE_BIG_ENDIAN:
+                    records.byteswap()
+                offset += step
+                yield records
+
+    def export_csv(self, filepath: str) -> None:
+        """
+        Export the stored bets to a CSV file, in the format of `utils.store_bets`
+        """
+        with open(filepath, 'w') as file:
+            writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
+            for bet in self.load_bets():
+                writer.writerow([bet.agency, bet.first_name, bet.last_name,
+                                 bet.document, bet.birthdate, bet.number])
+
+    def __open_log(self):
+        with open(self.filepath, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return _EmptyLog()
+            log = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if log[:len(self.MAGIC)] != self.MAGIC:
+            log.close()
+            raise ValueError(f"{self.filepath} is not a bets log")
+        return log
+
+
+class _EmptyLog(bytes):
+    """ Stand-in for a memory map of an empty log, which mmap does not support. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _file_size(file, filepath: str) -> int:
+    if file is not None:
+        return os.fstat(file.fileno()).st_size
+    return os.path.getsize(filepath) if os.path.exists(filepath) else 0
+
+
+def _truncate_file(filepath: str, size: int) -> None:
+    if os.path.exists(filepath):
+        with open(filepath, 'r+b') as file:
+            file.truncate(size)
+
+
+def create_storage(backend: str, filepath: str = ""):
+    """
+    Create the bets storage of the given backend, at the given filepath
+    or at the default location of the backend
+    """
+    if backend == STORAGE_BACKEND_CSV:
+        return CsvBetStorage(filepath or STORAGE_FILEPATH)
+    if backend == STORAGE_BACKEND_BINARY:
+        return BinaryBetStorage(filepath or BINARY_STORAGE_FILEPATH)
+    raise ValueError(f"unknown storage backend: {backend}")
+
+
+def shard_filepath(backend: str, filepath: str, shard: int) -> str:
+    """
+    Location of the given storage shard: the shard number is inserted
+    before the extension of the filepath or of the default location
+    """
+    if not filepath:
+        filepath = STORAGE_FILEPATH if backend == STORAGE_BACKEND_CSV else BINARY_STORAGE_FILEPATH
+    root, extension = os.path.splitext(filepath)
+    return f"{root}.shard{shard}{extension}"
+
+
+if __name__ == "__main__":
+    # Export a binary bets log as CSV: python -m common.storage <bets.log> <bets.csv>
+    if len(sys.argv) != 3:
+        sys.exit(f"usage: {sys.argv[0]} <bets log> <csv file>")
+    BinaryBetStorage(sys.argv[1]).export_csv(sys.argv[2])
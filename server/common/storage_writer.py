@@ -0,0 +1,192 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from .metrics import BETS_STORED, STORAGE_COMMIT_SECONDS, STORAGE_QUEUE_WAIT_SECONDS
+from .utils import BetBatch
+from .draw import DEFAULT_DRAW_ENGINE
+
+
+""" Acknowledge a batch once it is handed to the OS, it survives a server crash but not a host one. """
+FSYNC_POLICY_NEVER = "never"
+""" Acknowledge a batch once the group commit that contains it is fsynced to disk. """
+FSYNC_POLICY_ALWAYS = "always"
+FSYNC_POLICIES = (FSYNC_POLICY_NEVER, FSYNC_POLICY_ALWAYS)
+
+_STOP = object()
+
+
+class StorageWriter:
+    """
+    Single thread that owns the bets storage and persists every stored batch
+
+    Client handlers submit their batches to a queue instead of taking a
+    lock and writing themselves. The writer drains whatever batches are
+    queued, up to `max_group_batches`, and persists them as one group
+    commit: one write of every batch followed by a single flush, and a
+    single fsync under the `always` policy. The future returned by
+    `submit` is resolved only after the group is durable under the
+    configured policy, so handlers must wait on it before acking.
+
+    `group_delay` makes the writer wait up to that many seconds for more
+    batches before committing a group, trading latency for bigger groups.
+
+    With a `wal`, every stored batch is recorded in the write-ahead log
+    within its group commit, before its future is resolved. Batches that
+    carry a sequence number not above the last one stored for their
+    agency, starting from `sequence_numbers`, are retries of stored ones:
+    they are acked without being stored again. The winners recorded in
+    the log are classified by `draw_engine`.
+    """
+    def __init__(self, storage, fsync_policy: str = FSYNC_POLICY_NEVER, max_group_batches: int = 64, group_delay: float = 0,
+                 wal=None, sequence_numbers: dict = None, draw_engine=DEFAULT_DRAW_ENGINE):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy: {fsync_policy}")
+        self.storage = storage
+        self._sync = fsync_policy == FSYNC_POLICY_ALWAYS
+        self._max_group_batches = max_group_batches
+        self._group_delay = group_delay
+        self._wal = wal
+        self._draw_engine = draw_engine
+        self._sequence_numbers = dict(sequence_numbers or {})
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._thread = threading.Thread(target=self.__run, name="storage-writer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def submit(self, batch: BetBatch, sequence_number: int = None) -> Future:
+        """
+        Queue a whole batch to be stored
+
+        The batch is stored, and recorded in the write-ahead log, within a
+        single group commit, so it is never left partly stored. The
+        returned future resolves to True once the batch is durable, to
+        False if it was a retry of a stored batch, or to the exception that
+        prevented storing it.
+        """
+        if self._stopped:
+            raise RuntimeError("storage writer is stopped")
+        future = Future()
+        self._queue.put((batch, future, time.perf_counter(), sequence_number))
+        return future
+
+    def sequence_numbers(self) -> dict:
+        """
+        Return a copy of the last sequence number stored per agency
+        """
+        return dict(self._sequence_numbers)
+
+    def advance_sequence_number(self, agency: int, sequence_number: int) -> None:
+        """
+        Treat the batches of an agency up to sequence_number as stored, for
+        batches stored by another process
+
+        Meant for agencies without sequenced batches in flight.
+        """
+        self._sequence_numbers[agency] = max(sequence_number, self._sequence_numbers.get(agency, 0))
+
+    def record_finished(self, agency_id: str) -> None:
+        """
+        Record in the write-ahead log that an agency finished sending its bets
+        """
+        if self._wal is not None:
+            self._wal.append_finished(int(agency_id))
+            self._wal.flush(self._sync)
+
+    def stop(self) -> None:
+        """
+        Store every batch queued so far and close the storage
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        self.storage.close()
+        if self._wal is not None:
+            self._wal.close()
+        logging.info("action: close_storage | result: success")
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            group = [item]
+            deadline = time.monotonic() + self._group_delay
+            while len(group) < self._max_group_batches:
+                try:
+                    timeout = deadline - time.monotonic()
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                group.append(item)
+
+            self.__commit(group)
+
+    def __commit(self, group):
+        start = time.perf_counter()
+        appended = []
+        retried = []
+        # Retries of batches appended by this same group, only stored once the group is flushed
+        retried_in_group = []
+        stored = 0
+        # Sequence numbers as of this group, so two copies of a batch in it are stored once
+        sequence_numbers = dict(self._sequence_numbers)
+        for batch, future, submitted, sequence_number in group:
+            STORAGE_QUEUE_WAIT_SECONDS.observe(start - submitted)
+            if sequence_number is not None and sequence_number <= sequence_numbers.get(batch.agency, 0):
+                if sequence_number <= self._sequence_numbers.get(batch.agency, 0):
+                    retried.append(future)
+                else:
+                    retried_in_group.append(future)
+                continue
+            try:
+                self.storage.append(batch)
+                appended.append((batch, future, sequence_number))
+                stored += len(batch)
+                if sequence_number is not None:
+                    sequence_numbers[batch.agency] = sequence_number
+            except Exception as e:
+                logging.error(f"action: store_bets | result: fail | cantidad: {len(batch)} | error: {e}")
+                future.set_exception(e)
+
+        try:
+            self.storage.flush(self._sync)
+            if self._wal is not None and appended:
+                storage_size = self.storage.size()
+                for batch, _, sequence_number in appended:
+                    self._wal.append_batch(batch.agency, sequence_number or 0, storage_size,
+                                          self._draw_engine.batch_winners(batch), len(batch))
+                self._wal.flush(self._sync)
+        except Exception as e:
+            logging.error(f"action: flush_storage | result: fail | batches: {len(appended)} | error: {e}")
+            for _, future, _ in appended:
+                future.set_exception(e)
+            # The retries were not stored either, and the sequence numbers of the group are rolled back
+            for future in retried_in_group:
+                future.set_exception(e)
+            appended = []
+            retried_in_group = []
+            stored = 0
+
+        for batch, _, sequence_number in appended:
+            if sequence_number is not None:
+                self._sequence_numbers[batch.agency] = max(sequence_number, self._sequence_numbers.get(batch.agency, 0))
+        retried.extend(retried_in_group)
+
+        STORAGE_COMMIT_SECONDS.observe(time.perf_counter() - start)
+        BETS_STORED.inc(stored)
+        logging.debug("action: group_commit | result: success | batches: %d | retried: %d", len(appended), len(retried))
+        for _, future, _ in appended:
+            future.set_result(True)
+        for future in retried:
+            future.set_result(False)
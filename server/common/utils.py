@@ -1,6 +1,9 @@
 import csv
 import datetime
+import sys
 import time
+from array import array
+from typing import Iterator
 
 
 """ Bets storage location. """
@@ -11,6 +14,8 @@ LOTTERY_WINNER_NUMBER = 7574
 
 """ A lottery bet registry. """
 class Bet:
+    __slots__ = ('agency', 'first_name', 'last_name', 'document', 'birthdate', 'number')
+
     def __init__(self, agency: str, first_name: str, last_name: str, document: str, birthdate: str, number: str):
         """
         agency must be passed with integer format.
@@ -24,28 +29,99 @@ class Bet:
         self.birthdate = datetime.date.fromisoformat(birthdate)
         self.number = int(number)
 
+    @classmethod
+    def from_packed(cls, agency: int, first_name: str, last_name: str, document: int, birthdate: int, number: int) -> 'Bet':
+        """
+        Build a bet from already decoded integer fields, without parsing strings.
+        birthdate must be passed packed as the integer YYYYMMDD.
+        """
+        bet = cls.__new__(cls)
+        bet.agency = agency
+        bet.first_name = first_name
+        bet.last_name = last_name
+        bet.document = str(document)
+        bet.birthdate = datetime.date(birthdate // 10000, birthdate // 100 % 100, birthdate % 100)
+        bet.number = number
+        return bet
+
+""" Packs a date as the integer YYYYMMDD. """
+def pack_date(date: datetime.date) -> int:
+    return date.year * 10000 + date.month * 100 + date.day
+
+""" A batch of bets of a single agency, stored by columns. """
+class BetBatch:
+    __slots__ = ('agency', 'first_names', 'last_names', 'documents', 'birthdates', 'numbers')
+
+    def __init__(self, agency: int):
+        """
+        Integer fields are kept in array('I') columns, so a bet costs its two
+        names plus 12 bytes instead of a Bet object with six attributes.
+        birthdates are packed as the integer YYYYMMDD.
+        """
+        self.agency = agency
+        self.first_names = []
+        self.last_names = []
+        self.documents = array('I')
+        self.birthdates = array('I')
+        self.numbers = array('I')
+
+    @classmethod
+    def from_bets(cls, agency: int, bets: list[Bet]) -> 'BetBatch':
+        batch = cls(agency)
+        for bet in bets:
+            batch.append(bet.first_name, bet.last_name, int(bet.document), pack_date(bet.birthdate), bet.number)
+        return batch
+
+    def append(self, first_name: str, last_name: str, document: int, birthdate: int, number: int) -> None:
+        self.first_names.append(first_name)
+        self.last_names.append(last_name)
+        self.documents.append(document)
+        self.birthdates.append(birthdate)
+        self.numbers.append(number)
+
+    def extend(self, other: 'BetBatch') -> None:
+        """
+        Append the bets of another batch of the same agency
+        """
+        self.first_names.extend(other.first_names)
+        self.last_names.extend(other.last_names)
+        self.documents.extend(other.documents)
+        self.birthdates.extend(other.birthdates)
+        self.numbers.extend(other.numbers)
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __iter__(self) -> Iterator[Bet]:
+        for i in range(len(self.numbers)):
+            yield Bet.from_packed(self.agency, self.first_names[i], self.last_names[i],
+                                  self.documents[i], self.birthdates[i], self.numbers[i])
+
 """ Checks whether a bet won the prize or not. """
 def has_won(bet: Bet) -> bool:
     return bet.number == LOTTERY_WINNER_NUMBER
 
 """
-Persist the information of each bet in the STORAGE_FILEPATH file.
+Persist the information of each bet in the STORAGE_FILEPATH file,
+or in the given CSV file.
 Not thread-safe/process-safe.
 """
-def store_bets(bets: list[Bet]) -> None:
-    with open(STORAGE_FILEPATH, 'a+') as file:
+def store_bets(bets: list[Bet], filepath: str = STORAGE_FILEPATH) -> None:
+    with open(filepath, 'a+') as file:
         writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
         for bet in bets:
             writer.writerow([bet.agency, bet.first_name, bet.last_name,
                              bet.document, bet.birthdate, bet.number])
 
 """
-Loads the information all the bets in the STORAGE_FILEPATH file.
+Loads the information all the bets in the STORAGE_FILEPATH file,
+or in the given CSV file.
+Names are interned, so loaded bets share one object per name.
 Not thread-safe/process-safe.
 """
-def load_bets() -> list[Bet]:
-    with open(STORAGE_FILEPATH, 'r') as file:
+def load_bets(filepath: str = STORAGE_FILEPATH) -> list[Bet]:
+    with open(filepath, 'r') as file:
         reader = csv.reader(file, quoting=csv.QUOTE_MINIMAL)
         for row in reader:
-            yield Bet(row[0], row[1], row[2], row[3], row[4], row[5])
+            yield Bet(row[0], sys.intern(row[1]), sys.intern(row[2]), row[3], row[4], row[5])
 
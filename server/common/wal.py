@@ -0,0 +1,279 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Optional
+from .draw import DrawEngine, DEFAULT_DRAW_ENGINE
+from .winners import load_winners_index
+
+
+""" Default location of the write-ahead log. """
+WAL_FILEPATH = "./bets.wal"
+
+_RECORD_FRAME = struct.Struct('>II')
+_RECORD_CHECKPOINT = 1
+_RECORD_BATCH = 2
+_RECORD_FINISHED = 3
+_CHECKPOINT_HEADER = struct.Struct('>BQQII')
+_BATCH_HEADER = struct.Struct('>BIIQII')
+_AGENCY_BETS = struct.Struct('>II')
+_FINISHED = struct.Struct('>BI')
+_WINNER = struct.Struct('>II')
+_AGENCY_WINNER = struct.Struct('>III')
+""" Records above which the log is compacted when the server starts. """
+COMPACT_MIN_RECORDS = 1024
+
+
+class WalState:
+    """
+    Server state rebuilt from the write-ahead log
+    """
+    def __init__(self):
+        # Bytes of the bets storage covered by a committed record
+        self.storage_size = 0
+        # (document, tier) winners per agency id, as kept by `WinnersIndex`
+        self.winners = {}
+        # Stored bets per agency id
+        self.bets = {}
+        # Agency ids that finished sending their bets
+        self.finished_agencies = []
+        # Last stored sequence number per agency
+        self.sequence_numbers = {}
+        # `DrawEngine.fingerprint` of the rules the winners were classified by
+        self.rules_fingerprint = 0
+        # Records read from the log
+        self.records = 0
+
+
+class WriteAheadLog:
+    """
+    Append-only log of the commits of the bets storage and of the agencies
+    that finished sending their bets
+
+    The storage writer appends a batch record for every stored batch, once
+    the batch is in the storage and before acking it, with the storage
+    size after its group commit, its number of bets, its winners with their
+    tier and, for a sequenced batch, its sequence number.
+    Recovery then only reads this small log: the storage is truncated to
+    the last committed size and the winners index, with its bet counts, is
+    rebuilt without scanning the bets.
+
+    Every record is framed as length(4), crc32(4), payload, so a record
+    left half-written by a crash is detected and dropped. Since the log
+    grows with every stored batch, `compact` rewrites it as the few records
+    of the recovered state.
+    """
+    def __init__(self, filepath: str = WAL_FILEPATH):
+        self.filepath = filepath
+        self._file = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def read(self) -> Optional[WalState]:
+        """
+        Rebuild the state from the log, or return None if it has no records
+
+        A torn record at the end of the log is truncated away, while a
+        whole record of an unknown format raises ValueError.
+        """
+        if not os.path.exists(self.filepath):
+            return None
+        with open(self.filepath, 'rb') as file:
+            data = file.read()
+
+        state = WalState()
+        offset = 0
+        finished = set()
+        while offset + _RECORD_FRAME.size <= len(data):
+            length, checksum = _RECORD_FRAME.unpack_from(data, offset)
+            payload = data[offset + _RECORD_FRAME.size:offset + _RECORD_FRAME.size + length]
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                break
+            try:
+                self.__apply(state, finished, payload)
+            except (IndexError, struct.error) as e:
+                raise ValueError(f"malformed write-ahead log record: {e}") from e
+            offset += _RECORD_FRAME.size + length
+            state.records += 1
+
+        if offset != len(data):
+            logging.warning(f"action: recover_wal | result: warning | error: dropped {len(data) - offset} bytes of a torn record")
+            with open(self.filepath, 'r+b') as file:
+                file.truncate(offset)
+        return state if state.records else None
+
+    def append_checkpoint(self, storage_size: int, winners: dict, bets: dict, rules_fingerprint: int) -> None:
+        """
+        Record the whole state of a storage that was filled without a log,
+        with the winners classified by the rules of the given fingerprint
+        """
+        self.__append(_checkpoint_payload(storage_size, winners, bets, rules_fingerprint))
+
+    def append_batch(self, agency: int, sequence_number: int, storage_size: int, winners: list, bets: int = 0) -> None:
+        """
+        Record a stored batch of the given number of bets and its (document, tier)
+        winners, sequence_number is 0 unless the batch is sequenced
+        """
+        self.__append(_batch_payload(agency, sequence_number, storage_size, winners, bets))
+
+    def append_finished(self, agency: int) -> None:
+        self.__append(_FINISHED.pack(_RECORD_FINISHED, agency))
+
+    def compact(self, state: WalState) -> None:
+        """
+        Replace the log with a checkpoint of the given state, followed by a
+        record per stored sequence number and per finished agency
+
+        The new log is written aside and renamed over the old one, so a
+        crash while compacting leaves either of them whole.
+        """
+        payloads = [_checkpoint_payload(state.storage_size, state.winners, state.bets, state.rules_fingerprint)]
+        payloads.extend(_batch_payload(agency, sequence_number, state.storage_size, [], 0)
+                        for agency, sequence_number in sorted(state.sequence_numbers.items()))
+        payloads.extend(_FINISHED.pack(_RECORD_FINISHED, int(agency_id)) for agency_id in state.finished_agencies)
+
+        self.close()
+        compacted_filepath = self.filepath + ".compact"
+        with open(compacted_filepath, 'wb') as file:
+            file.write(b''.join(_frame(payload) for payload in payloads))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(compacted_filepath, self.filepath)
+        logging.info(f"action: compact_wal | result: success | records: {state.records} | compacted_records: {len(payloads)}")
+        state.records = len(payloads)
+
+    def flush(self, sync: bool) -> None:
+        """
+        Write the appended records, and fsync them if sync is set
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            if self._file is None:
+                self._file = open(self.filepath, 'ab')
+            self._file.write(b''.join(self._pending))
+            self._pending = []
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def discard(self) -> None:
+        """
+        Remove the log along with any appended record not yet written
+        """
+        self.close()
+        with self._lock:
+            self._pending = []
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def __append(self, payload: bytes) -> None:
+        with self._lock:
+            self._pending.append(_frame(payload))
+
+    @staticmethod
+    def __apply(state: WalState, finished: set, payload: bytes) -> None:
+        record_type = payload[0]
+        if record_type == _RECORD_CHECKPOINT:
+            _, state.storage_size, state.rules_fingerprint, agencies, _ = _CHECKPOINT_HEADER.unpack_from(payload)
+            rows_offset = _CHECKPOINT_HEADER.size + agencies * _AGENCY_BETS.size
+            state.bets = {str(agency): bets for agency, bets in
+                          _AGENCY_BETS.iter_unpack(payload[_CHECKPOINT_HEADER.size:rows_offset])}
+            state.winners = {}
+            for agency, document, tier in _AGENCY_WINNER.iter_unpack(payload[rows_offset:]):
+                state.winners.setdefault(str(agency), []).append((str(document), tier))
+        elif record_type == _RECORD_BATCH:
+            _, agency, sequence_number, storage_size, bets, count = _BATCH_HEADER.unpack_from(payload)
+            state.storage_size = max(state.storage_size, storage_size)
+            if bets:
+                state.bets[str(agency)] = state.bets.get(str(agency), 0) + bets
+            if count:
+                winners = _WINNER.iter_unpack(payload[_BATCH_HEADER.size:])
+                state.winners.setdefault(str(agency), []).extend((str(document), tier) for document, tier in winners)
+            if sequence_number:
+                state.sequence_numbers[agency] = max(sequence_number, state.sequence_numbers.get(agency, 0))
+        elif record_type == _RECORD_FINISHED:
+            agency_id = str(_FINISHED.unpack_from(payload)[1])
+            if agency_id not in finished:
+                finished.add(agency_id)
+                state.finished_agencies.append(agency_id)
+        else:
+            raise ValueError(f"unknown write-ahead log record type: {record_type}")
+
+
+def _frame(payload: bytes) -> bytes:
+    return _RECORD_FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _checkpoint_payload(storage_size: int, winners: dict, bets: dict, rules_fingerprint: int) -> bytes:
+    rows = [(int(agency_id), int(document), tier)
+            for agency_id, agency_winners in winners.items() for document, tier in agency_winners]
+    return (_CHECKPOINT_HEADER.pack(_RECORD_CHECKPOINT, storage_size, rules_fingerprint, len(bets), len(rows))
+            + b''.join(_AGENCY_BETS.pack(int(agency_id), count) for agency_id, count in bets.items())
+            + b''.join(_AGENCY_WINNER.pack(*row) for row in rows))
+
+
+def _batch_payload(agency: int, sequence_number: int, storage_size: int, winners: list, bets: int) -> bytes:
+    return (_BATCH_HEADER.pack(_RECORD_BATCH, agency, sequence_number, storage_size, bets, len(winners))
+            + b''.join(_WINNER.pack(*winner) for winner in winners))
+
+
+def recover(storage, wal: WriteAheadLog, engine: DrawEngine = DEFAULT_DRAW_ENGINE) -> WalState:
+    """
+    Bring the storage back to its last committed state and return the
+    state recorded by the log
+
+    Bets past the last committed record, such as a half-written row or a
+    group that was never acked, are truncated. A storage without a log is
+    scanned once, classified by engine, and its state recorded as a
+    checkpoint of a new log, and so is a storage whose log has a record of
+    an unknown format. If the log classified the winners by other rules
+    than engine, they are classified again by scanning the storage and the
+    log is compacted under the rules of engine. A log of more than
+    `COMPACT_MIN_RECORDS` records is compacted too, so the next start reads
+    only the recovered state.
+    """
+    try:
+        state = wal.read()
+    except ValueError as e:
+        logging.warning(f"action: recover_wal | result: warning | error: {e}, rebuilding the log from the storage")
+        wal.discard()
+        state = None
+    if state is None:
+        state = WalState()
+        state.storage_size = storage.size()
+        index = load_winners_index(storage, engine)
+        state.winners = index.snapshot()
+        state.bets = index.bet_counts()
+        state.rules_fingerprint = engine.fingerprint
+        wal.append_checkpoint(state.storage_size, state.winners, state.bets, state.rules_fingerprint)
+        wal.flush(sync=True)
+        logging.info(f"action: recover_wal | result: success | storage_size: {state.storage_size} | checkpoint: true")
+        return state
+
+    size = storage.size()
+    if size > state.storage_size:
+        storage.truncate(state.storage_size)
+        logging.warning(f"action: recover_wal | result: warning | error: truncated {size - state.storage_size} uncommitted bytes of the storage")
+    elif size < state.storage_size:
+        logging.error(f"action: recover_wal | result: fail | error: storage has {size} bytes, the log committed {state.storage_size}")
+    if state.rules_fingerprint != engine.fingerprint:
+        logging.warning("action: recover_wal | result: warning | error: the draw rules changed, classifying the stored bets again")
+        index = load_winners_index(storage, engine)
+        state.winners = index.snapshot()
+        state.bets = index.bet_counts()
+        state.rules_fingerprint = engine.fingerprint
+        wal.compact(state)
+    elif state.records > COMPACT_MIN_RECORDS:
+        wal.compact(state)
+
+    logging.info(f"action: recover_wal | result: success | storage_size: {state.storage_size} | "
+                 f"finished_agencies: {len(state.finished_agencies)} | sequenced_agencies: {len(state.sequence_numbers)}")
+    return state
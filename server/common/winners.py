@@ -0,0 +1,178 @@
+import logging
+import threading
+from typing import Iterable, Tuple
+from .draw import compute_winners, DrawEngine, DEFAULT_DRAW_ENGINE, DEFAULT_TIER
+from .protocol import encode_tallies, encode_winners
+from .utils import Bet, BetBatch
+
+
+# Responses of an agency without winners, as (documents, tiered) responses
+_NO_WINNERS_RESPONSES = (encode_winners([]), encode_winners([], tiered=True))
+
+
+class WinnersIndex:
+    """
+    Per-agency index of the documents that won the lottery, with their prize tier
+
+    The index is kept up to date as bets are stored, so answering a winners
+    query only costs the number of winners of the queried agency and does
+    not need to scan the bets storage nor hold the storage lock. Bets are
+    classified by the draw `engine`.
+
+    It also counts the bets stored per agency, so the running tallies of
+    bets and winners can be answered at any time, before the draw too.
+
+    Once the draw makes the winners final, `publish` encodes the winners
+    responses of every agency, so each query is answered with the same
+    immutable bytes without taking the lock nor encoding again.
+    """
+    def __init__(self, engine: DrawEngine = DEFAULT_DRAW_ENGINE):
+        self.engine = engine
+        self._winners = {}
+        self._bets = {}
+        self._lock = threading.Lock()
+        self._responses = None
+
+    def add_bets(self, bets: Iterable[Bet]) -> None:
+        """
+        Register the winning bets among the given ones
+        """
+        counts = {}
+        winners = []
+        for bet in bets:
+            agency_id = str(bet.agency)
+            counts[agency_id] = counts.get(agency_id, 0) + 1
+            tier = self.engine.tier(bet.agency, bet.number)
+            if tier:
+                winners.append((agency_id, (bet.document, tier)))
+
+        with self._lock:
+            for agency_id, count in counts.items():
+                self._bets[agency_id] = self._bets.get(agency_id, 0) + count
+            for agency_id, winner in winners:
+                self._winners.setdefault(agency_id, []).append(winner)
+
+    def add_batch(self, batch: BetBatch) -> None:
+        """
+        Count the bets of a stored batch and register its winning bets,
+        looking only at its numbers column
+        """
+        winners = [(str(document), tier) for document, tier in self.engine.batch_winners(batch)]
+        agency_id = str(batch.agency)
+        with self._lock:
+            self._bets[agency_id] = self._bets.get(agency_id, 0) + len(batch)
+            if winners:
+                self._winners.setdefault(agency_id, []).extend(winners)
+
+    def add_winner(self, agency_id: str, document: str, tier: int = DEFAULT_TIER) -> None:
+        with self._lock:
+            self._winners.setdefault(agency_id, []).append((document, tier))
+
+    def snapshot(self) -> dict:
+        """
+        Return a copy of the (document, tier) winners of every agency
+        """
+        with self._lock:
+            return {agency_id: list(winners) for agency_id, winners in self._winners.items()}
+
+    def bet_counts(self) -> dict:
+        """
+        Return a copy of the number of bets stored per agency
+        """
+        with self._lock:
+            return dict(self._bets)
+
+    def replace(self, winners: dict, bets: dict = None) -> None:
+        """
+        Replace the whole index with the given (document, tier) winners per
+        agency, and the bet counts per agency if given
+        """
+        winners = {agency_id: list(agency_winners) for agency_id, agency_winners in winners.items()}
+        with self._lock:
+            self._winners = winners
+            if bets is not None:
+                self._bets = dict(bets)
+
+    def tallies(self) -> list[Tuple[int, int, int]]:
+        """
+        Return the running (agency, bets, winners) of every agency with
+        stored bets or winners, ordered by agency
+        """
+        with self._lock:
+            agency_ids = self._bets.keys() | self._winners.keys()
+            tallies = [(int(agency_id), self._bets.get(agency_id, 0), len(self._winners.get(agency_id, ())))
+                       for agency_id in agency_ids]
+        return sorted(tallies)
+
+    def tallies_response(self) -> bytes:
+        """
+        Return the encoded running tallies of every agency
+        """
+        return encode_tallies(self.tallies())
+
+    def publish(self) -> None:
+        """
+        Encode the documents and the tiered winners responses of every agency
+
+        Meant to run once, when the draw is done: winners added afterwards
+        are not answered.
+        """
+        with self._lock:
+            winners = {agency_id: list(agency_winners) for agency_id, agency_winners in self._winners.items()}
+        responses = {}
+        for agency_id, agency_winners in winners.items():
+            documents = [document for document, _ in agency_winners]
+            responses[agency_id] = (encode_winners(documents), encode_winners(agency_winners, tiered=True))
+        # Replaced as a whole, so readers never see it half built
+        self._responses = responses
+        logging.debug(f"action: publish_winners | result: success | agencies: {len(responses)} | "
+                      f"winners_count: {sum(len(agency_winners) for agency_winners in winners.values())}")
+
+    def winners_response(self, agency_id: str, tiered: bool = False) -> bytes:
+        """
+        Return the encoded winners response of an agency, as documents or as
+        (document, tier) pairs if tiered
+
+        Published responses are returned as is, before `publish` the
+        response is encoded from the current winners.
+        """
+        responses = self._responses
+        if responses is None:
+            winners = self.tiered_winners_for_agency(agency_id) if tiered else self.winners_for_agency(agency_id)
+            return encode_winners(winners, tiered)
+        return responses.get(agency_id, _NO_WINNERS_RESPONSES)[tiered]
+
+    def winners_for_agency(self, agency_id: str) -> list[str]:
+        """
+        Return the documents of the winning bets of the given agency, of every tier
+        """
+        with self._lock:
+            return [document for document, _ in self._winners.get(agency_id, ())]
+
+    def tiered_winners_for_agency(self, agency_id: str) -> list[Tuple[str, int]]:
+        """
+        Return the (document, tier) of the winning bets of the given agency
+        """
+        with self._lock:
+            return list(self._winners.get(agency_id, ()))
+
+
+def load_winners_index(storage, engine: DrawEngine = DEFAULT_DRAW_ENGINE) -> WinnersIndex:
+    """
+    Build a winners index with the bets stored before the server started
+
+    The storage is scanned only once at startup, as columns classified in
+    bulk by `draw.compute_winners`, which counts the bets of every agency
+    too, from then on the index is kept up to date as new batches are stored.
+    """
+    index = WinnersIndex(engine)
+    if not storage.exists():
+        return index
+
+    try:
+        bets = {}
+        index.replace(compute_winners(storage, engine, bets=bets), bets)
+        logging.debug("action: load_stored_winners | result: success")
+    except Exception as e:
+        logging.error(f"action: load_stored_winners | result: fail | error: {e}")
+    return index
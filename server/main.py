@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
 from configparser import ConfigParser
-from common.server import Server
+from common.metrics import MetricsServer, SERVER_READY, STARTUP_SECONDS
+from common.storage import create_storage, shard_filepath, STORAGE_BACKENDS
+from common.storage_writer import StorageWriter, FSYNC_POLICIES
+from common.compression import parse_compression_codecs
+from common.draw import DrawEngine, parse_draw_rules
+from common.logs import initialize_log, stop_log
+from common.lottery import Lottery
+from common.wal import WriteAheadLog, recover
+from common.winners import WinnersIndex, load_winners_index
+from functools import partial
 import logging
 import os
-import signal
-import sys
+import time
+
+SERVER_ENGINES = ("threads", "asyncio")
 
 
 def initialize_config():
@@ -19,16 +29,65 @@ def initialize_config():
     with config parameters
     """
 
-    config = ConfigParser(os.environ)
+    config = ConfigParser(interpolation=None)
     # If config.ini does not exists original config object is not modified
     config.read("config.ini")
 
+    def config_value(key):
+        # Environment variables override the config file, and may set keys it lacks
+        value = os.environ.get(key)
+        return value if value is not None else config["DEFAULT"][key]
+
     config_params = {}
     try:
-        config_params["port"] = int(os.getenv('SERVER_PORT', config["DEFAULT"]["SERVER_PORT"]))
-        config_params["listen_backlog"] = int(os.getenv('SERVER_LISTEN_BACKLOG', config["DEFAULT"]["SERVER_LISTEN_BACKLOG"]))
-        config_params["logging_level"] = os.getenv('LOGGING_LEVEL', config["DEFAULT"]["LOGGING_LEVEL"])
-        config_params["num_agencies"] = int(os.getenv('NUM_AGENCIES', config["DEFAULT"]["NUM_AGENCIES"]))
+        config_params["port"] = int(config_value('SERVER_PORT'))
+        config_params["listen_backlog"] = int(config_value('SERVER_LISTEN_BACKLOG'))
+        config_params["logging_level"] = config_value('LOGGING_LEVEL')
+        logging_async = config_value('LOGGING_ASYNC').lower()
+        if logging_async not in config.BOOLEAN_STATES:
+            raise ValueError(f"invalid boolean for LOGGING_ASYNC: {logging_async}")
+        config_params["logging_async"] = config.BOOLEAN_STATES[logging_async]
+        config_params["logging_batch_sample"] = int(config_value('LOGGING_BATCH_SAMPLE'))
+        if config_params["logging_batch_sample"] < 1:
+            raise ValueError(f"invalid batch log sample: {config_params['logging_batch_sample']}")
+        config_params["num_agencies"] = int(config_value('NUM_AGENCIES'))
+        config_params["max_message_size"] = int(config_value('SERVER_MAX_MESSAGE_SIZE'))
+        config_params["workers"] = int(config_value('SERVER_WORKERS'))
+        if config_params["workers"] < 1:
+            raise ValueError(f"invalid number of workers: {config_params['workers']}")
+        config_params["metrics_port"] = int(config_value('METRICS_PORT'))
+        config_params["engine"] = config_value('SERVER_ENGINE')
+        if config_params["engine"] not in SERVER_ENGINES:
+            raise ValueError(f"unknown server engine: {config_params['engine']}")
+        config_params["max_clients"] = int(config_value('SERVER_MAX_CLIENTS'))
+        config_params["accept_queue_size"] = int(config_value('SERVER_ACCEPT_QUEUE_SIZE'))
+        if config_params["max_clients"] < 1 or config_params["accept_queue_size"] < 1:
+            raise ValueError("max clients and accept queue size must be positive")
+        config_params["async_max_clients"] = int(config_value('SERVER_ASYNC_MAX_CLIENTS'))
+        if config_params["async_max_clients"] < 0:
+            raise ValueError("async max clients must not be negative")
+        # Agencies keep their connection until the draw, which needs all of them
+        max_clients = config_params["async_max_clients"] if config_params["engine"] == "asyncio" else config_params["max_clients"]
+        if max_clients and max_clients < config_params["num_agencies"]:
+            raise ValueError(f"max clients {max_clients} of the {config_params['engine']} engine is lower than "
+                             f"num_agencies {config_params['num_agencies']}, the draw would never take place")
+        config_params["idle_timeout"] = float(config_value('CLIENT_IDLE_TIMEOUT'))
+        config_params["max_in_flight_batches"] = int(config_value('SERVER_MAX_INFLIGHT_BATCHES'))
+        if config_params["max_in_flight_batches"] < 1:
+            raise ValueError("max in-flight batches must be positive")
+        config_params["storage_backend"] = config_value('STORAGE_BACKEND')
+        if config_params["storage_backend"] not in STORAGE_BACKENDS:
+            raise ValueError(f"unknown storage backend: {config_params['storage_backend']}")
+        config_params["storage_filepath"] = config_value('STORAGE_FILEPATH')
+        config_params["storage_fsync"] = config_value('STORAGE_FSYNC')
+        if config_params["storage_fsync"] not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy: {config_params['storage_fsync']}")
+        config_params["storage_group_max_batches"] = int(config_value('STORAGE_GROUP_MAX_BATCHES'))
+        config_params["storage_group_delay_ms"] = int(config_value('STORAGE_GROUP_DELAY_MS'))
+        config_params["wal_filepath"] = config_value('STORAGE_WAL_FILEPATH')
+        config_params["draw_rules"] = parse_draw_rules(config_value('DRAW_RULES'))
+        config_params["readiness_filepath"] = config_value('READINESS_FILEPATH')
+        config_params["compression_codecs"] = parse_compression_codecs(config_value('COMPRESSION_CODECS'))
     except KeyError as e:
         raise KeyError("Key was not found. Error: {} .Aborting server".format(e))
     except ValueError as e:
@@ -37,43 +96,148 @@ def initialize_config():
     return config_params
 
 
-def signal_handler(sig, frame):
-    logging.info("action: sigterm_received | result: success")
-    sys.exit(0)
-
-
 def main():
-    signal.signal(signal.SIGTERM, signal_handler)
-    
+    # Time to recover the storage and start serving, without the interpreter startup and imports
+    started_at = time.monotonic()
     config_params = initialize_config()
     logging_level = config_params["logging_level"]
     port = config_params["port"]
     listen_backlog = config_params["listen_backlog"]
     num_agencies = config_params["num_agencies"]
+    engine = config_params["engine"]
+    workers = config_params["workers"]
+    storage_backend = config_params["storage_backend"]
+    storage_fsync = config_params["storage_fsync"]
 
-    initialize_log(logging_level)
+    initialize_log(logging_level, config_params["logging_async"], config_params["logging_batch_sample"])
 
     # Log config parameters at the beginning of the program to verify the configuration
     # of the component
     logging.debug(f"action: config | result: success | port: {port} | "
-                  f"listen_backlog: {listen_backlog} | logging_level: {logging_level} | num_agencies: {num_agencies}")
-
-    # Initialize server and start server loop
-    server = Server(port, listen_backlog, num_agencies)
+                  f"listen_backlog: {listen_backlog} | logging_level: {logging_level} | num_agencies: {num_agencies} | "
+                  f"engine: {engine} | workers: {workers} | storage_backend: {storage_backend} | storage_fsync: {storage_fsync}")
+
+    # The server engine installs its own SIGTERM handler. Until then, SIGTERM
+    # kills the process, which the write-ahead log recovers from.
+    readiness_filepath = config_params["readiness_filepath"]
+    clear_ready(readiness_filepath)
+    on_ready = partial(report_ready, started_at, readiness_filepath)
+    if workers > 1:
+        from common.sharding import ShardedServer
+        server = ShardedServer(num_agencies, workers, partial(create_shard_server, config_params, started_at), on_ready)
+    else:
+        start_metrics_server(config_params["metrics_port"])
+        storage = create_storage(storage_backend, config_params["storage_filepath"])
+        server = create_server(config_params, storage, config_params["wal_filepath"], Lottery(num_agencies), on_ready=on_ready)
     server.run()
+    stop_log()
 
-def initialize_log(logging_level):
+
+def create_server(config_params, storage, wal_filepath, lottery, **kwargs):
+    """
+    Create the server of the configured engine over the given storage
+
+    With a write-ahead log, the storage is recovered to its last committed
+    state, and the winners, the finished agencies and the stored sequence
+    numbers are restored from the log instead of scanning the storage.
+    The indexes of the storage are caught up before serving either way.
+    Winners are classified by the draw engine of the configured rules.
+    Only the modules of the configured engine are imported.
+    """
+    draw_engine = DrawEngine(config_params["draw_rules"])
+    wal = None
+    sequence_numbers = {}
+    finished_agencies = []
+    if wal_filepath:
+        wal = WriteAheadLog(wal_filepath)
+        state = recover(storage, wal, draw_engine)
+        winners_index = WinnersIndex(draw_engine)
+        winners_index.replace(state.winners, state.bets)
+        sequence_numbers = state.sequence_numbers
+        finished_agencies = state.finished_agencies
+    else:
+        winners_index = load_winners_index(storage, draw_engine)
+    # Caught up now, rather than by the first batch or lookup while the other waits
+    storage.open_indexes()
+
+    storage_writer = StorageWriter(storage, config_params["storage_fsync"],
+                                   config_params["storage_group_max_batches"],
+                                   config_params["storage_group_delay_ms"] / 1000,
+                                   wal, sequence_numbers, draw_engine)
+    if config_params["workers"] > 1:
+        # The `ShardLottery` of a worker answers the coordinator from the index,
+        # and shares the sequence numbers of the writer with the other workers
+        lottery.start(winners_index, storage_writer)
+    for agency_id in finished_agencies:
+        lottery.mark_finished(agency_id)
+    kwargs["lottery"] = lottery
+    kwargs["winners_index"] = winners_index
+    kwargs["idle_timeout"] = config_params["idle_timeout"] or None
+    kwargs["max_in_flight_batches"] = config_params["max_in_flight_batches"]
+    kwargs["compression_codecs"] = config_params["compression_codecs"]
+    if config_params["engine"] == "asyncio":
+        from common.async_server import AsyncServer
+        server_class = AsyncServer
+        kwargs["max_clients"] = config_params["async_max_clients"] or None
+    else:
+        from common.server import Server
+        server_class = Server
+        kwargs["max_clients"] = config_params["max_clients"]
+        kwargs["accept_queue_size"] = config_params["accept_queue_size"]
+    return server_class(config_params["port"], config_params["listen_backlog"], config_params["num_agencies"],
+                        storage_writer, config_params["max_message_size"], **kwargs)
+
+
+def create_shard_server(config_params, started_at, shard, lottery):
+    """
+    Create the server of a worker process, over its own storage shard
     """
-    Python custom logging initialization
+    def on_ready():
+        report_ready(started_at, shard=shard)
+        lottery.notify_ready()
+
+    if config_params["metrics_port"]:
+        # Each worker has its own metrics, served on consecutive ports
+        start_metrics_server(config_params["metrics_port"] + shard)
+    backend = config_params["storage_backend"]
+    storage = create_storage(backend, shard_filepath(backend, config_params["storage_filepath"], shard))
+    wal_filepath = config_params["wal_filepath"]
+    if wal_filepath:
+        wal_filepath = shard_filepath(backend, wal_filepath, shard)
+    return create_server(config_params, storage, wal_filepath, lottery, reuse_port=True, on_ready=on_ready)
+
+
+def report_ready(started_at, readiness_filepath="", shard=None):
+    """
+    Report that the server accepts connections: in the logs, in the metrics
+    and, unless readiness_filepath is empty, by creating that file for
+    orchestrator readiness probes
+    """
+    startup_seconds = time.monotonic() - started_at
+    SERVER_READY.set(1)
+    STARTUP_SECONDS.set(startup_seconds)
+    if readiness_filepath:
+        with open(readiness_filepath, 'w') as file:
+            file.write(f"{os.getpid()}\n")
+    shard_field = "" if shard is None else f" | shard: {shard}"
+    logging.info(f"action: server_ready | result: success | startup_seconds: {startup_seconds:.3f}{shard_field}")
+
+
+def clear_ready(readiness_filepath):
+    """
+    Remove the readiness file left by a previous run, so the server is not
+    reported ready while it recovers
+    """
+    if readiness_filepath and os.path.exists(readiness_filepath):
+        os.remove(readiness_filepath)
 
-    Current timestamp is added to be able to identify in docker
-    compose logs the date when the log has arrived
+
+def start_metrics_server(port):
+    """
+    Serve the metrics of this process at http://localhost:<port>/metrics, unless port is 0
     """
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=logging_level,
-        datefmt='%Y-%m-%d %H:%M:%S',
-    )
+    if port:
+        MetricsServer(port).start()
 
 
 if __name__ == "__main__":
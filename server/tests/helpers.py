@@ -0,0 +1,14 @@
+from common.utils import Bet, BetBatch
+
+def batch(agency, *numbers):
+    """
+    Batch of the agency with a bet per number, whose document is 10000000
+    plus the number
+    """
+    bets = BetBatch(agency)
+    for number in numbers:
+        bets.append('first', 'last', 10000000 + number, 20001220, number)
+    return bets
+
+def bet_fields(bet):
+    return [getattr(bet, field) for field in Bet.__slots__]
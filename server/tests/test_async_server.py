@@ -0,0 +1,158 @@
+from common.async_server import AsyncServer
+from common.protocol import encode_batch_ack, encode_response, encode_winners
+from common.storage import BinaryBetStorage
+from common.storage_writer import StorageWriter
+from common.utils import LOTTERY_WINNER_NUMBER
+import os
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+def encode_bet(document, number):
+    return struct.pack('>I5sI4sIII', 5, b'first', 4, b'last', document, 20001220, number)
+
+def encode_batch(agency, *numbers, sequence_number=None):
+    body = struct.pack('>II', agency, len(numbers)) + b''.join(encode_bet(10000000 + number, number) for number in numbers)
+    if sequence_number is None:
+        return struct.pack('>II', 1, len(body)) + body
+    return struct.pack('>III', 4, sequence_number, len(body)) + body
+
+def encode_message(message_type, agency):
+    return struct.pack('>III', message_type, 4, agency)
+
+def receive_response(client):
+    data = b''
+    while len(data) < 4 or len(data) < 4 + struct.unpack('>I', data[:4])[0]:
+        received = client.recv(1024)
+        if not received:
+            break
+        data += received
+    return data
+
+class TestAsyncServer(unittest.TestCase):
+    """
+    The server runs in the main thread, where asyncio can handle SIGTERM,
+    while each test talks to it from a client thread
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = BinaryBetStorage(os.path.join(directory.name, 'bets.log'))
+        self.ready = threading.Event()
+        self.server = AsyncServer(0, 5, 2, StorageWriter(self.storage), 1024, idle_timeout=5, on_ready=self.ready.set)
+        self.port = self.server._server_socket.getsockname()[1]
+        self.stopping = False
+
+    def stop(self):
+        self.stopping = True
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def connect(self):
+        client = socket.create_connection(('127.0.0.1', self.port))
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        return client
+
+    def serve(self, client):
+        """
+        Run the server until client returns, then stop it with SIGTERM
+        unless client did
+        """
+        errors = []
+
+        def run_client():
+            try:
+                self.assertTrue(self.ready.wait(5))
+                client()
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                if not self.stopping:
+                    self.stop()
+
+        thread = threading.Thread(target=run_client)
+        thread.start()
+        self.server.run()
+        thread.join(5)
+        if errors:
+            raise errors[0]
+
+    def test_batches_must_be_stored_and_answered(self):
+        def client():
+            agency = self.connect()
+            agency.sendall(encode_batch(1, 1, 2))
+            self.assertEqual(encode_response(True), receive_response(agency))
+            agency.sendall(encode_batch(1, 3, sequence_number=1) + encode_batch(1, 4, sequence_number=2))
+            # Acks are cumulative, batches stored apart are acked apart
+            ack = receive_response(agency)
+            if ack == encode_batch_ack(True, 1):
+                ack = receive_response(agency)
+            self.assertEqual(encode_batch_ack(True, 2), ack)
+
+        self.serve(client)
+        self.assertEqual([1, 2, 3, 4], [bet.number for bet in self.storage.load_bets()])
+
+    def test_winners_query_must_be_answered_once_every_agency_finished(self):
+        def client():
+            first = self.connect()
+            first.sendall(encode_batch(1, 1, LOTTERY_WINNER_NUMBER))
+            self.assertEqual(encode_response(True), receive_response(first))
+            first.sendall(encode_message(2, 1))
+            self.assertEqual(encode_response(True), receive_response(first))
+            first.sendall(encode_message(3, 1))
+            first.settimeout(0.2)
+            with self.assertRaises(socket.timeout):
+                first.recv(16)
+
+            second = self.connect()
+            second.sendall(encode_message(2, 2))
+            self.assertEqual(encode_response(True), receive_response(second))
+            first.settimeout(5)
+            self.assertEqual(encode_winners([str(10000000 + LOTTERY_WINNER_NUMBER)]), receive_response(first))
+
+        self.serve(client)
+
+    def test_draw_must_not_block_other_connections(self):
+        drawing = threading.Event()
+        self.server._lottery.add_draw_hook(lambda: (drawing.set(), time.sleep(1)))
+
+        def client():
+            first = self.connect()
+            first.sendall(encode_message(2, 1))
+            self.assertEqual(encode_response(True), receive_response(first))
+            second = self.connect()
+            second.sendall(encode_message(2, 2))
+            self.assertTrue(drawing.wait(5))
+
+            start = time.monotonic()
+            first.sendall(encode_batch(1, 1))
+            self.assertEqual(encode_response(True), receive_response(first))
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertEqual(encode_response(True), receive_response(second))
+
+        self.serve(client)
+
+    def test_sigterm_must_answer_waiting_winners_query_with_error(self):
+        def client():
+            agency = self.connect()
+            agency.sendall(encode_message(2, 1))
+            self.assertEqual(encode_response(True), receive_response(agency))
+            agency.sendall(encode_message(3, 1))
+            agency.settimeout(0.2)
+            with self.assertRaises(socket.timeout):
+                agency.recv(16)
+
+            agency.settimeout(5)
+            self.stop()
+            self.assertEqual(encode_response(False), receive_response(agency))
+            self.assertEqual(b'', agency.recv(16))
+
+        self.serve(client)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+from array import array
+from common.columns import ColumnCache, DEFAULT_CHUNK_BETS
+from helpers import batch
+import os
+import tempfile
+import time
+import unittest
+
+def scanned_numbers(cache, numbers_of=None):
+    return [number for _, _, chunk in cache.scan(DEFAULT_CHUNK_BETS, numbers_of) for number in chunk]
+
+class TestColumnCache(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.filepath = os.path.join(self._dir.name, 'bets.log.cols')
+
+    def new_cache(self, storage_size, walk_columns=lambda offset: iter(())):
+        cache = ColumnCache(self.filepath)
+        cache.SEGMENT_BETS = 4
+        cache.open(storage_size, walk_columns)
+        self.addCleanup(cache.close)
+        return cache
+
+    def wait_for_compaction(self, compacted):
+        deadline = time.monotonic() + 5
+        while not compacted() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(compacted())
+
+    def test_small_segments_must_be_compacted_in_the_background(self):
+        cache = self.new_cache(0)
+        for number in range(8):
+            cache.append(batch(number % 2 + 1, number))
+            cache.flush(number + 1, sync=False)
+
+        self.wait_for_compaction(lambda: len(os.listdir(self.filepath)) == 2)
+        self.assertEqual(list(range(8)), scanned_numbers(cache))
+        self.assertEqual({1: 4, 2: 4}, cache.bet_counts())
+        cache.close()
+
+        cache = self.new_cache(8)
+        self.assertEqual(list(range(8)), scanned_numbers(cache))
+
+    def test_scan_must_skip_segments_without_the_numbers_looked_for(self):
+        cache = self.new_cache(0)
+        cache.append(batch(1, 1, 2, 3, 4))
+        cache.flush(4, sync=False)
+        cache.append(batch(2, 5, 6, 7, 8))
+        cache.flush(8, sync=False)
+
+        # Only segments rewritten with a bloom filter by the compactor are skipped
+        self.wait_for_compaction(lambda: not scanned_numbers(cache, lambda agencies: {9999}))
+        self.assertEqual([5, 6, 7, 8], scanned_numbers(cache, lambda agencies: {7} if 2 in agencies else set()))
+
+    def test_open_must_catch_up_and_drop_segments_past_the_storage(self):
+        cache = self.new_cache(0)
+        cache.append(batch(1, 1, 2))
+        cache.flush(2, sync=False)
+        cache.append(batch(1, 3))
+        cache.flush(5, sync=False)
+        cache.close()
+
+        # The storage was truncated after the first flush, then got other bets
+        cache = self.new_cache(4, lambda offset: iter([(array('I', [3, 3]), array('I', [5, 6]), array('I', [offset, 9]))]))
+        self.assertEqual([1, 2, 2, 9], scanned_numbers(cache))
+        self.assertEqual({1: 2, 3: 2}, cache.bet_counts())
+
+if __name__ == '__main__':
+    unittest.main()
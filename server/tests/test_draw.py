@@ -0,0 +1,85 @@
+from array import array
+from common.draw import compute_winners, matching_indexes, parse_draw_rules, DrawEngine, DrawRule
+from common.storage import BinaryBetStorage, CsvBetStorage
+from common.utils import Bet, LOTTERY_WINNER_NUMBER
+from helpers import batch
+import os
+import tempfile
+import unittest
+
+class TestMatchingIndexes(unittest.TestCase):
+
+    def test_must_return_sorted_positions_of_every_winning_number(self):
+        numbers = array('I', [1, 7574, 2, 3, 7574, 3])
+        self.assertEqual([1, 3, 4, 5], matching_indexes(numbers, {7574, 3}))
+
+    def test_must_skip_matches_across_two_numbers(self):
+        # The bytes of 7574 only appear straddling both numbers
+        pattern = array('I', [7574]).tobytes()
+        numbers = array('I')
+        numbers.frombytes(b'\x00' * 2 + pattern + b'\x00' * 2)
+        self.assertEqual([], matching_indexes(numbers, {7574}))
+
+class TestDrawEngine(unittest.TestCase):
+
+    def test_parse_draw_rules_must_expand_ranges_and_agencies(self):
+        rules = parse_draw_rules("1:7574; 2:10-12,20@1,2")
+
+        self.assertEqual([1, 2], [rule.tier for rule in rules])
+        self.assertEqual({10, 11, 12, 20}, rules[1].numbers)
+        self.assertEqual(None, rules[0].agencies)
+        self.assertEqual({1, 2}, rules[1].agencies)
+
+    def test_lowest_tier_must_win_and_agency_rules_must_only_apply_to_their_agencies(self):
+        engine = DrawEngine(parse_draw_rules("2:5-9;1:7;3:5,100@1"))
+
+        self.assertEqual(1, engine.tier(2, 7))
+        self.assertEqual(2, engine.tier(1, 5))
+        self.assertEqual(3, engine.tier(1, 100))
+        self.assertEqual(0, engine.tier(2, 100))
+        self.assertEqual([(10000005, 2), (10000100, 3)], engine.batch_winners(batch(1, 5, 4, 100)))
+
+    def test_classify_columns_must_match_many_winning_numbers(self):
+        engine = DrawEngine([DrawRule(1, range(1000, 2000))])
+        numbers = array('I', [5, 1500, 1999, 2000])
+
+        self.assertEqual([(7, 21, 1), (7, 22, 1)],
+                         list(engine.classify_columns(array('I', [7] * 4), array('I', range(20, 24)), numbers)))
+
+class TestComputeWinners(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+
+    def test_must_match_bets_appended_and_stored_without_cache(self):
+        for storage in (BinaryBetStorage(os.path.join(self._dir.name, 'bets.log')),
+                        CsvBetStorage(os.path.join(self._dir.name, 'bets.csv'))):
+            storage.append(batch(1, LOTTERY_WINNER_NUMBER, 1, LOTTERY_WINNER_NUMBER + 1))
+            storage.flush(sync=False)
+            storage.store_bets([Bet('2', 'first', 'last', '20000000', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+            storage.append(batch(3, 2, LOTTERY_WINNER_NUMBER))
+            storage.flush(sync=False)
+
+            self.assertEqual({'1': [('10007574', 1)], '2': [('20000000', 1)], '3': [('10007574', 1)]},
+                             compute_winners(storage, chunk_bets=2))
+            storage.close()
+
+    def test_must_rebuild_columns_of_truncated_storage(self):
+        storage = BinaryBetStorage(os.path.join(self._dir.name, 'bets.log'))
+        storage.append(batch(1, LOTTERY_WINNER_NUMBER))
+        storage.flush(sync=False)
+        size = storage.size()
+        storage.append(batch(2, LOTTERY_WINNER_NUMBER))
+        storage.flush(sync=False)
+        storage.truncate(size)
+
+        self.assertEqual({'1': [('10007574', 1)]}, compute_winners(storage))
+        storage.append(batch(3, 3))
+        storage.flush(sync=False)
+        engine = DrawEngine([DrawRule(1, [LOTTERY_WINNER_NUMBER]), DrawRule(2, [3])])
+        self.assertEqual({'1': [('10007574', 1)], '3': [('10000003', 2)]}, compute_winners(storage, engine))
+        storage.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+from array import array
+from common.indexes import SortedRunIndex
+from common.storage import BinaryBetStorage, CsvBetStorage
+from common.utils import Bet, BetBatch
+import os
+import tempfile
+import unittest
+
+class TestSortedRunIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self._dir.name, 'bets.idx')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def new_index(self, storage_size):
+        index = SortedRunIndex(self.filepath)
+        index.RUN_ENTRIES = 10
+        index.FANOUT = 2
+        index.open(storage_size)
+        return index
+
+    def test_lookup_must_find_entries_across_runs_and_memory_in_storage_order(self):
+        index = self.new_index(0)
+        for start in range(0, 100, 5):
+            index.add(array('I', [offset % 3 for offset in range(start, start + 5)]), array('Q', range(start, start + 5)))
+            index.flush(start + 5)
+
+        self.assertEqual(list(range(1, 100, 3)), index.lookup(1))
+        self.assertEqual([2, 5, 8], index.lookup(2, limit=3))
+        self.assertEqual(33, index.count(2))
+        self.assertEqual(0, index.count(3))
+        index.close(100)
+
+        index = self.new_index(100)
+        self.assertEqual(100, index.covered)
+        self.assertEqual(list(range(0, 100, 3)), index.lookup(0))
+        index.close(100)
+
+    def test_open_must_drop_entries_past_a_truncated_storage(self):
+        index = self.new_index(0)
+        index.add(array('I', [7] * 20), array('Q', range(20)))
+        index.close(20)
+
+        index = self.new_index(10)
+        self.assertEqual(0, index.covered)
+        self.assertEqual([], index.lookup(7))
+        index.close(10)
+
+
+class TestStorageFindBets(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def assert_find_bets(self, storage):
+        storage.store_bets([Bet('1', 'Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', 1033)])
+        storage.append(BetBatch.from_bets(2, [Bet('2', 'first', 'last, "quoted"', str(10000000 + i % 2), '2000-12-20', i)
+                                              for i in range(5)]))
+        storage.flush(sync=False)
+
+        total, bets = storage.find_bets("document", 10000001)
+        self.assertEqual(2, total)
+        self.assertEqual([(2, 'last, "quoted"', 1), (2, 'last, "quoted"', 3)],
+                         [(bet.agency, bet.last_name, bet.number) for bet in bets])
+        self.assertEqual((0, []), storage.find_bets("document", 99))
+        storage.close()
+
+        # Indexes must be caught up with bets stored while they were lost
+        os.remove(storage.filepath + ".agency.idx")
+        total, bets = storage.find_bets("agency", 2, limit=2)
+        self.assertEqual(5, total)
+        self.assertEqual([0, 1], [bet.number for bet in bets])
+        total, bets = storage.find_bets("document", 34407251)
+        self.assertEqual(['Tiago Nicolás'], [bet.first_name for bet in bets])
+        storage.close()
+
+    def test_binary_storage_must_find_bets_by_document_and_agency(self):
+        self.assert_find_bets(BinaryBetStorage(os.path.join(self._dir.name, 'bets.log')))
+
+    def test_csv_storage_must_find_bets_by_document_and_agency(self):
+        self.assert_find_bets(CsvBetStorage(os.path.join(self._dir.name, 'bets.csv')))
+
+    def test_empty_storage_must_find_no_bets(self):
+        for storage in (BinaryBetStorage(os.path.join(self._dir.name, 'bets.log')),
+                        CsvBetStorage(os.path.join(self._dir.name, 'bets.csv'))):
+            self.assertEqual((0, []), storage.find_bets("agency", 1))
+            storage.close()
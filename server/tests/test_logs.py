@@ -0,0 +1,49 @@
+from common import logs
+import itertools
+import os
+import subprocess
+import sys
+import textwrap
+import unittest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class TestLogs(unittest.TestCase):
+
+    def test_log_batch_received_must_log_one_of_every_sample(self):
+        self.addCleanup(setattr, logs, '_batch_log_sample', logs._batch_log_sample)
+        logs._batch_log_sample = 3
+        logs._batches_received = itertools.count()
+        with self.assertLogs(level='INFO') as captured:
+            for cantidad in range(7):
+                logs.log_batch_received(cantidad)
+        self.assertEqual(3, len(captured.output))
+        self.assertTrue(all('action: apuesta_recibida | result: success | cantidad: ' in line for line in captured.output))
+
+    def test_asynchronous_log_must_write_every_record_of_forked_workers_in_order(self):
+        script = textwrap.dedent('''
+            import logging, multiprocessing
+            from common.logs import initialize_log
+
+            def work(shard):
+                for i in range(100):
+                    logging.debug("action: work | result: success | shard: %d | i: %d", shard, i)
+
+            if __name__ == "__main__":
+                initialize_log("DEBUG", asynchronous=True)
+                logging.info("action: start | result: success")
+                worker = multiprocessing.get_context("fork").Process(target=work, args=(1,))
+                worker.start()
+                worker.join()
+                work(0)
+        ''')
+        result = subprocess.run([sys.executable, '-c', script], cwd=SERVER_DIR, capture_output=True, text=True, timeout=30)
+        lines = result.stderr.splitlines()
+        self.assertEqual(201, len(lines))
+        self.assertIn('INFO     action: start | result: success', lines[0])
+        for shard in (0, 1):
+            self.assertEqual([f'action: work | result: success | shard: {shard} | i: {i}' for i in range(100)],
+                             [line.split('DEBUG    ')[1] for line in lines if f'shard: {shard} |' in line])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+from common.metrics import MetricsRegistry, MetricsServer
+from urllib.request import urlopen
+import unittest
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render_must_expose_counters_and_gauges(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("bets_total", "Bets")
+        gauge = registry.gauge("clients", "Clients")
+        counter.inc(3)
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+
+        self.assertEqual("# HELP bets_total Bets\n# TYPE bets_total counter\nbets_total 3\n"
+                         "# HELP clients Clients\n# TYPE clients gauge\nclients 1\n", registry.render())
+
+    def test_histogram_must_render_cumulative_buckets(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = registry.render().splitlines()[2:]
+        self.assertEqual(['latency_seconds_bucket{le="0.1"} 1',
+                          'latency_seconds_bucket{le="1"} 2',
+                          'latency_seconds_bucket{le="+Inf"} 3',
+                          'latency_seconds_sum 5.55',
+                          'latency_seconds_count 3'], lines)
+
+    def test_metrics_server_must_serve_registry(self):
+        registry = MetricsRegistry()
+        registry.counter("bets_total", "Bets").inc()
+        server = MetricsServer(0, registry)
+        server.start()
+        try:
+            with urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+                self.assertIn("bets_total 1", response.read().decode('utf-8'))
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
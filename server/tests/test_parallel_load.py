@@ -0,0 +1,62 @@
+from common.draw import compute_winners, DrawEngine, DrawRule
+from common.parallel_load import load_batches, winners_per_agency
+from common.storage import BinaryBetStorage, CsvBetStorage
+from common.utils import BetBatch, LOTTERY_WINNER_NUMBER
+from helpers import bet_fields
+import os
+import tempfile
+import unittest
+
+class TestParallelLoad(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+
+    def fill(self, storage):
+        for start in range(0, 300, 30):
+            batch = BetBatch(start // 30 % 3 + 1)
+            for i in range(start, start + 30):
+                batch.append(f'first {i % 7}', 'last, "quoted"', 10000000 + i, 20001220, LOTTERY_WINNER_NUMBER - i % 5)
+            storage.append(batch)
+        storage.flush(sync=False)
+        storage.close()
+
+    def assert_parallel_load(self, storage):
+        self.fill(storage)
+        stored = [bet_fields(bet) for bet in storage.load_bets()]
+        # A row or record left half-written by an interrupted append
+        with open(storage.filepath, 'ab') as file:
+            file.write(b'1,first')
+
+        loaded = [bet for batch in load_batches(storage, workers=2, chunk_bytes=500) for bet in batch]
+        self.assertEqual(stored, [bet_fields(bet) for bet in loaded])
+
+        engine = DrawEngine([DrawRule(1, [LOTTERY_WINNER_NUMBER]), DrawRule(2, [LOTTERY_WINNER_NUMBER - 1], [2])])
+        winners, bets = winners_per_agency(storage, engine, workers=2, chunk_bytes=500)
+        self.assertEqual(compute_winners(storage, engine), winners)
+        self.assertEqual({'1': 120, '2': 90, '3': 90}, bets)
+        self.assertEqual((winners, bets), winners_per_agency(storage, engine, workers=1, chunk_bytes=500))
+        storage.close()
+
+    def test_binary_storage_must_load_in_parallel_as_sequentially(self):
+        self.assert_parallel_load(BinaryBetStorage(os.path.join(self._dir.name, 'bets.log')))
+
+    def test_csv_storage_must_load_in_parallel_as_sequentially(self):
+        self.assert_parallel_load(CsvBetStorage(os.path.join(self._dir.name, 'bets.csv')))
+
+    def test_csv_split_must_cut_at_row_boundaries(self):
+        storage = CsvBetStorage(os.path.join(self._dir.name, 'bets.csv'))
+        self.fill(storage)
+        with open(storage.filepath, 'rb') as file:
+            data = file.read()
+
+        ranges = storage.split(100)
+        self.assertEqual(0, ranges[0][0])
+        self.assertEqual(len(data), ranges[-1][1])
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(b'\n', data[end - 1:end])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+from common.pipelining import BatchAcker
+from common.utils import BetBatch, LOTTERY_WINNER_NUMBER
+from common.winners import WinnersIndex
+from concurrent.futures import Future
+import socket
+import struct
+import unittest
+
+def ack(success, sequence_number):
+    return struct.pack('>IBI', 5, 0 if success else 1, sequence_number)
+
+def stored_chunk(agency, number):
+    chunk = BetBatch(agency)
+    chunk.append('first', 'last', 10000000 + number, 20001220, number)
+    future = Future()
+    future.set_result(True)
+    return chunk, future
+
+class TestBatchAcker(unittest.TestCase):
+
+    def setUp(self):
+        self.server_sock, self.client_sock = socket.socketpair()
+        self.addCleanup(self.server_sock.close)
+        self.addCleanup(self.client_sock.close)
+        self.client_sock.settimeout(2)
+        self.winners_index = WinnersIndex()
+        self.acker = BatchAcker(self.server_sock, self.winners_index, 8)
+
+    def receive_acks(self, count):
+        data = b''
+        while len(data) < count * 9:
+            data += self.client_sock.recv(1024)
+        return data
+
+    def test_batches_stored_together_must_get_one_cumulative_ack(self):
+        first = Future()
+        self.acker.submit(1, (BetBatch(1), first), 1)
+        self.acker.submit(2, stored_chunk(1, LOTTERY_WINNER_NUMBER), 1)
+        self.acker.submit(3, None, 0)
+        first.set_result(True)
+        self.acker.close()
+
+        self.assertEqual(ack(True, 3), self.receive_acks(1))
+        self.assertEqual(['10007574'], self.winners_index.winners_for_agency('1'))
+
+    def test_ack_must_wait_for_batch_to_be_stored(self):
+        chunk = BetBatch(1)
+        chunk.append('first', 'last', 10000000, 20001220, LOTTERY_WINNER_NUMBER)
+        future = Future()
+        self.acker.submit(1, (chunk, future), 1)
+        self.client_sock.settimeout(0.1)
+        with self.assertRaises(socket.timeout):
+            self.client_sock.recv(16)
+
+        future.set_result(True)
+        self.client_sock.settimeout(2)
+        self.assertEqual(ack(True, 1), self.receive_acks(1))
+        self.assertEqual(['10000000'], self.winners_index.winners_for_agency('1'))
+        self.acker.close()
+
+    def test_failed_batch_must_be_acked_with_error_after_previous_ones(self):
+        failed = Future()
+        failed.set_exception(OSError("disk full"))
+        self.acker.submit(1, stored_chunk(1, 1), 1)
+        self.acker.submit(2, (BetBatch(1), failed), 1)
+        self.acker.submit_error(3)
+        self.acker.close()
+
+        self.assertEqual(ack(True, 1) + ack(False, 2) + ack(False, 3), self.receive_acks(3))
+
+if __name__ == '__main__':
+    unittest.main()
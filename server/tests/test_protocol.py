@@ -0,0 +1,181 @@
+from common.compression import choose_codec, COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_LZ4
+from common.protocol import parse_bet_batch, parse_lookup, recv_all, receive_bet_batch_stream, encode_lookup_response, encode_tallies, encode_winners, encode_winners_chunks, send_buffers, send_winners, encode_compressed_batch_payload, BetBatchDecoder, CompressedBetBatchDecoder, ProtocolError, MessageTooLargeError
+from common.utils import Bet
+import socket
+import struct
+import threading
+import unittest
+
+def encode_bet(nombre, apellido, documento, nacimiento, numero):
+    nombre = nombre.encode('utf-8')
+    apellido = apellido.encode('utf-8')
+    return (struct.pack('>I', len(nombre)) + nombre + struct.pack('>I', len(apellido)) + apellido
+            + struct.pack('>III', documento, nacimiento, numero))
+
+class TestProtocol(unittest.TestCase):
+
+    def test_parse_bet_batch_must_keep_fields(self):
+        payload = struct.pack('>II', 3, 2) + encode_bet('Tiago Nicolás', 'Rivera', 34407251, 20010829, 1033) \
+            + encode_bet('first', 'last', 10000000, 20001220, 7574)
+
+        self.assertEqual(('3', [
+            ('Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', '1033'),
+            ('first', 'last', '10000000', '2000-12-20', '7574'),
+        ]), parse_bet_batch(payload))
+
+    def test_parse_bet_batch_without_bets_must_be_empty(self):
+        self.assertEqual(('3', []), parse_bet_batch(struct.pack('>II', 3, 0)))
+
+    def test_parse_bet_batch_with_truncated_bet_must_fail(self):
+        payload = struct.pack('>II', 3, 1) + encode_bet('first', 'last', 10000000, 20001220, 7574)
+        self.assertIsNone(parse_bet_batch(payload[:-1]))
+
+    def test_parse_bet_batch_with_out_of_bounds_name_must_fail(self):
+        payload = struct.pack('>III', 3, 1, 100) + b'first'
+        self.assertIsNone(parse_bet_batch(payload))
+
+    def test_recv_all_must_return_exactly_n_bytes(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(b'0123456789')
+            self.assertEqual(b'01234', recv_all(receiver, 5))
+            self.assertEqual(b'56789', recv_all(receiver, 5))
+
+    def test_recv_all_with_closed_connection_must_return_none(self):
+        sender, receiver = socket.socketpair()
+        with receiver:
+            sender.sendall(b'012')
+            sender.close()
+            self.assertIsNone(recv_all(receiver, 5))
+
+    def decode_by_pieces(self, payload, piece_size, buffer_size=64, chunk_bets=1024, compression=COMPRESSION_NONE):
+        if compression == COMPRESSION_NONE:
+            decoder = BetBatchDecoder(len(payload), buffer_size, chunk_bets)
+        else:
+            decoder = CompressedBetBatchDecoder(len(payload), compression, 1 << 20, buffer_size, chunk_bets)
+        chunks = []
+        offset = 0
+        while not decoder.done:
+            view = decoder.writable_view()
+            received = payload[offset:offset + min(piece_size, len(view))]
+            view[:len(received)] = received
+            offset += len(received)
+            chunks.extend(decoder.feed(len(received)))
+        chunks.append(decoder.finish())
+        return chunks
+
+    def test_bet_batch_decoder_must_leave_info_logs_to_the_sampled_batch_log(self):
+        payload = struct.pack('>II', 3, 1) + encode_bet('first', 'last', 10000000, 20001220, 7574)
+
+        with self.assertLogs(level='DEBUG') as captured:
+            self.decode_by_pieces(payload, len(payload))
+        self.assertEqual(['DEBUG'], sorted({record.levelname for record in captured.records}))
+
+    def test_bet_batch_decoder_must_decode_bets_received_byte_by_byte(self):
+        payload = struct.pack('>II', 3, 3) + encode_bet('Tiago Nicolás', 'Rivera', 34407251, 20010829, 1033) \
+            + encode_bet('first', 'last', 10000000, 20001220, 7574) + encode_bet('a', 'b', 1, 19990101, 2)
+
+        chunks = self.decode_by_pieces(payload, 1, chunk_bets=2)
+        self.assertEqual([2, 1], [len(chunk) for chunk in chunks if len(chunk)])
+        bets = [(bet.agency, bet.first_name, bet.last_name, bet.document, bet.number)
+                for chunk in chunks for bet in chunk]
+        self.assertEqual([
+            (3, 'Tiago Nicolás', 'Rivera', '34407251', 1033),
+            (3, 'first', 'last', '10000000', 7574),
+            (3, 'a', 'b', '1', 2),
+        ], bets)
+
+    def test_bet_batch_decoder_with_truncated_bet_must_fail(self):
+        payload = struct.pack('>II', 3, 1) + encode_bet('first', 'last', 10000000, 20001220, 7574)
+        with self.assertRaises(ProtocolError):
+            self.decode_by_pieces(payload[:-1], 7)
+
+    def test_bet_batch_decoder_with_bet_larger_than_buffer_must_fail(self):
+        payload = struct.pack('>II', 3, 1) + encode_bet('x' * 100, 'last', 10000000, 20001220, 7574)
+        with self.assertRaises(ProtocolError):
+            self.decode_by_pieces(payload, 16)
+
+    def test_compressed_bet_batch_decoder_must_decode_as_uncompressed(self):
+        payload = struct.pack('>II', 3, 200) + b''.join(
+            encode_bet('Milagros De Los Angeles', 'Valenzuela', 28765432 + i, 19921210, i) for i in range(200))
+        compressed = encode_compressed_batch_payload(payload, COMPRESSION_ZLIB)
+        self.assertLess(len(compressed), len(payload) // 4)
+
+        chunks = self.decode_by_pieces(compressed, 7, buffer_size=128, chunk_bets=64, compression=COMPRESSION_ZLIB)
+        expected = self.decode_by_pieces(payload, 7, buffer_size=128, chunk_bets=64)
+        columns = lambda chunk: (chunk.agency, list(chunk.first_names), list(chunk.documents), list(chunk.numbers))
+        self.assertEqual([columns(chunk) for chunk in expected], [columns(chunk) for chunk in chunks])
+
+    def test_compressed_bet_batch_decoder_with_wrong_length_must_fail(self):
+        payload = struct.pack('>II', 3, 1) + encode_bet('first', 'last', 10000000, 20001220, 7574)
+        compressed = encode_compressed_batch_payload(payload, COMPRESSION_ZLIB)
+        longer = struct.pack('>I', len(payload) - 1) + compressed[4:]
+        for malformed in (compressed[:-1], longer, struct.pack('>I', 1 << 21) + compressed[4:]):
+            with self.assertRaises(ProtocolError):
+                self.decode_by_pieces(malformed, 5, compression=COMPRESSION_ZLIB)
+
+    def test_choose_codec_must_follow_client_preference_among_accepted(self):
+        self.assertEqual(COMPRESSION_ZLIB, choose_codec([COMPRESSION_LZ4, COMPRESSION_ZLIB], [COMPRESSION_ZLIB]))
+        self.assertEqual(COMPRESSION_NONE, choose_codec([COMPRESSION_ZLIB], []))
+
+    def test_receive_bet_batch_stream_with_too_large_message_must_fail(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(struct.pack('>I', 1000))
+            with self.assertRaises(MessageTooLargeError):
+                list(receive_bet_batch_stream(receiver, 999))
+
+    def test_receive_bet_batch_stream_must_skip_malformed_message(self):
+        malformed = struct.pack('>III', 3, 1, 100) + b'first'
+        valid = struct.pack('>II', 3, 0)
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(struct.pack('>I', len(malformed)) + malformed + struct.pack('>I', len(valid)) + valid)
+            with self.assertRaises(ProtocolError):
+                list(receive_bet_batch_stream(receiver, 1000, buffer_size=8))
+            self.assertEqual(0, sum(len(chunk) for chunk in receive_bet_batch_stream(receiver, 1000)))
+
+    def test_encode_winners_must_pack_documents_after_header(self):
+        self.assertEqual(struct.pack('>IBIII', 13, 0, 2, 30904465, 21689196), encode_winners(['30904465', '21689196']))
+        self.assertEqual(struct.pack('>IBI', 5, 0, 0), encode_winners([]))
+
+    def test_encode_tiered_winners_must_pack_document_and_tier_pairs(self):
+        self.assertEqual(struct.pack('>IBIIIII', 21, 0, 2, 30904465, 1, 21689196, 3),
+                         encode_winners([('30904465', 1), ('21689196', 3)], tiered=True))
+
+    def test_encode_tallies_must_pack_agency_bets_and_winners(self):
+        self.assertEqual(struct.pack('>IBIIIIIII', 29, 0, 2, 1, 150, 3, 2, 10, 0),
+                         encode_tallies([(1, 150, 3), (2, 10, 0)]))
+
+    def test_parse_lookup_must_only_accept_indexed_fields(self):
+        self.assertEqual(("document", 34407251), parse_lookup(struct.pack('>II', 1, 34407251)))
+        self.assertEqual(("agency", 3), parse_lookup(struct.pack('>II', 2, 3)))
+        self.assertIsNone(parse_lookup(struct.pack('>II', 3, 3)))
+        self.assertIsNone(parse_lookup(struct.pack('>I', 1)))
+
+    def test_encode_lookup_response_must_pack_total_and_bets(self):
+        bet_data = struct.pack('>I', 1) + encode_bet('Tiago Nicolás', 'Rivera', 34407251, 20010829, 1033)
+        self.assertEqual(struct.pack('>IBII', 9 + len(bet_data), 0, 5, 1) + bet_data,
+                         encode_lookup_response(5, [Bet('1', 'Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', '1033')]))
+
+    def test_encode_winners_chunks_must_split_documents(self):
+        chunks = [bytes(chunk) for chunk in encode_winners_chunks(['1', '2', '3'], chunk_size=2)]
+        self.assertEqual([struct.pack('>IBI', 17, 0, 3), struct.pack('>II', 1, 2), struct.pack('>I', 3)], chunks)
+
+    def test_send_buffers_and_send_winners_must_send_everything_in_order(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            send_buffers(sender, [b'ab', b'', bytearray(b'cd')])
+            self.assertEqual(b'abcd', recv_all(receiver, 4))
+
+            winners = [str(i) for i in range(50000)]
+            expected = encode_winners(winners)
+            received = []
+            reader = threading.Thread(target=lambda: received.append(recv_all(receiver, len(expected))))
+            reader.start()
+            send_winners(sender, winners)
+            reader.join()
+            self.assertEqual(expected, received[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+from common.server import Server
+from common.storage import BinaryBetStorage
+from common.storage_writer import StorageWriter
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+BUSY_RESPONSE = struct.pack('>IB', 1, 2)
+OK_RESPONSE = struct.pack('>IB', 1, 0)
+ERROR_RESPONSE = struct.pack('>IB', 1, 1)
+
+class TestServerAdmission(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage_writer = StorageWriter(BinaryBetStorage(os.path.join(directory.name, 'bets.log')))
+        self.ready = threading.Event()
+        self.server = Server(0, 5, 1, storage_writer, 1024, max_clients=1, accept_queue_size=1, idle_timeout=0.5,
+                             on_ready=self.ready.set)
+        self.port = self.server._server_socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        with self.assertRaises(SystemExit):
+            self.server._signal_handler(None, None)
+        self.thread.join(5)
+
+    def connect(self):
+        client = socket.create_connection(('127.0.0.1', self.port))
+        self.addCleanup(client.close)
+        time.sleep(0.05)
+        return client
+
+    def test_server_must_report_ready_once_running(self):
+        self.assertTrue(self.ready.wait(5))
+
+    def test_connection_over_queue_must_get_busy_response(self):
+        self.connect()
+        self.connect()
+        rejected = self.connect()
+        rejected.settimeout(1)
+
+        self.assertEqual(BUSY_RESPONSE, rejected.recv(16))
+        self.assertEqual(b'', rejected.recv(16))
+
+    def test_idle_connection_must_be_closed_and_free_its_handler(self):
+        idle = self.connect()
+        queued = self.connect()
+        idle.settimeout(2)
+        queued.settimeout(2)
+
+        self.assertEqual(b'', idle.recv(16))
+        queued.sendall(struct.pack('>III', 2, 4, 1))
+        self.assertEqual(OK_RESPONSE, queued.recv(16))
+
+class TestServerBatches(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = BinaryBetStorage(os.path.join(directory.name, 'bets.log'))
+        self.server = Server(0, 5, 1, StorageWriter(self.storage), 1024 * 1024, idle_timeout=5)
+        self.port = self.server._server_socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.assertRaises(SystemExit):
+            self.server._signal_handler(None, None)
+        self.thread.join(5)
+
+    def test_sigterm_must_close_connections_without_errors(self):
+        client = socket.create_connection(('127.0.0.1', self.port))
+        self.addCleanup(client.close)
+        client.settimeout(5)
+        client.sendall(struct.pack('>III', 2, 4, 1))
+        self.assertEqual(OK_RESPONSE, client.recv(16))
+
+        with self.assertLogs(level='DEBUG') as captured:
+            self.stop()
+        self.assertEqual([], [line for line in captured.output if 'result: fail' in line])
+        self.assertEqual(b'', client.recv(16))
+
+    def test_malformed_batch_must_store_none_of_its_chunks(self):
+        bets = [struct.pack('>I5sI4sIII', 5, b'first', 4, b'last', 10000000 + i, 20001220, i) for i in range(3000)]
+        # The last bet announces a name longer than the message
+        bets.append(struct.pack('>I', 1000))
+        body = struct.pack('>II', 1, len(bets)) + b''.join(bets)
+        client = socket.create_connection(('127.0.0.1', self.port))
+        self.addCleanup(client.close)
+        client.settimeout(5)
+        client.sendall(struct.pack('>II', 1, len(body)) + body)
+        self.assertEqual(ERROR_RESPONSE, client.recv(16))
+
+        self.stop()
+        self.assertEqual([], list(self.storage.load_bets()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+from common.protocol import encode_tallies
+from common.sharding import ShardCoordinator, ShardLottery
+from common.storage import BinaryBetStorage
+from common.storage_writer import StorageWriter
+from common.utils import LOTTERY_WINNER_NUMBER
+from common.winners import WinnersIndex
+from helpers import batch
+from multiprocessing import Pipe
+import os
+import tempfile
+import threading
+import unittest
+
+class TestShardCoordinator(unittest.TestCase):
+
+    def start_shards(self, num_agencies, num_shards, on_ready=None, storage_writers=()):
+        shards = []
+        coordinator_conns = []
+        for shard in range(num_shards):
+            coordinator_conn, shard_conn = Pipe()
+            lottery = ShardLottery(shard_conn)
+            index = WinnersIndex()
+            lottery.start(index, storage_writers[shard] if storage_writers else None)
+            shards.append((lottery, index))
+            coordinator_conns.append(coordinator_conn)
+
+        threading.Thread(target=ShardCoordinator(num_agencies, coordinator_conns, on_ready).run, daemon=True).start()
+        return shards
+
+    def test_draw_must_wait_for_agencies_finished_in_every_shard(self):
+        (lottery1, index1), (lottery2, index2) = self.start_shards(2, 2)
+        index1.add_winner('1', '10000000')
+        index2.add_winner('2', '20000000')
+
+        lottery1.mark_finished('1')
+        self.assertFalse(lottery1.done)
+        lottery2.mark_finished('2')
+
+        self.assertTrue(lottery1.wait())
+        self.assertTrue(lottery2.wait())
+
+    def test_draw_must_share_winners_of_every_shard(self):
+        (lottery1, index1), (lottery2, index2) = self.start_shards(1, 2)
+        index1.add_winner('1', '10000000')
+        index2.add_winner('1', '10000001')
+
+        lottery2.mark_finished('1')
+
+        self.assertTrue(lottery1.wait())
+        self.assertTrue(lottery2.wait())
+        self.assertEqual(['10000000', '10000001'], sorted(index1.winners_for_agency('1')))
+        self.assertEqual(['10000000', '10000001'], sorted(index2.winners_for_agency('1')))
+
+    def test_ready_must_be_reported_once_every_shard_is_ready(self):
+        ready = threading.Event()
+        (lottery1, _), (lottery2, _) = self.start_shards(1, 2, ready.set)
+
+        lottery1.notify_ready()
+        self.assertFalse(ready.wait(0.2))
+        lottery2.notify_ready()
+
+        self.assertTrue(ready.wait(5))
+
+    def storage_writer(self, sequence_numbers):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return StorageWriter(BinaryBetStorage(os.path.join(directory.name, 'bets.log')), sequence_numbers=sequence_numbers)
+
+    def test_agency_must_be_granted_to_one_shard_at_a_time_with_its_last_sequence_number(self):
+        writer1, writer2 = self.storage_writer({1: 3}), self.storage_writer({})
+        (lottery1, _), (lottery2, _) = self.start_shards(1, 2, storage_writers=[writer1, writer2])
+        lottery2.notify_ready()
+        acquired = threading.Event()
+        threading.Thread(target=lambda: (lottery2.acquire_agency(1), acquired.set()), daemon=True).start()
+        self.assertFalse(acquired.wait(0.2))
+        lottery1.notify_ready()
+        self.assertTrue(acquired.wait(5))
+        self.assertEqual({1: 3}, writer2.sequence_numbers())
+
+        acquired.clear()
+        threading.Thread(target=lambda: (lottery1.acquire_agency(1), acquired.set()), daemon=True).start()
+        self.assertFalse(acquired.wait(0.2))
+        writer2.advance_sequence_number(1, 7)
+        lottery2.release_agency(1)
+        self.assertTrue(acquired.wait(5))
+        self.assertEqual({1: 7}, writer1.sequence_numbers())
+
+    def test_acquire_agency_must_fail_once_lottery_is_cancelled(self):
+        (lottery, _), = self.start_shards(1, 1)
+        threading.Timer(0.1, lottery.cancel).start()
+
+        with self.assertRaises(ConnectionAbortedError):
+            lottery.acquire_agency(1)
+
+    def test_find_bets_must_gather_the_bets_stored_by_every_shard(self):
+        writer1, writer2 = self.storage_writer({}), self.storage_writer({})
+        for writer, agency in ((writer1, 1), (writer2, 2)):
+            writer.start()
+            self.addCleanup(writer.stop)
+            writer.submit(batch(agency, 1, 2)).result(timeout=5)
+        (lottery1, _), _ = self.start_shards(2, 2, storage_writers=[writer1, writer2])
+
+        total, bets = lottery1.find_bets(writer1.storage, 'document', 10000002, 10)
+        self.assertEqual(2, total)
+        self.assertEqual([1, 2], sorted(bet.agency for bet in bets))
+
+        total, bets = lottery1.find_bets(writer1.storage, 'document', 10000001, 1)
+        self.assertEqual(2, total)
+        self.assertEqual(1, len(bets))
+
+    def test_tallies_must_add_up_every_shard_before_and_after_the_draw(self):
+        (lottery1, index1), (lottery2, index2) = self.start_shards(1, 2)
+        index1.add_batch(batch(1, LOTTERY_WINNER_NUMBER, 1))
+        index2.add_batch(batch(1, LOTTERY_WINNER_NUMBER))
+        expected = encode_tallies([(1, 3, 2)])
+
+        self.assertEqual(expected, lottery1.tallies_response(index1))
+        lottery2.mark_finished('1')
+        self.assertTrue(lottery1.wait())
+        self.assertEqual(expected, lottery1.tallies_response(index1))
+        self.assertEqual(expected, lottery2.tallies_response(index2))
+
+    def test_lottery_must_be_cancelled_when_coordinator_is_gone(self):
+        coordinator_conn, shard_conn = Pipe()
+        lottery = ShardLottery(shard_conn)
+        lottery.start(WinnersIndex())
+        coordinator_conn.close()
+
+        self.assertFalse(lottery.wait())
+
+if __name__ == '__main__':
+    unittest.main()
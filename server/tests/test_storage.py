@@ -0,0 +1,146 @@
+from common.names import NameTable
+from common.storage import BinaryBetStorage, CsvBetStorage
+from common.storage_writer import StorageWriter, FSYNC_POLICY_ALWAYS
+from common.utils import Bet, BetBatch, LOTTERY_WINNER_NUMBER, load_bets
+from helpers import bet_fields
+import os
+import tempfile
+import unittest
+
+class TestBinaryBetStorage(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.storage = BinaryBetStorage(os.path.join(self._dir.name, 'bets.log'))
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_store_bets_and_load_bets_keeps_fields_data_and_order(self):
+        to_store = [
+            Bet('1', 'Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', 1033),
+            Bet('2', 'first', 'last', '10000000', '2000-12-20', 7500),
+        ]
+        self.storage.store_bets(to_store[:1])
+        self.storage.store_bets(to_store[1:])
+        from_load = list(self.storage.load_bets())
+
+        self.assertEqual(2, len(from_load))
+        for stored, loaded in zip(to_store, from_load):
+            self.assertEqual(bet_fields(stored), bet_fields(loaded))
+
+    def test_find_by_number_must_only_yield_matching_bets(self):
+        self.storage.store_bets([
+            Bet('1', 'first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'first', 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER + 1),
+            Bet('2', 'first', 'last', '10000002', '2000-12-20', LOTTERY_WINNER_NUMBER),
+        ])
+
+        self.assertEqual([(1, '10000000'), (2, '10000002')],
+                         list(self.storage.find_by_number({LOTTERY_WINNER_NUMBER})))
+
+    def test_load_bets_must_skip_half_written_record(self):
+        self.storage.store_bets([Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)] * 2)
+        with open(self.storage.filepath, 'r+b') as file:
+            file.truncate(os.path.getsize(self.storage.filepath) - 3)
+
+        self.assertEqual(1, len(list(self.storage.load_bets())))
+
+    def test_load_bets_must_share_names_stored_once(self):
+        self.storage.store_bets([Bet('1', 'first', 'last', str(10000000 + i), '2000-12-20', 7500) for i in range(3)])
+        self.storage.close()
+        self.storage.append(BetBatch.from_bets(2, [Bet('2', 'last', 'other', '10000003', '2000-12-20', 7500)]))
+        self.storage.flush(sync=False)
+        self.storage.close()
+
+        loaded = list(self.storage.load_bets())
+        self.assertEqual([('first', 'last')] * 3 + [('last', 'other')], [(bet.first_name, bet.last_name) for bet in loaded])
+        self.assertIs(loaded[0].first_name, loaded[2].first_name)
+        self.assertIs(loaded[0].last_name, loaded[3].first_name)
+        self.assertEqual(len(NameTable.MAGIC) + 3 * 2 + len('firstlastother'),
+                         os.path.getsize(self.storage.filepath + '.names'))
+
+    def test_load_bets_must_stop_at_record_with_lost_name(self):
+        self.storage.store_bets([Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)])
+        self.storage.store_bets([Bet('1', 'other', 'last', '10000001', '2000-12-20', 7500)])
+        self.storage.close()
+        with open(self.storage.filepath + '.names', 'r+b') as names:
+            names.truncate(os.path.getsize(self.storage.filepath + '.names') - 1)
+
+        self.assertEqual(['10000000'], [bet.document for bet in self.storage.load_bets()])
+
+    def test_append_and_flush_must_keep_fields_data(self):
+        bet = Bet('3', 'Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', 1033)
+        self.storage.append(BetBatch.from_bets(3, [bet]))
+        self.storage.flush(sync=False)
+
+        self.assertEqual([bet_fields(bet)], [bet_fields(loaded) for loaded in self.storage.load_bets()])
+        self.storage.close()
+
+    def test_export_csv_must_be_readable_by_load_bets(self):
+        bet = Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)
+        self.storage.store_bets([bet])
+        csv_filepath = os.path.join(self._dir.name, 'bets.csv')
+        self.storage.export_csv(csv_filepath)
+
+        self.assertEqual([bet_fields(bet)], [bet_fields(loaded) for loaded in load_bets(csv_filepath)])
+
+class TestCsvBetStorage(unittest.TestCase):
+
+    def test_append_and_flush_must_be_readable_by_load_bets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = CsvBetStorage(os.path.join(directory, 'bets.csv'))
+            bet = Bet('3', 'Tiago Nicolás', 'Rivera', '34407251', '2001-08-29', 1033)
+            storage.append(BetBatch.from_bets(3, [bet]))
+            storage.flush(sync=False)
+            storage.close()
+
+            self.assertEqual([bet_fields(bet)], [bet_fields(loaded) for loaded in load_bets(storage.filepath)])
+
+    def test_find_by_number_must_only_yield_matching_bets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = CsvBetStorage(os.path.join(directory, 'bets.csv'))
+            storage.store_bets([
+                Bet('1', 'first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER),
+                Bet('2', 'first', 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER + 1),
+            ])
+
+            self.assertEqual([(1, '10000000')], list(storage.find_by_number({LOTTERY_WINNER_NUMBER})))
+
+class TestStorageWriter(unittest.TestCase):
+
+    def test_submitted_batches_must_be_stored_in_order_once_resolved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = BinaryBetStorage(os.path.join(directory, 'bets.log'))
+            writer = StorageWriter(storage, FSYNC_POLICY_ALWAYS)
+            writer.start()
+            futures = [writer.submit(BetBatch.from_bets(agency, [Bet(str(agency), 'first', 'last', '10000000', '2000-12-20', 7500)]))
+                       for agency in range(10)]
+            for future in futures:
+                future.result(timeout=5)
+
+            self.assertEqual(list(range(10)), [bet.agency for bet in storage.load_bets()])
+            writer.stop()
+
+    def test_copies_of_a_sequenced_batch_in_one_group_must_be_stored_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = CsvBetStorage(os.path.join(directory, 'bets.csv'))
+            writer = StorageWriter(storage, group_delay=0.3)
+            writer.start()
+            batch = BetBatch.from_bets(1, [Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)])
+            futures = [writer.submit(batch, 4), writer.submit(batch, 4)]
+
+            self.assertEqual([True, False], [future.result(timeout=5) for future in futures])
+            writer.stop()
+            self.assertEqual(1, len(list(storage.load_bets())))
+
+    def test_submit_after_stop_must_fail(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = StorageWriter(BinaryBetStorage(os.path.join(directory, 'bets.log')))
+            writer.start()
+            writer.stop()
+            with self.assertRaises(RuntimeError):
+                writer.submit([])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+from common.draw import parse_draw_rules, DrawEngine
+from common.storage import BinaryBetStorage, CsvBetStorage
+from common.storage_writer import StorageWriter
+from common.utils import Bet, BetBatch, LOTTERY_WINNER_NUMBER
+from common.wal import WriteAheadLog, recover, COMPACT_MIN_RECORDS
+from helpers import batch
+import os
+import tempfile
+import unittest
+import zlib
+
+class TestWriteAheadLog(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.storage = BinaryBetStorage(os.path.join(self._dir.name, 'bets.log'))
+        self.wal_filepath = os.path.join(self._dir.name, 'bets.wal')
+
+    def start_writer(self):
+        wal = WriteAheadLog(self.wal_filepath)
+        state = recover(self.storage, wal)
+        writer = StorageWriter(self.storage, wal=wal, sequence_numbers=state.sequence_numbers)
+        writer.start()
+        return writer, state
+
+    def test_recover_must_rebuild_winners_finished_agencies_and_sequence_numbers(self):
+        writer, _ = self.start_writer()
+        writer.submit(batch(1, LOTTERY_WINNER_NUMBER, 1), 1).result(timeout=5)
+        writer.submit(batch(2, 2), 3).result(timeout=5)
+        writer.record_finished('1')
+        writer.stop()
+
+        state = WriteAheadLog(self.wal_filepath).read()
+        self.assertEqual({'1': [('10007574', 1)]}, state.winners)
+        self.assertEqual({'1': 2, '2': 1}, state.bets)
+        self.assertEqual(['1'], state.finished_agencies)
+        self.assertEqual({1: 1, 2: 3}, state.sequence_numbers)
+        self.assertEqual(os.path.getsize(self.storage.filepath), state.storage_size)
+
+    def test_recover_must_compact_a_long_log_into_the_same_state(self):
+        writer, _ = self.start_writer()
+        for sequence_number in range(1, COMPACT_MIN_RECORDS + 2):
+            writer.submit(batch(sequence_number % 3 + 1, LOTTERY_WINNER_NUMBER), sequence_number).result(timeout=5)
+        writer.record_finished('2')
+        writer.stop()
+        expected = WriteAheadLog(self.wal_filepath).read()
+
+        recover(self.storage, WriteAheadLog(self.wal_filepath))
+        state = WriteAheadLog(self.wal_filepath).read()
+
+        self.assertEqual(5, state.records)
+        self.assertEqual(expected.storage_size, state.storage_size)
+        self.assertEqual(expected.winners, state.winners)
+        self.assertEqual(expected.bets, state.bets)
+        self.assertEqual(expected.sequence_numbers, state.sequence_numbers)
+        self.assertEqual(['2'], state.finished_agencies)
+
+    def test_retried_sequenced_batch_must_not_be_stored_again(self):
+        writer, _ = self.start_writer()
+        self.assertTrue(writer.submit(batch(1, 1), 1).result(timeout=5))
+        writer.stop()
+
+        writer, _ = self.start_writer()
+        self.assertFalse(writer.submit(batch(1, 1), 1).result(timeout=5))
+        self.assertTrue(writer.submit(batch(1, 2), 2).result(timeout=5))
+        writer.stop()
+
+        self.assertEqual([1, 2], [bet.number for bet in self.storage.load_bets()])
+
+    def test_recover_must_truncate_uncommitted_storage_and_torn_record(self):
+        writer, _ = self.start_writer()
+        writer.submit(batch(1, 1)).result(timeout=5)
+        writer.stop()
+        committed = os.path.getsize(self.storage.filepath)
+        self.storage.store_bets([Bet('1', 'first', 'last', '10000002', '2000-12-20', 2)])
+        with open(self.storage.filepath, 'ab') as file:
+            file.write(b'\x00\x00')
+        with open(self.wal_filepath, 'ab') as file:
+            file.write(b'\x00\x00\x00\x09')
+
+        state = recover(self.storage, WriteAheadLog(self.wal_filepath))
+
+        self.assertEqual(committed, state.storage_size)
+        self.assertEqual(committed, os.path.getsize(self.storage.filepath))
+        self.assertEqual([1], [bet.number for bet in self.storage.load_bets()])
+
+    def test_recover_without_log_must_checkpoint_stored_winners(self):
+        storage = CsvBetStorage(os.path.join(self._dir.name, 'bets.csv'))
+        storage.store_bets([Bet('3', 'first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+
+        recover(storage, WriteAheadLog(self.wal_filepath))
+        state = WriteAheadLog(self.wal_filepath).read()
+
+        self.assertEqual({'3': [('10000000', 1)]}, state.winners)
+        self.assertEqual({'3': 1}, state.bets)
+        self.assertEqual(os.path.getsize(storage.filepath), state.storage_size)
+
+    def test_recover_must_rebuild_a_log_of_an_unknown_format_from_the_storage(self):
+        writer, _ = self.start_writer()
+        writer.submit(batch(1, LOTTERY_WINNER_NUMBER, 1), 1).result(timeout=5)
+        writer.stop()
+        payload = b'\x09unknown'
+        with open(self.wal_filepath, 'wb') as file:
+            file.write(len(payload).to_bytes(4, 'big') + zlib.crc32(payload).to_bytes(4, 'big') + payload)
+
+        with self.assertLogs(level='WARNING'):
+            recover(self.storage, WriteAheadLog(self.wal_filepath))
+        state = WriteAheadLog(self.wal_filepath).read()
+
+        self.assertEqual(1, state.records)
+        self.assertEqual({'1': [('10007574', 1)]}, state.winners)
+        self.assertEqual({'1': 2}, state.bets)
+        self.assertEqual(os.path.getsize(self.storage.filepath), state.storage_size)
+
+    def test_recover_must_classify_stored_bets_again_when_the_draw_rules_change(self):
+        writer, _ = self.start_writer()
+        bets = BetBatch(1)
+        bets.append('first', 'last', 123, 20001220, 1111)
+        bets.append('first', 'last', 124, 20001220, 7574)
+        writer.submit(bets, 1).result(timeout=5)
+        writer.stop()
+
+        engine = DrawEngine(parse_draw_rules('1:1111'))
+        state = recover(self.storage, WriteAheadLog(self.wal_filepath), engine)
+
+        self.assertEqual({'1': [('123', 1)]}, state.winners)
+        self.assertEqual({'1': 2}, state.bets)
+        self.assertEqual({1: 1}, state.sequence_numbers)
+        self.assertEqual({'1': [('123', 1)]}, WriteAheadLog(self.wal_filepath).read().winners)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+from common.utils import Bet, BetBatch, LOTTERY_WINNER_NUMBER
+from common.draw import DrawEngine, parse_draw_rules
+from common.lottery import Lottery
+from common.protocol import encode_tallies, encode_winners
+from common.winners import WinnersIndex
+import unittest
+
+class TestWinnersIndex(unittest.TestCase):
+
+    def test_winners_for_agency_must_only_return_winning_documents_of_agency(self):
+        index = WinnersIndex()
+        index.add_bets([
+            Bet('1', 'first', 'last', '10000000', '2000-12-20', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'first', 'last', '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER + 1),
+            Bet('2', 'first', 'last', '10000002', '2000-12-20', LOTTERY_WINNER_NUMBER),
+        ])
+
+        self.assertEqual(['10000000'], index.winners_for_agency('1'))
+        self.assertEqual(['10000002'], index.winners_for_agency('2'))
+
+    def test_add_batch_must_only_register_winning_documents(self):
+        index = WinnersIndex()
+        batch = BetBatch(1)
+        batch.append('first', 'last', 10000000, 20001220, LOTTERY_WINNER_NUMBER)
+        batch.append('first', 'last', 10000001, 20001220, LOTTERY_WINNER_NUMBER + 1)
+        index.add_batch(batch)
+
+        self.assertEqual(['10000000'], index.winners_for_agency('1'))
+
+    def test_tiered_winners_for_agency_must_return_tier_of_each_winner(self):
+        index = WinnersIndex(DrawEngine(parse_draw_rules("1:7574;2:7500")))
+        batch = BetBatch(1)
+        batch.append('first', 'last', 10000000, 20001220, 7500)
+        batch.append('first', 'last', 10000001, 20001220, LOTTERY_WINNER_NUMBER)
+        index.add_batch(batch)
+
+        self.assertEqual([('10000000', 2), ('10000001', 1)], index.tiered_winners_for_agency('1'))
+        self.assertEqual(['10000000', '10000001'], index.winners_for_agency('1'))
+
+    def test_tallies_must_count_stored_bets_and_winners_of_every_agency(self):
+        index = WinnersIndex()
+        index.add_batch(BetBatch.from_bets(2, [Bet('2', 'first', 'last', '10000000', '2000-12-20', 1)]))
+        batch = BetBatch(1)
+        batch.append('first', 'last', 10000001, 20001220, LOTTERY_WINNER_NUMBER)
+        batch.append('first', 'last', 10000002, 20001220, 2)
+        index.add_batch(batch)
+        index.add_batch(batch)
+
+        self.assertEqual([(1, 4, 2), (2, 1, 0)], index.tallies())
+        self.assertEqual(encode_tallies([(1, 4, 2), (2, 1, 0)]), index.tallies_response())
+        index.replace({'3': [('10000003', 1)]})
+        self.assertEqual([(1, 4, 0), (2, 1, 0), (3, 0, 1)], index.tallies())
+
+    def test_winners_for_agency_without_bets_must_be_empty(self):
+        index = WinnersIndex()
+        self.assertEqual([], index.winners_for_agency('1'))
+
+    def test_draw_must_publish_encoded_responses_before_waking_waiters(self):
+        index = WinnersIndex()
+        index.add_winner('1', '10000000', 2)
+        lottery = Lottery(1)
+        lottery.add_draw_hook(index.publish)
+        lottery.mark_finished('1')
+        index.add_winner('1', '10000001')
+
+        self.assertTrue(lottery.wait())
+        self.assertEqual(encode_winners(['10000000']), index.winners_response('1'))
+        self.assertEqual(encode_winners([('10000000', 2)], tiered=True), index.winners_response('1', tiered=True))
+        self.assertEqual(encode_winners([]), index.winners_response('2'))
+        self.assertIs(index.winners_response('1'), index.winners_response('1'))
+
+    def test_winners_response_before_publish_must_encode_current_winners(self):
+        index = WinnersIndex()
+        index.add_winner('1', '10000000')
+        self.assertEqual(encode_winners(['10000000']), index.winners_response('1'))
+
+if __name__ == '__main__':
+    unittest.main()